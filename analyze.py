@@ -0,0 +1,545 @@
+"""
+Statistics over experiment folders in logs/.
+For every folder holding VM*_cr*.log (or .jsonl event logs, or binary .trace files) it
+reports per VM clock jump distributions, queue size histograms and drift, the clock
+difference between VMs over real time, and message latency from send to receive.
+Files are streamed line by line, every statistic is a counter or a per second series,
+so memory stays bounded however long the run was. Folders are analyzed in parallel.
+Binary traces are mapped into memory instead of read, see Trace. --drift only looks up
+the events at every second of a run, so it takes the same time for any trace length.
+With numpy, the events of every log, trace records or parsed text and JSON lines, are
+aggregated as columns a chunk at a time.
+Clocks of VMs run with clock_type "hlc" are times too, hlc_window finds the events
+of a wall clock window by their clocks.
+Run by
+    python3 analyze.py logs/tick_116_random_up_10 logs/tick_666_random_up_10
+    python3 analyze.py logs --json summary.json
+    python3 analyze.py logs/05_01_23_10:00:00 --drift
+"""
+import os
+import re
+import sys
+import json
+import glob
+import mmap
+import struct
+import heapq
+import itertools
+import bisect
+import argparse
+import datetime
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from clock import TRACE_MAGIC, TRACE_HEADER, TRACE_RECORD, TRACE_EVENTS, hlc_from_time
+
+try:
+    import numpy
+except ImportError: # everything still works, row by row
+    numpy = None
+
+# every clock event line any version of clock.py has written, e.g.
+#   2023-03-09 21:45:39,146 : VM0_cr1 Send Message VM0_cr1:0 to VM1 at system time 0.000
+#   ... : VM1_cr1 Received Message VM0_cr1:0 with queue size 0 and internal logic clock 0 at system time 0.001
+#   ... : VM1_cr1 Received Message 17 with queue size 0 ...   (early broadcasts carried no sender)
+#   ... : VM0_cr1 send message VM0_cr1:1 to both other VMs at system time 1.005
+#   ... : VM0_cr1 Internal Event with logical clock 2 at system time 2.010
+LINE = re.compile(
+    r"(\d{4}-\d\d-\d\d) (\d\d):(\d\d):(\d\d),(\d{3}) : VM\d+_cr\d+ (?:"
+    r"Received Message (?:VM(\d+)(?:_cr\d+)?:)?(\d+) with queue size (\d+) and internal logic clock (\d+)"
+    r"|[Ss]end [Mm]essage VM\d+(?:_cr\d+)?:(\d+) to (?:VM(\d+)|(?:both|all) other VMs)"
+    r"|Internal Event with logical clock (\d+)"
+    r") at system time")
+LOG_NAME = re.compile(r"VM(\d+)_cr(\d+)\.(log|jsonl|trace)$")
+
+RECV, SEND, INTERNAL = "recv", "send", "internal"
+BROADCAST = -1 # peer of a message sent to every other VM
+UNKNOWN = -2 # sender of a received message that did not name it
+
+
+def _day_epochs():
+    # parsing dates is slow, and a log only spans a day or two
+    cache = {}
+
+    def day_epoch(day):
+        if day not in cache:
+            cache[day] = datetime.datetime.strptime(day, "%Y-%m-%d").timestamp()
+        return cache[day]
+    return day_epoch
+
+
+def text_events(path):
+    """
+    Yield (kind, wall time, clock before the event, peer, queue size, message clock)
+    for every clock event of a text log
+    """
+    day_epoch = _day_epochs()
+    match = LINE.match
+    with open(path, errors="replace") as f:
+        for line in f:
+            m = match(line)
+            if m is None:
+                continue
+            day, hh, mm, ss, ms, sender, msg_clock, qsize, clock, stamp, to, internal = m.groups()
+            wall = day_epoch(day) + int(hh) * 3600 + int(mm) * 60 + int(ss) + int(ms) / 1000
+            if msg_clock is not None:
+                yield RECV, wall, int(clock), int(sender) if sender is not None else UNKNOWN, int(qsize), int(msg_clock)
+            elif stamp is not None:
+                yield SEND, wall, int(stamp), int(to) if to is not None else BROADCAST, -1, -1
+            else:
+                yield INTERNAL, wall, int(internal), -1, -1, -1
+
+
+def json_events(path):
+    """
+    The same events from a JSON lines event log, monotonic nanoseconds are turned into
+    wall time with the start line
+    """
+    with open(path) as f:
+        start = json.loads(f.readline())
+        wall, t0 = start["wall"], start["t"]
+        for line in f:
+            e = json.loads(line)
+            event = e["event"]
+            kind = SEND if event == "broadcast" else event
+            peer = BROADCAST if event == "broadcast" else e["peer"]
+            yield kind, wall + (e["t"] - t0) / 1e9, e["clock"], peer, e["queue"], e["msg_clock"]
+
+
+TRACE_TIME = struct.Struct("<q") # the first field of a trace record
+TRACE_CLOCK = struct.Struct("<Q") # the second one
+
+
+class Trace():
+    """
+    A binary trace of clock.TraceLog mapped into memory. With numpy, records is a
+    structured array over the mapping, columns t, clock, msg_clock, queue, peer, vm and
+    event (a position in TRACE_EVENTS), so queries read the file without copying it.
+    Records of one VM are in time order, t are monotonic nanoseconds of that VM and
+    t + offset nanoseconds since the epoch. A view of records a caller still holds keeps
+    the file mapped after close()
+    """
+    DTYPE = numpy.dtype([("t", "<i8"), ("clock", "<u8"), ("msg_clock", "<i8"), ("queue", "<i4"),
+                         ("peer", "<i2"), ("vm", "u1"), ("event", "u1")]) if numpy is not None else None
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.vm, self.tick, self.wall, self.t0, count = TRACE_HEADER.unpack_from(self.map)
+        if magic != TRACE_MAGIC:
+            self.map.close()
+            raise ValueError("{} is not a trace".format(path))
+        # a trace still being written has space reserved past its records
+        self.count = min(count, (len(self.map) - TRACE_HEADER.size) // TRACE_RECORD.size)
+        self.offset = round(self.wall * 1e9) - self.t0
+        self.records = numpy.frombuffer(self.map, self.DTYPE, self.count, TRACE_HEADER.size) if numpy is not None else None
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.records = None
+        try:
+            self.map.close()
+        except BufferError:
+            # a caller still holds a view of records, the file is unmapped once that is dropped
+            pass
+
+    def record(self, i):
+        return TRACE_RECORD.unpack_from(self.map, TRACE_HEADER.size + i * TRACE_RECORD.size)
+
+    def time(self, i):
+        # only the t field of record i
+        return TRACE_TIME.unpack_from(self.map, TRACE_HEADER.size + i * TRACE_RECORD.size)[0]
+
+    def at(self, wall_ns):
+        """
+        Index of the last record at or before wall_ns, -1 if there is none. A binary search
+        that touches about 30 records of a 100M event trace
+        """
+        return bisect.bisect_right(range(self.count), wall_ns - self.offset, key=self.time) - 1
+
+    def clock(self, i):
+        # only the clock field of record i
+        return TRACE_CLOCK.unpack_from(self.map, TRACE_HEADER.size + i * TRACE_RECORD.size + TRACE_TIME.size)[0]
+
+    def between(self, first, last):
+        """
+        Indices of the records with clocks from first to last. The clocks of one VM never
+        decrease, so these are two binary searches
+        """
+        lo = bisect.bisect_left(range(self.count), first, key=self.clock)
+        return range(lo, bisect.bisect_right(range(lo, self.count), last, key=self.clock) + lo)
+
+    def rows(self, chunk=65536):
+        """
+        Every record as a tuple, read chunk records at a time
+        """
+        for start in range(0, self.count, chunk):
+            end = min(self.count, start + chunk)
+            yield from TRACE_RECORD.iter_unpack(self.map[TRACE_HEADER.size + start * TRACE_RECORD.size:TRACE_HEADER.size + end * TRACE_RECORD.size])
+
+    def events(self):
+        """
+        The same events as text_events, from the trace
+        """
+        wall, t0 = self.wall, self.t0
+        broadcast = TRACE_EVENTS.index("broadcast")
+        for t, clock, msg_clock, qsize, peer, vm, event in self.rows():
+            if event == broadcast:
+                yield SEND, wall + (t - t0) / 1e9, clock, BROADCAST, qsize, msg_clock
+            else:
+                yield TRACE_EVENTS[event], wall + (t - t0) / 1e9, clock, peer, qsize, msg_clock
+
+
+def trace_events(path):
+    with Trace(path) as trace:
+        yield from trace.events()
+
+
+def events(path):
+    if path.endswith(".trace"):
+        return trace_events(path)
+    return json_events(path) if path.endswith(".jsonl") else text_events(path)
+
+
+def merge_traces(traces):
+    """
+    Yield (wall ns, vm, event, clock, peer, queue size, msg clock) for the events of all
+    traces in time order, streaming every trace once
+    """
+    def stream(trace):
+        offset, vm = trace.offset, trace.vm
+        for t, clock, msg_clock, qsize, peer, _, event in trace.rows():
+            yield t + offset, vm, TRACE_EVENTS[event], clock, peer, qsize, msg_clock
+    return heapq.merge(*[stream(trace) for trace in traces])
+
+
+def hlc_window(traces, start, end):
+    """
+    Yield (clock, vm, event, wall ns, peer, queue size, msg clock) for the events of
+    traces of clock_type "hlc" VMs whose clocks fall in the wall clock seconds from start
+    up to end, in clock order. Hybrid clocks of all VMs compare as times, so the events
+    of a window are found by integer compares on the clocks alone, and their order
+    never puts a receive before its send
+    """
+    first, last = hlc_from_time(start), hlc_from_time(end) - 1
+    def window(trace):
+        offset, vm = trace.offset, trace.vm
+        for i in trace.between(first, last):
+            t, clock, msg_clock, qsize, peer, _, event = trace.record(i)
+            yield clock, vm, TRACE_EVENTS[event], t + offset, peer, qsize, msg_clock
+    return heapq.merge(*[window(trace) for trace in traces])
+
+
+def trace_drift(traces, every=1.0):
+    """
+    Drift in seconds of every VM, logical clock / clock rate - seconds since the trace
+    began, every `every` seconds while all traces ran, and the difference between every
+    two VMs. Each sample is one binary search, the events in between are never read
+    """
+    start = max(trace.wall for trace in traces)
+    end = min(trace.wall + (trace.time(trace.count - 1) - trace.t0) / 1e9 for trace in traces if trace.count)
+    samples = int((end - start) / every) + 1 if end >= start else 0
+    drift = {} # vm -> sample -> drift
+    for trace in traces:
+        series = drift[trace.vm] = {}
+        for k in range(samples):
+            wall = start + k * every
+            i = trace.at(round(wall * 1e9))
+            if i >= 0:
+                _, clock, msg_clock = trace.record(i)[:3]
+                # the clock after the event, a receive jumps past the message clock
+                series[k] = (max(clock, msg_clock) + 1) / trace.tick - (wall - trace.wall)
+    vms = {vm: {"samples": len(series), "final": series[max(series)] if series else None,
+                "max_abs": max((abs(d) for d in series.values()), default=None)}
+           for vm, series in sorted(drift.items())}
+    pairs = {}
+    for a in sorted(drift):
+        for b in sorted(drift):
+            common = sorted(set(drift[a]) & set(drift[b])) if a < b else []
+            if common:
+                diffs = [drift[a][k] - drift[b][k] for k in common]
+                pairs["VM{}-VM{}".format(a, b)] = {"mean": sum(diffs) / len(diffs), "max_abs": max(abs(d) for d in diffs), "final": diffs[-1]}
+    return {"seconds": samples * every, "vms": vms, "pairs": pairs}
+
+
+def percentiles(counter, ps=(50, 90, 99)):
+    """
+    Percentiles of the values counted in a Counter
+    """
+    total = sum(counter.values())
+    result = {}
+    if not total:
+        return {p: None for p in ps}
+    keys = sorted(counter)
+    for p in ps:
+        target, seen = p / 100 * total, 0
+        for key in keys:
+            seen += counter[key]
+            if seen >= target:
+                result[p] = key
+                break
+    return result
+
+
+def _row_stats(path):
+    # one pass over the events of a log, one at a time
+    counts = Counter()
+    jumps = Counter() # clock increase from one event to the next, 1 without a jump
+    queue_sizes = Counter()
+    per_second = {} # wall second -> clock at the last event in it
+    first = last = None
+    prev = None
+    for kind, wall, clock, peer, qsize, msg_clock in events(path):
+        counts[kind] += 1
+        if kind == RECV:
+            queue_sizes[qsize] += 1
+            if peer == UNKNOWN:
+                counts["recv unattributed"] += 1
+            after = max(clock, msg_clock) + 1
+        else:
+            after = clock + 1
+        if prev is not None:
+            jumps[after - prev] += 1
+        prev = after
+        per_second[int(wall)] = after
+        if first is None:
+            first = wall
+        last = wall
+    return counts, jumps, queue_sizes, per_second, first, last, prev
+
+
+def event_columns(path, chunk=65536):
+    """
+    With numpy, the events of a log as columns, chunk events at a time: event (a position
+    in TRACE_EVENTS), wall time, clock before the event, peer, queue size and message
+    clock. A trace hands out copies of its mapped records, text and JSON lines are parsed
+    into the same columns
+    """
+    if path.endswith(".trace"):
+        with Trace(path) as trace:
+            for start in range(0, trace.count, chunk):
+                r = trace.records[start:start + chunk]
+                yield (r["event"].copy(), trace.wall + (r["t"] - trace.t0) / 1e9, r["clock"].astype(numpy.int64),
+                       r["peer"].astype(numpy.int64), r["queue"].astype(numpy.int64), r["msg_clock"].copy())
+                del r
+        return
+    codes = {RECV: TRACE_EVENTS.index("recv"), SEND: TRACE_EVENTS.index("send"), INTERNAL: TRACE_EVENTS.index("internal")}
+    rows = events(path)
+    while True:
+        block = list(itertools.islice(rows, chunk))
+        if not block:
+            return
+        kind, wall, clock, peer, qsize, msg_clock = zip(*block)
+        yield (numpy.array([codes[k] for k in kind], numpy.uint8), numpy.array(wall, numpy.float64), numpy.array(clock, numpy.int64),
+               numpy.array(peer, numpy.int64), numpy.array(qsize, numpy.int64), numpy.array(msg_clock, numpy.int64))
+
+
+def _counted(values):
+    # a Counter of the values of an array
+    unique, counts = numpy.unique(values, return_counts=True)
+    return Counter(dict(zip(unique.tolist(), counts.tolist())))
+
+
+def _column_stats(path, chunk=65536):
+    # the same statistics as _row_stats, a chunk of event_columns at a time
+    kinds = (RECV, SEND, SEND, INTERNAL) # by TRACE_EVENTS, a broadcast is a send
+    recv_code = TRACE_EVENTS.index("recv")
+    counts, jumps, queue_sizes, per_second = Counter(), Counter(), Counter(), {}
+    first = last = prev = None
+    for event, wall, clock, peer, qsize, msg_clock in event_columns(path, chunk):
+        for code, n in enumerate(numpy.bincount(event, minlength=len(kinds)).tolist()):
+            if n:
+                counts[kinds[code]] += n
+        recv = event == recv_code
+        unattributed = int(numpy.count_nonzero(recv & (peer == UNKNOWN)))
+        if unattributed:
+            counts["recv unattributed"] += unattributed
+        after = numpy.where(recv, numpy.maximum(clock, msg_clock), clock) + 1
+        jumps.update(_counted(numpy.diff(after, prepend=prev) if prev is not None else numpy.diff(after)))
+        queue_sizes.update(_counted(qsize[recv]))
+        # the last event of every second in the chunk, later chunks overwrite
+        seconds, at = numpy.unique(wall.astype(numpy.int64)[::-1], return_index=True)
+        per_second.update(zip(seconds.tolist(), after[len(after) - 1 - at].tolist()))
+        if first is None:
+            first = float(wall[0])
+        last, prev = float(wall[-1]), int(after[-1])
+    return counts, jumps, queue_sizes, per_second, first, last, prev
+
+
+def analyze_vm(path):
+    """
+    One streaming pass over the log of one VM, with numpy as columns a chunk at a time
+    """
+    index, rate, _ = LOG_NAME.search(path).groups()
+    counts, jumps, queue_sizes, per_second, first, last, prev = (_column_stats if numpy is not None else _row_stats)(path)
+    duration = (last - first) if first is not None else 0.0
+    final = prev or 0
+    return {
+        "vm": int(index),
+        "rate": int(rate),
+        "file": os.path.basename(path),
+        "events": dict(counts),
+        "final_clock": final,
+        "duration": duration,
+        # the README drift, (logical clock / clock rate - system time) / system time
+        "drift": (final / int(rate) - duration) / duration if duration else None,
+        "jumps": dict(sorted(jumps.items())),
+        "jump_percentiles": percentiles(jumps),
+        "queue_sizes": dict(sorted(queue_sizes.items())),
+        "queue_percentiles": percentiles(queue_sizes),
+        "per_second": per_second,
+    }
+
+
+def message_latency(sender_path, sender, receiver_path, receiver):
+    """
+    Latencies in milliseconds on the link sender -> receiver, from the send until the
+    receiver pulls the message off its queue, so queueing delay is included.
+    Links are FIFO and stamps of one sender only grow, so sends and receives are joined
+    by walking both logs once in step, holding one event of each at a time
+    """
+    sends = ((wall, clock) for kind, wall, clock, peer, _, _ in events(sender_path)
+             if kind == SEND and peer in (receiver, BROADCAST))
+    latency = Counter()
+    sent = next(sends, None) # the earliest send not matched yet
+    for kind, wall, _, peer, _, msg_clock in events(receiver_path):
+        if kind != RECV or peer != sender:
+            continue
+        # sends the receiver never logged, e.g. broadcasts without a sender, are skipped
+        while sent is not None and sent[1] < msg_clock:
+            sent = next(sends, None)
+        if sent is None:
+            break
+        if sent[1] == msg_clock:
+            latency[max(0, round((wall - sent[0]) * 1000))] += 1
+            sent = next(sends, None)
+    return latency
+
+
+def analyze_folder(folder):
+    """
+    Every statistic of one experiment folder
+    """
+    paths = {}
+    for path in sorted(glob.glob(os.path.join(folder, "VM*_cr*.*"))):
+        m = LOG_NAME.search(path)
+        # prefer the structured event log or trace of a VM to its text log
+        if m and (m.group(1) not in paths or paths[m.group(1)].endswith(".log")):
+            paths[m.group(1)] = path
+    vms = {int(index): analyze_vm(path) for index, path in paths.items()}
+
+    # clock differences between VMs at the same wall clock second
+    drift = {}
+    for a in sorted(vms):
+        for b in sorted(vms):
+            if a >= b:
+                continue
+            sa, sb = vms[a]["per_second"], vms[b]["per_second"]
+            common = sorted(set(sa) & set(sb))
+            if not common:
+                continue
+            diffs = [sa[t] - sb[t] for t in common]
+            drift["VM{}-VM{}".format(a, b)] = {
+                "seconds": len(common),
+                "mean": sum(diffs) / len(diffs),
+                "max_abs": max(abs(d) for d in diffs),
+                "final": diffs[-1],
+            }
+
+    latency = {}
+    for s in sorted(vms):
+        for r in sorted(vms):
+            if s != r:
+                counter = message_latency(paths[str(s)], s, paths[str(r)], r)
+                if counter:
+                    latency["VM{}->VM{}".format(s, r)] = {"messages": sum(counter.values()), "ms": percentiles(counter)}
+
+    for vm in vms.values():
+        del vm["per_second"]
+    return {"folder": folder, "vms": [vms[i] for i in sorted(vms)], "drift": drift, "latency": latency}
+
+
+def find_folders(roots):
+    """
+    The given folders, or their subfolders when they hold no logs themselves
+    """
+    folders = []
+    for root in roots:
+        if glob.glob(os.path.join(root, "VM*_cr*.*")):
+            folders.append(root)
+        else:
+            folders.extend(sorted(os.path.dirname(p) for p in glob.glob(os.path.join(root, "*", "VM*_cr*.*")) if LOG_NAME.search(p)))
+    return sorted(set(folders))
+
+
+def folder_drift(folder, every=1.0):
+    """
+    trace_drift of the binary traces in a folder
+    """
+    traces = [Trace(path) for path in sorted(glob.glob(os.path.join(folder, "VM*_cr*.trace")))]
+    try:
+        return dict(trace_drift(traces, every), folder=folder) if traces else None
+    finally:
+        for trace in traces:
+            trace.close()
+
+
+def report_drift(drift):
+    print("{} drift over {:.0f}s".format(drift["folder"], drift["seconds"]))
+    for vm, d in drift["vms"].items():
+        print("  VM{} drift final {} s max {} s".format(vm, *("n/a" if v is None else "{:.3f}".format(v) for v in (d["final"], d["max_abs"]))))
+    for pair, d in drift["pairs"].items():
+        print("  {} difference mean {:.3f} s max {:.3f} s final {:.3f} s".format(pair, d["mean"], d["max_abs"], d["final"]))
+
+
+def report(summary):
+    print(summary["folder"])
+    for vm in summary["vms"]:
+        print("  VM{} cr{} final clock {} over {:.1f}s, drift {}, events {}".format(
+            vm["vm"], vm["rate"], vm["final_clock"], vm["duration"],
+            "n/a" if vm["drift"] is None else "{:.5f}".format(vm["drift"]), vm["events"]))
+        print("      clock jumps p50/p90/p99 {}  queue size p50/p90/p99 {}  max queue {}".format(
+            "/".join(str(v) for v in vm["jump_percentiles"].values()),
+            "/".join(str(v) for v in vm["queue_percentiles"].values()),
+            max(vm["queue_sizes"], default=0)))
+    for pair, d in summary["drift"].items():
+        print("  {} clock difference mean {:.1f} max {} final {} over {}s".format(pair, d["mean"], d["max_abs"], d["final"], d["seconds"]))
+    for link, l in summary["latency"].items():
+        print("  {} latency ms p50/p90/p99 {} over {} messages".format(link, "/".join(str(v) for v in l["ms"].values()), l["messages"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyze logical clock experiment logs")
+    parser.add_argument("folders", nargs="*", default=["logs"])
+    parser.add_argument("--json", help="also write every statistic to this file")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="folders analyzed in parallel")
+    parser.add_argument("--drift", type=float, nargs="?", const=1.0, metavar="SECONDS", help="only the drift of binary traces, sampled this often")
+    args = parser.parse_args()
+
+    folders = find_folders(args.folders)
+    if not folders:
+        sys.exit("no VM*_cr*.log files under {}".format(" ".join(args.folders)))
+    if args.drift:
+        drifts = [drift for drift in (folder_drift(folder, args.drift) for folder in folders) if drift is not None]
+        for drift in drifts:
+            report_drift(drift)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(drifts, f, indent=1)
+        sys.exit(0 if drifts else "no VM*_cr*.trace files in {}".format(" ".join(folders)))
+    with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(folders)))) as pool:
+        summaries = list(pool.map(analyze_folder, folders))
+    for summary in summaries:
+        report(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summaries, f, indent=1)
@@ -0,0 +1,1004 @@
+"""
+Micro benchmarks for the logical clock VMs.
+Run all of them by
+    python3 bench.py
+or a single one by
+    python3 bench.py wire
+A quick suite of ticks/s, msgs/s and connect time against N is checked against a baseline
+saved on the same machine, and the run fails when any of them got worse than the threshold
+    python3 bench.py --check --save
+    python3 bench.py --check --threshold 0.25
+"""
+import sys
+import json
+import time
+import argparse
+import socket
+import asyncio
+import logging
+import tempfile
+import threading
+import tracemalloc
+import os
+import glob
+import queue
+import bisect
+from array import array
+
+from clock import encode_frame, FrameDecoder, Message, MSG_CLOCK, FRAME_HEADER
+from clock import VM, AsyncVM, run_vm, LOCAL_HOST, free_ports, mesh_topology, TickScheduler, MetricsServer, CausalOrder
+from clock import LamportClock, VectorClock, MatrixClock, HybridClock, hlc_time
+from clock import TRACE_MAGIC, TRACE_HEADER, TRACE_RECORD, TRACE_EVENTS
+from clock import Simulation, run_simulations
+from clock import TRANSPORTS, ShmTransport
+from clock import Impairment, DelayLine
+from multiprocessing import Process, Pipe, Queue as MpQueue
+import sweep
+import analyze
+
+
+def _pump(sock, chunks):
+    # send every chunk, then close so the reader sees end of stream
+    for chunk in chunks:
+        sock.sendall(chunk)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def bench_wire(n=200000):
+    """
+    Throughput of the old text format against the binary frame format over one loopback link.
+    The text reader mirrors the original listen: one recv(1024) is one message, so merged
+    sends are mis-parsed and updates are lost. The frame reader recovers every message.
+    """
+    results = {}
+
+    # old format: "VM0_cr4:17" per send, recv(1024).decode() and split per chunk
+    a, b = socket.socketpair()
+    chunks = [("VM0_cr4:" + str(i)).encode() for i in range(n)]
+    sender = threading.Thread(target=_pump, args=(a, chunks))
+    start = time.perf_counter()
+    sender.start()
+    parsed = 0
+    while True:
+        msg = b.recv(1024).decode()
+        if msg == "":
+            break
+        try:
+            int(msg.split(":")[-1])
+            parsed += 1
+        except ValueError:
+            pass
+    elapsed = time.perf_counter() - start
+    sender.join()
+    a.close()
+    b.close()
+    results["text"] = (parsed / elapsed, parsed)
+
+    # new format: length prefixed frames decoded in place
+    results["frame"] = _frame_rate(n)
+
+    for fmt, (rate, parsed) in results.items():
+        print("wire {:6s} {:10.0f} delivered msgs/s  {:7d}/{} messages recovered".format(fmt, rate, parsed, n))
+    return results
+
+
+def _frame_rate(n):
+    # msgs/s of clock frames sent one by one over a socket pair and decoded in place
+    a, b = socket.socketpair()
+    chunks = [encode_frame(0, i) for i in range(n)]
+    sender = threading.Thread(target=_pump, args=(a, chunks))
+    decoder = FrameDecoder()
+    start = time.perf_counter()
+    sender.start()
+    parsed = 0
+    while decoder.recv_into(b):
+        for msg in decoder.frames():
+            parsed += 1
+    elapsed = time.perf_counter() - start
+    sender.join()
+    a.close()
+    b.close()
+    return parsed / elapsed, parsed
+
+
+def _connect_mesh(n, folder):
+    # seconds until n threaded VMs behind a readiness barrier are linked in a full mesh
+    ports = free_ports(n)
+    vms = [VM(LOCAL_HOST, ports, folder, i, 1, topology=mesh_topology(n)) for i in range(n)]
+    ready = threading.Barrier(n)
+    threads = [threading.Thread(target=vm.connect, args=(ready,)) for vm in vms]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    for vm in vms:
+        vm.close_down()
+    return elapsed
+
+
+def bench_connect(sizes=(8, 16, 32, 64)):
+    """
+    Time to bring up a full mesh of N VMs, with threaded VMs behind a readiness barrier
+    and with AsyncVMs sharing one event loop. Every VM lives in this process.
+    """
+    logging.disable(logging.CRITICAL)
+    folder = tempfile.mkdtemp()
+    results = {}
+    for n in sizes:
+        results[("thread", n)] = _connect_mesh(n, folder)
+
+        ports = free_ports(n)
+        vms = [AsyncVM(LOCAL_HOST, ports, folder, i, 1, topology=mesh_topology(n)) for i in range(n)]
+
+        async def bring_up():
+            ready = asyncio.Barrier(n)
+            start = time.perf_counter()
+            await asyncio.gather(*[vm.connect(ready) for vm in vms])
+            elapsed = time.perf_counter() - start
+            for vm in vms:
+                await vm.close_down()
+            return elapsed
+
+        results[("async", n)] = asyncio.run(bring_up())
+
+    logging.disable(logging.NOTSET)
+    for (runtime, n), elapsed in results.items():
+        print("connect {:6s} N={:4d} {:6d} links {:8.3f} s".format(runtime, n, n * (n - 1) // 2, elapsed))
+    return results
+
+
+def bench_tick(rates=(1000, 10000, 100000), seconds=1.0):
+    """
+    Achieved tick rate of the original relative sleep loop against the absolute deadline
+    scheduler, with an empty round. The old loop can only fall behind, the scheduler
+    catches up and reports its jitter
+    """
+    results = {}
+    for rate in rates:
+        total = int(rate * seconds)
+
+        # original loop: sleep 1/tick minus this round's own time, clamped so it cannot raise
+        start = time.monotonic()
+        for i in range(total):
+            wake_up_this_round_time = time.time()
+            round_time = time.time() - wake_up_this_round_time
+            time.sleep(max(0, 1/rate - round_time))
+        elapsed = time.monotonic() - start
+        results[("relative", rate)] = (total / elapsed, None)
+
+        sched = TickScheduler(rate, total)
+        for _ in sched.ticks():
+            pass
+        stats = sched.stats()
+        results[("deadline", rate)] = (stats["achieved_rate"], stats["jitter_p99"])
+
+    for (loop, rate), (achieved, p99) in results.items():
+        jitter = "n/a" if p99 is None else "{:.6f} s".format(p99)
+        print("tick {:8s} target {:7d}/s achieved {:10.1f}/s ({:6.2%} short) jitter p99 {}".format(loop, rate, achieved, 1 - achieved / rate, jitter))
+    return results
+
+
+def bench_drain(ticks=60, inflow=11, modes=None):
+    """
+    Queue depth of a slow VM receiving inflow messages per tick, as a clock rate 1 VM next to
+    two clock rate 6 VMs can. Messages are enqueued directly, so this runs in virtual time
+    """
+    logging.disable(logging.CRITICAL)
+    folder = tempfile.mkdtemp()
+    modes = modes or {
+        "one per tick": {},
+        "batch 8": {"batch": 8},
+        "drain all": {"batch": 0},
+        "bounded 100": {"queue_size": 100, "queue_policy": "drop_oldest"},
+    }
+    results = {}
+    for mode, kwargs in modes.items():
+        vm = VM(LOCAL_HOST, [0, 0, 0], folder, 0, 1, **kwargs)
+        vm.need_to_listen = True
+        clock = 0
+        start = time.perf_counter()
+        for t in range(ticks):
+            for i in range(inflow):
+                clock += 1
+                vm.enqueue(Message(MSG_CLOCK, 1, clock, b""))
+            vm.step(0)
+        elapsed = time.perf_counter() - start
+        peak = max(row[1] for row in vm.depth_series)
+        results[mode] = (peak, vm.q.qsize(), vm.dropped, elapsed)
+    logging.disable(logging.NOTSET)
+    for mode, (peak, left, dropped, elapsed) in results.items():
+        print("drain {:14s} peak depth {:6d} left {:6d} dropped {:6d} in {:.4f} s".format(mode, peak, left, dropped, elapsed))
+    return results
+
+
+def _per_op(fn, budget=0.2):
+    # seconds per call of fn, repeated for about budget seconds
+    count = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > budget:
+            return elapsed / count
+
+
+def bench_clocks(sizes=(3, 64, 1024)):
+    """
+    Cost of increments and in place merges for vector and matrix clocks, and the
+    payload size of a full vector against a delta
+    """
+    results = {}
+    for n in sizes:
+        a, b = VectorClock(n, 0), VectorClock(n, 1, delta=False)
+        for j in range(n):
+            b.vector[j] = j
+        full = b.payload(0)
+        # a delta after three internal events, only the own entry changed
+        c = VectorClock(n, 1)
+        c.payload(0)
+        for _ in range(3):
+            c.internal()
+        delta = c.payload(0)
+        results[("vector increment", n)] = _per_op(a.internal)
+        results[("vector merge full", n)] = _per_op(lambda: a.merge(full))
+        results[("vector merge delta", n)] = _per_op(lambda: a.merge(delta))
+        print("clocks N={:5d} vector payload full {:6d} bytes, delta {:4d} bytes".format(n, len(full), len(delta)))
+
+        m, other = MatrixClock(n, 0), MatrixClock(n, 1)
+        other.internal()
+        rows = other.payload(0)
+        results[("matrix increment", n)] = _per_op(m.internal)
+        results[("matrix merge row", n)] = _per_op(lambda: m.merge(rows, 1))
+
+    for (op, n), seconds in results.items():
+        print("clocks N={:5d} {:20s} {:10.3f} us".format(n, op, seconds * 1e6))
+    return results
+
+
+def bench_logging(n=100000):
+    """
+    Internal events per second through the original synchronous file and console logger
+    against the queued text log, the JSON lines event log, the binary trace and disabled
+    event logging.
+    Console output goes to os.devnull. "hot" is what the tick loop pays, "total" includes
+    waiting for the background writer to flush
+    """
+    folder = tempfile.mkdtemp()
+    results = {}
+
+    # original path: string concatenation and a synchronous FileHandler plus StreamHandler
+    devnull = open(os.devnull, "w")
+    old = logging.getLogger("bench_old_logger")
+    formatter = logging.Formatter('%(asctime)s : %(message)s')
+    for handler in (logging.FileHandler(folder + "/old.log", mode='w'), logging.StreamHandler(devnull)):
+        handler.setFormatter(formatter)
+        old.addHandler(handler)
+    old.setLevel(logging.INFO)
+    name = "VM0_cr1"
+    start_time = time.time()
+    start = time.perf_counter()
+    for clock in range(n):
+        old.info(name +' Internal Event with logical clock '+ str(clock) + " at system time "+ str(time.time()-start_time)[0:5])
+    elapsed = time.perf_counter() - start
+    results["sync text"] = (n / elapsed, n / elapsed)
+    for handler in old.handlers[:]:
+        handler.close()
+        old.removeHandler(handler)
+
+    modes = {
+        "queued text": {"console": False},
+        "queued text+echo": {"console": True},
+        "json lines": {"log_format": "json"},
+        "binary trace": {"log_format": "binary"},
+        "disabled": {"log_level": logging.WARNING},
+    }
+    for mode, kwargs in modes.items():
+        vm = VM(LOCAL_HOST, [0, 0, 0], folder, 0, 1, **kwargs)
+        for handler in getattr(vm.logger, "listener").handlers:
+            if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler):
+                handler.setStream(devnull)
+        start = time.perf_counter()
+        for clock in range(n):
+            if vm.log_events:
+                vm.log_event(start_time, "internal", clock)
+        hot = time.perf_counter() - start
+        vm.close_logs()
+        total = time.perf_counter() - start
+        results[mode] = (n / hot, n / total)
+    devnull.close()
+
+    for mode, (hot, total) in results.items():
+        print("logging {:17s} hot {:12.0f} events/s  total {:12.0f} events/s".format(mode, hot, total))
+    return results
+
+
+def bench_simulate(configs=1000, workers=None):
+    """
+    60 second 3 VM experiments in virtual time, one alone, then a sweep of configs
+    over tick rates and seeds serially and in a process pool
+    """
+    start = time.perf_counter()
+    Simulation([1, 1, 6], total_time=60, seed=0).run()
+    single = time.perf_counter() - start
+
+    grid = [{"ticks": [(i % 6) + 1, ((i // 6) % 6) + 1, ((i // 36) % 6) + 1], "total_time": 60, "seed": i} for i in range(configs)]
+    start = time.perf_counter()
+    for config in grid[:100]:
+        Simulation(**config).run()
+    serial = (time.perf_counter() - start) / 100 * configs
+    start = time.perf_counter()
+    run_simulations(grid, workers)
+    pooled = time.perf_counter() - start
+
+    print("simulate one 60s experiment {:.4f} s".format(single))
+    print("simulate {} experiments serial {:.2f} s (estimated from 100), process pool {:.2f} s".format(configs, serial, pooled))
+    return single, serial, pooled
+
+
+def bench_sweep(experiments=8, seconds=2, jobs=None):
+    """
+    Wall time of a sweep of short real experiments one after another, like the original
+    single experiment __main__ without its fixed 70 second wait, and several at once
+    """
+    root = tempfile.mkdtemp()
+    configs = sweep.grid([[2, 3, 4]], durations=[seconds], repeat=experiments)
+    jobs = jobs or max(2, (os.cpu_count() or 1) // 3)
+    results = {}
+    for mode, n in (("serial", 1), ("parallel", jobs)):
+        start = time.perf_counter()
+        done = list(sweep.sweep(configs, os.path.join(root, mode), jobs=n))
+        results[mode] = (time.perf_counter() - start, sum(result["ok"] for result in done))
+    for mode, (elapsed, ok) in results.items():
+        print("sweep {:8s} {} experiments of {} s in {:7.2f} s, {} ok".format(mode, experiments, seconds, elapsed, ok))
+    return results
+
+
+def _link(transport, port):
+    # both ends of one link on a transport, the accepting end first
+    if not transport.selectable:
+        return transport.create(port, port + 1), transport.attach(port + 1, port)
+    listener = transport.bind(port, 1)
+    dialer = transport.make_socket()
+    dialer.connect(transport.address(port))
+    accepted, _ = listener.accept()
+    listener.close()
+    transport.release(port)
+    return accepted, dialer
+
+
+def _read(channel, decoder, poll):
+    # wait for more bytes like VM.listen does, False once the other end closed
+    while True:
+        try:
+            return decoder.recv_into(channel) > 0
+        except BlockingIOError:
+            time.sleep(poll)
+
+
+def _echo(channel, poll):
+    # send every frame straight back
+    decoder = FrameDecoder()
+    while _read(channel, decoder, poll):
+        for msg in decoder.frames():
+            channel.sendall(encode_frame(1, msg.clock))
+
+
+def _count(channel, poll, n):
+    # take n frames, then acknowledge them with one frame
+    decoder = FrameDecoder()
+    seen = 0
+    while seen < n and _read(channel, decoder, poll):
+        for msg in decoder.frames():
+            seen += 1
+    channel.sendall(encode_frame(1, seen))
+
+
+def bench_transport(n=20000, rounds=2000):
+    """
+    Per message round trip latency and one way throughput of a clock frame between two
+    processes, over loopback TCP, Unix domain sockets and shared memory rings. Like in a VM,
+    every frame is its own sendall. The shm reader sleeps its poll interval when the ring
+    is empty, "shm spin" only yields
+    """
+    results = {}
+    transports = [(name, TRANSPORTS[name]()) for name in ("tcp", "unix", "shm")] + [("shm spin", ShmTransport(poll=0))]
+    for name, transport in transports:
+        poll = getattr(transport, "poll", 0)
+        port = free_ports(1)[0]
+
+        near, far = _link(transport, port)
+        echo = Process(target=_echo, args=(far, poll))
+        echo.start()
+        decoder = FrameDecoder()
+        rtts = []
+        for i in range(rounds):
+            start = time.perf_counter()
+            near.sendall(encode_frame(0, i))
+            while not any(True for _ in decoder.frames()):
+                _read(near, decoder, poll)
+            rtts.append(time.perf_counter() - start)
+        near.shutdown(socket.SHUT_RDWR)
+        echo.join()
+        near.close()
+        far.close()
+        rtts.sort()
+
+        near, far = _link(transport, port)
+        counter = Process(target=_count, args=(far, poll, n))
+        counter.start()
+        start = time.perf_counter()
+        for i in range(n):
+            near.sendall(encode_frame(0, i))
+        decoder = FrameDecoder()
+        while not any(True for _ in decoder.frames()):
+            _read(near, decoder, poll)
+        elapsed = time.perf_counter() - start
+        counter.join()
+        near.close()
+        far.close()
+        results[name] = (rtts[len(rtts) // 2], rtts[int(len(rtts) * 0.99)], n / elapsed)
+
+    for name, (p50, p99, rate) in results.items():
+        print("transport {:8s} round trip p50 {:8.1f} us p99 {:8.1f} us  throughput {:10.0f} msgs/s".format(name, p50 * 1e6, p99 * 1e6, rate))
+    return results
+
+
+class _Sink():
+    # a peer channel that drops every frame
+    def sendall(self, data):
+        pass
+
+
+def _original_step(vm, start_time):
+    # VM.step before the hot loop rework: a randint per tick, a fresh frame per send,
+    # a fresh list per drain and a generator per receive, the queue depth read under its lock
+    depth = vm.q.qsize()
+    if depth > vm.depth_max:
+        vm.depth_max = depth
+    vm.steps += 1
+    if vm.steps % vm.tick == 0:
+        vm.depth_series.append((vm.steps // vm.tick, vm.depth_max, depth, vm.dropped))
+        vm.depth_max = 0
+    msgs = []
+    limit = vm.batch or -1
+    while len(msgs) != limit:
+        try:
+            msgs.append(vm.q.get_nowait())
+        except queue.Empty:
+            break
+    if msgs:
+        vm.engine.value = max(vm.engine.value, max(msg.clock for msg in msgs)) + 1
+        return
+    r_num = vm.rng.randint(1, vm.die)
+    if r_num <= 2 and vm.peer_order:
+        if len(vm.peer_order) <= 2:
+            peer = vm.peer_order[(r_num-1) % len(vm.peer_order)]
+        else:
+            peer = vm.rng.choice(vm.peer_order)
+        stamp = vm.engine.send()
+        vm.send(encode_frame(vm.index, stamp, vm.engine.payload(peer)), vm.peers[peer])
+    elif r_num == 3 and vm.peer_order:
+        stamp = vm.engine.send()
+        msg = encode_frame(vm.index, stamp)
+        for peer in vm.peer_order:
+            vm.send(msg, vm.peers[peer])
+    else:
+        vm.engine.internal()
+
+
+def _arrivals(server, results):
+    # the peer of one VM: time every frame as it is decoded, in another process so the
+    # reads do not wait for the GIL of the sender. perf_counter is the monotonic clock of
+    # the machine, so both processes read the same time
+    conn, _ = server.accept()
+    conn.recv(FRAME_HEADER.size, socket.MSG_WAITALL) # hello
+    decoder = FrameDecoder()
+    arrivals = {}
+    while decoder.recv_into(conn):
+        now = time.perf_counter()
+        for msg in decoder.frames():
+            arrivals[msg.clock] = now
+    results.send(arrivals)
+
+
+def bench_coalesce(rates=(1000, 20000), seconds=1.0, windows=(250, 1000)):
+    """
+    sendall calls per message and delivery latency, from the tick that sends a frame until
+    the peer decodes it, for a VM sending one frame every tick over loopback TCP: with
+    Nagle's algorithm, with TCP_NODELAY and a write per frame, and with TCP_NODELAY and
+    frames coalesced for up to a window of microseconds
+    """
+    logging.disable(logging.CRITICAL)
+    modes = [("nagle", False, None), ("nodelay", True, None)] + [("window {}us".format(w), True, w) for w in windows]
+    results = {}
+    for rate in rates:
+        for name, nodelay, coalesce in modes:
+            server = socket.create_server((LOCAL_HOST, 0))
+            receiving, results_end = Pipe()
+            proc = Process(target=_arrivals, args=(server, results_end))
+            proc.start()
+            # a three faced die sends on every tick, to the only peer
+            vm = VM(LOCAL_HOST, [0, server.getsockname()[1]], None, 0, rate, die=3, log_level=logging.WARNING,
+                    console=False, nodelay=nodelay, coalesce=coalesce)
+            vm.initiate_socket(timeout=5)
+            sent = {}
+            scheduler = TickScheduler(rate, int(rate * seconds))
+            for _ in scheduler.ticks():
+                # nothing is received, so every send stamps the clock as it is now
+                sent[vm.clock] = time.perf_counter()
+                vm.step(0)
+                vm.end_tick(scheduler.next_due())
+            vm.flush()
+            writes = vm.peer_info[1].channel.writes
+            vm.out_s.shutdown(socket.SHUT_WR)
+            arrivals = receiving.recv()
+            proc.join()
+            vm.out_s.close()
+            server.close()
+            latency = sorted(arrivals[clock] - t for clock, t in sent.items() if clock in arrivals)
+            results[(rate, name)] = (writes / len(sent), latency[len(latency) // 2], latency[int(len(latency) * 0.99)], len(latency) / len(sent))
+    logging.disable(logging.NOTSET)
+    for (rate, name), (per_msg, p50, p99, delivered) in results.items():
+        print("coalesce {:6d} ticks/s {:13s} {:6.3f} writes/msg  latency p50 {:9.1f} us p99 {:9.1f} us  delivered {:.0%}".format(
+            rate, name, per_msg, p50 * 1e6, p99 * 1e6, delivered))
+    return results
+
+
+def bench_hotloop(ticks=200000, traced=20000, inflow_every=3, peers=(2, 8)):
+    """
+    Ticks per second and memory allocated per tick by the tick loop with clock event logging
+    off and frames dropped by a sink, before the rework and now. A message arrives every
+    inflow_every ticks. "bytes/tick" is the mean tracemalloc peak within a tick above the
+    memory at its start, "kept/tick" what stays allocated
+    """
+    logging.disable(logging.CRITICAL)
+    msg = Message(MSG_CLOCK, 1, 5, b"")
+    results = {}
+    for n in peers:
+        for mode in ("original", "now"):
+            vm = VM(LOCAL_HOST, [0] * (n + 1), None, 0, 1000, seed=1, log_level=logging.WARNING, console=False)
+            vm.need_to_listen = True
+            for peer in range(1, n + 1):
+                vm.add_peer(peer, _Sink())
+            step = (lambda t: _original_step(vm, t)) if mode == "original" else vm.step
+
+            start = time.perf_counter()
+            for i in range(ticks):
+                if i % inflow_every == 0:
+                    vm.q.put_nowait(msg)
+                step(0)
+            rate = ticks / (time.perf_counter() - start)
+
+            tracemalloc.start()
+            peak = 0
+            first = tracemalloc.get_traced_memory()[0]
+            for i in range(traced):
+                if i % inflow_every == 0:
+                    vm.q.put_nowait(msg)
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                step(0)
+                peak += tracemalloc.get_traced_memory()[1] - before
+            kept = tracemalloc.get_traced_memory()[0] - first
+            tracemalloc.stop()
+            results[(mode, n)] = (rate, peak / traced, kept / traced)
+    logging.disable(logging.NOTSET)
+    for (mode, n), (rate, peak, kept) in results.items():
+        print("hotloop {:8s} {:2d} peers {:10.0f} ticks/s {:8.1f} bytes/tick {:6.2f} kept/tick".format(mode, n, rate, peak, kept))
+    return results
+
+
+def bench_metrics(ticks=100000, peers=2, inflow_every=3):
+    """
+    What the metrics registry costs: one histogram observe, a snapshot taken in process and
+    one requested over the control socket, and ticks per second of the tick loop with no
+    profiler, sampled and under cProfile
+    """
+    logging.disable(logging.CRITICAL)
+    vm = VM(LOCAL_HOST, [0] * (peers + 1), None, 0, 1000, seed=1, log_level=logging.WARNING, console=False)
+    vm.need_to_listen = True
+    for peer in range(1, peers + 1):
+        vm.add_peer(peer, _Sink())
+    msg = Message(MSG_CLOCK, 1, 5, b"")
+    costs = {"observe": _per_op(lambda: vm.m_depth.observe(3)), "snapshot": _per_op(vm.metrics.snapshot)}
+    server = MetricsServer(vm.metrics, port=0).start()
+
+    def request():
+        with socket.create_connection((LOCAL_HOST, server.port)) as conn:
+            conn.makefile().readline()
+    costs["control socket"] = _per_op(request)
+    server.stop()
+
+    rates = {}
+    for profile in (None, "sample", "cprofile"):
+        vm.profile = profile
+        vm.start_metrics()
+        start = time.perf_counter()
+        for i in range(ticks):
+            if i % inflow_every == 0:
+                vm.q.put_nowait(msg)
+            vm.step(0)
+        rates[profile or "no profiler"] = ticks / (time.perf_counter() - start)
+        vm.stop_metrics()
+    logging.disable(logging.NOTSET)
+    for op, seconds in costs.items():
+        print("metrics {:16s} {:10.3f} us".format(op, seconds * 1e6))
+    for profile, rate in rates.items():
+        print("metrics {:16s} {:10.0f} ticks/s".format(profile, rate))
+    return costs, rates
+
+
+class _RescanOrder(CausalOrder):
+    # the textbook hold-back buffer: one list, scanned again after every delivery
+    def deliver(self, msgs, now_ns):
+        ready, pending = self.ready, self.held.setdefault("all", [])
+        ready.clear()
+        for msg in msgs:
+            deps, msg = self.split(msg)
+            pending.append([array('Q', deps), 0, msg, now_ns])
+        progress = True
+        while progress:
+            progress = False
+            for entry in list(pending):
+                if self.blocked(entry) is None:
+                    self.deliv[entry[2].sender] += 1
+                    ready.append(entry[2])
+                    pending.remove(entry)
+                    progress = True
+        self.count_held = len(pending)
+        return ready
+
+
+def bench_causal(sizes=(10, 100, 1000, 10000), rescan_up_to=1000):
+    """
+    Cost per message of causal delivery with many messages held back. VM2 gets n messages
+    from VM1 that all depend on one message from VM0 still in flight, one arrival at a
+    time, then that message, which releases all of them. The hold-back buffer of
+    CausalOrder stays flat per message; a buffer rescanned after every delivery grows with n
+    """
+    results = {}
+    for n in sizes:
+        for name, order in (("causal", CausalOrder), ("rescan", _RescanOrder)):
+            if name == "rescan" and n > rescan_up_to:
+                continue
+            a, b, c = (order(3, i) for i in range(3))
+            first = Message(MSG_CLOCK, 0, 0, a.payload(2))
+            b.deliver([Message(MSG_CLOCK, 0, 0, a.payload(1))], 0)
+            later = [Message(MSG_CLOCK, 1, 0, b.payload(2)) for _ in range(n)]
+            start = time.perf_counter()
+            for msg in later:
+                c.deliver([msg], 0)
+            held = c.count_held
+            released = len(c.deliver([first], 0))
+            seconds = time.perf_counter() - start
+            assert held == n and released == n + 1
+            results[(name, n)] = seconds / (n + 1)
+            print("causal {:8s} {:6d} held {:10.2f} us/message".format(name, n, seconds / (n + 1) * 1e6))
+    return results
+
+
+def bench_ordered(sizes=(3, 8), rate=5000, seconds=2, acks=("tick", "message")):
+    """
+    Ordered broadcasts delivered per second and the delay from arrival to delivery in total
+    order, for a full mesh of VM processes over loopback TCP that broadcast on every third
+    tick and pull every queued message each tick. Acknowledging once per tick is compared
+    with one acknowledgement per message
+    """
+    results = {}
+    for n in sizes:
+        for ack in acks:
+            socks = sweep.listeners(n)
+            ports = [sock.getsockname()[1] for sock in socks]
+            summaries = MpQueue()
+            procs = [Process(target=run_vm, args=(LOCAL_HOST, ports, None, i, rate, False, None, mesh_topology(n), summaries),
+                             kwargs={"total_time": seconds, "die": 3, "batch": 0, "ordered": True, "ack": ack, "listener": socks[i],
+                                     "console": False, "log_level": logging.WARNING})
+                     for i in range(n)]
+            for proc in procs:
+                proc.start()
+            for sock in socks:
+                sock.close()
+            vms = [summaries.get() for _ in procs]
+            for proc in procs:
+                proc.join()
+            results[(n, ack)] = (min(vm["ordered"] for vm in vms) / seconds,
+                                 max(vm["order_delay_us"][0] for vm in vms), max(vm["order_delay_us"][1] for vm in vms),
+                                 sum(vm["order_pending"] for vm in vms))
+    for (n, ack), (per_second, p50, p99, pending) in results.items():
+        print("ordered {:3d} VMs ack per {:8s} {:8.0f} deliveries/s  delay p50 < {:6d} us p99 < {:6d} us  {} pending at the end".format(
+            n, ack, per_second, p50 + 1, p99 + 1, pending))
+    return results
+
+
+def _write_trace(path, vm, tick, events, rate, chunk=1 << 20):
+    # a trace of a VM that ran events internal events at rate per second, written a chunk
+    # of records at a time as 4 int64 words each: t, clock, msg clock and the small fields
+    small = TRACE_RECORD.pack(0, 0, -1, -1, -1, vm, TRACE_EVENTS.index("internal"))[24:]
+    with open(path, "wb") as f:
+        f.write(TRACE_HEADER.pack(TRACE_MAGIC, 1, vm, tick, 1000.0, 0, events))
+        words = array('q', bytes(32 * chunk))
+        words[2::4] = array('q', [-1]) * chunk
+        words[3::4] = array('q', small) * chunk
+        step = int(1e9 / rate)
+        for start in range(0, events, chunk):
+            n = min(chunk, events - start)
+            words[0:4 * n:4] = array('q', range(start * step, (start + n) * step, step))
+            words[1:4 * n:4] = array('q', range(start, start + n))
+            f.write(memoryview(words)[:4 * n])
+
+
+def bench_trace(events=100000000, vms=3, rate=100000):
+    """
+    A binary trace of events events over vms VMs, as one long run would leave, is mapped
+    and the clock drift of every second computed, against streaming every record.
+    The traces are written directly, the same records TraceLog writes
+    """
+    folder = tempfile.mkdtemp()
+    per_vm = events // vms
+    start = time.perf_counter()
+    for vm in range(vms):
+        # the VMs have clock rates a percent apart but all run events at rate, so they drift
+        tick = rate - rate // 100 * vm
+        _write_trace(os.path.join(folder, "VM{}_cr{}.trace".format(vm, tick)), vm, tick, per_vm, rate)
+    written = time.perf_counter() - start
+    results = {"write": written, "bytes/event": TRACE_RECORD.size}
+
+    start = time.perf_counter()
+    drift = analyze.folder_drift(folder)
+    results["drift"] = time.perf_counter() - start
+
+    # a full pass, over the first million records of one VM so it finishes
+    with analyze.Trace(os.path.join(folder, "VM0_cr{}.trace".format(rate))) as trace:
+        n = min(trace.count, 1000000)
+        start = time.perf_counter()
+        for _ in zip(range(n), trace.rows()):
+            pass
+        results["scan rows/s"] = n / (time.perf_counter() - start)
+        if trace.records is not None:
+            start = time.perf_counter()
+            trace.records["clock"].max()
+            results["numpy max clock"] = time.perf_counter() - start
+    for path in glob.glob(os.path.join(folder, "*.trace")):
+        os.remove(path)
+    os.rmdir(folder)
+    print("trace {} events of {} VMs, {} bytes each, written in {:.1f} s".format(events, vms, TRACE_RECORD.size, written))
+    print("trace drift over {:.0f} s of run in {:.3f} s, VM1 final {:.3f} s".format(drift["seconds"], results["drift"], drift["vms"][1]["final"]))
+    print("trace streaming {:.0f} records/s, all of them would take {:.0f} s".format(results["scan rows/s"], events / results["scan rows/s"]))
+    if "numpy max clock" in results:
+        print("trace numpy max clock of {} records in {:.2f} s".format(per_vm, results["numpy max clock"]))
+    return results
+
+
+def _tick_rate(ticks=50000, peers=2, inflow_every=3):
+    # ticks/s of the tick loop without logging, frames dropped by sinks
+    vm = VM(LOCAL_HOST, [0] * (peers + 1), None, 0, 1000, seed=1, log_level=logging.WARNING, console=False)
+    vm.need_to_listen = True
+    for peer in range(1, peers + 1):
+        vm.add_peer(peer, _Sink())
+    msg = Message(MSG_CLOCK, 1, 5, b"")
+    start = time.perf_counter()
+    for i in range(ticks):
+        if i % inflow_every == 0:
+            vm.q.put_nowait(msg)
+        vm.step(0)
+    return ticks / (time.perf_counter() - start)
+
+
+def regression_suite(sizes=(8, 16, 32), runs=3):
+    """
+    The measurements the regression check compares, each the best of runs so one disturbed
+    run does not fail it. Returns name -> (value, whether higher is better)
+    """
+    logging.disable(logging.CRITICAL)
+    folder = tempfile.mkdtemp()
+    results = {
+        "ticks/s": (max(_tick_rate() for _ in range(runs)), True),
+        "msgs/s": (max(_frame_rate(50000)[0] for _ in range(runs)), True),
+    }
+    for n in sizes:
+        results["connect N={} s".format(n)] = (min(_connect_mesh(n, folder) for _ in range(runs)), False)
+    logging.disable(logging.NOTSET)
+    return results
+
+
+def check(path, threshold=0.25, save=False):
+    """
+    Run the regression suite and compare it with the baseline at path. A measurement more
+    than threshold, a fraction of the baseline, worse than it is a regression. With save,
+    or without a baseline, the results become the baseline. Returns whether nothing regressed
+    """
+    results = regression_suite()
+    baseline = {}
+    if not save and os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)
+    regressed = []
+    for name, (value, higher) in results.items():
+        if name not in baseline:
+            print("check {:14s} {:12.4g}".format(name, value))
+            continue
+        change = value / baseline[name] - 1
+        worse = -change > threshold if higher else change > threshold
+        if worse:
+            regressed.append(name)
+        print("check {:14s} {:12.4g} baseline {:12.4g} {:+7.1%} {}".format(name, value, baseline[name], change, "REGRESSED" if worse else "ok"))
+    if save or not baseline:
+        with open(path, "w") as f:
+            json.dump({name: value for name, (value, _) in results.items()}, f, indent=1)
+        print("saved the baseline to {}".format(path))
+    if regressed:
+        print("{} regressed beyond {:.0%}: {}".format(len(regressed), threshold, ", ".join(regressed)))
+    return not regressed
+
+
+class _SortedDelays(DelayLine):
+    # the same delay line on a list kept sorted, every frame moves the ones due after it
+    def submit(self, impairment, link, data):
+        due = impairment.due(self.clock(), len(data))
+        if due is None:
+            return
+        with self.cond:
+            self.seq += 1
+            bisect.insort(self.heap, (due, self.seq, link, data))
+            if self.heap[0][1] == self.seq:
+                self.cond.notify()
+
+    def run(self):
+        heap = self.heap
+        while True:
+            with self.cond:
+                while self.running and (not heap or heap[0][0] > self.clock()):
+                    self.cond.wait(heap[0][0] - self.clock() if heap else None)
+                if not self.running:
+                    return
+                now = self.clock()
+                due = []
+                while heap and heap[0][0] <= now:
+                    due.append(heap.pop(0))
+            for _, _, link, data in due:
+                link.deliver(data)
+            self.sent += len(due)
+
+
+class _Counter():
+    # an impaired link that only counts what the delay line delivers
+    def __init__(self):
+        self.got = 0
+
+    def deliver(self, data):
+        self.got += 1
+
+
+def bench_impair(in_flight=(0, 1000, 100000), frames=20000, sorted_up_to=100000, delays=(0, 0.01, 0.1, 1.0), losses=(0.1, 0.3), sizes=(3, 8, 16)):
+    """
+    Cost per frame of the delay line with many frames in flight, and how clock drift and
+    queue growth scale with an impaired network. A frame due at once is submitted and
+    sent while in_flight frames due in an hour wait, on the heap and on a sorted list.
+    Then simulated minutes of 1, 1, 6 ticks/s with growing delay and loss, and meshes
+    of growing size at 50 ms, report the spread of the final clocks and the peak queue
+    """
+    results = {}
+    frame = encode_frame(0, 1)
+    for k in in_flight:
+        for name, line_type in (("heap", DelayLine), ("sorted", _SortedDelays)):
+            if name == "sorted" and k > sorted_up_to:
+                continue
+            line = line_type()
+            later, now = Impairment(delay=3600), Impairment()
+            for _ in range(k):
+                line.submit(later, None, frame)
+            counter = _Counter()
+            line.start()
+            start = time.perf_counter()
+            for _ in range(frames):
+                line.submit(now, counter, frame)
+            while counter.got < frames:
+                time.sleep(0.0005)
+            results[(name, k)] = (time.perf_counter() - start) / frames
+            line.stop()
+            print("impair {:6s} {:7d} in flight {:8.2f} us/frame".format(name, k, results[(name, k)] * 1e6))
+
+    configs = [("delay {:g} s".format(d), [1, 1, 6], {"delay": d}) for d in delays]
+    configs += [("loss {:.0%}".format(p), [1, 1, 6], {"delay": 0.01, "loss": p}) for p in losses]
+    configs += [("mesh {}".format(n), [1 + 5 * (i % 2) for i in range(n)], {"delay": 0.05}) for n in sizes]
+    for name, ticks, impair in configs:
+        topology = mesh_topology(len(ticks)) if name.startswith("mesh") else None
+        summary = Simulation(ticks, total_time=60, seed=1, topology=topology, impair=impair).run()
+        spread = max(summary["clocks"]) - min(summary["clocks"])
+        results[name] = (spread, max(summary["peak_queue"]), sum(summary["lost"]), summary["messages"])
+        print("impair {:12s} clocks {} apart, peak queue {:4d}, lost {:4d} of {:5d} messages".format(name, *results[name]))
+    return results
+
+
+def bench_hlc(ticks=([1, 6], [1, 1, 6]), seconds=60, skews=(0, 0.05)):
+    """
+    Cost of a hybrid clock update against a Lamport one, and how far apart the clocks of
+    VMs with different tick rates end up. Simulated runs of 1 against 6 ticks/s, as in
+    logs/tick_116_random_up_10, look up the clock of every VM at every second of the
+    trace. Lamport clocks of the same moment differ by the events the fast VM counted,
+    hybrid clocks by milliseconds whatever the rates. With the wall clock of VM0 skew
+    seconds ahead, the others follow it and lead is how far any clock ran ahead of time
+    """
+    results = {}
+    msg = Message(MSG_CLOCK, 1, 0, b"")
+    for name, engine in (("lamport", LamportClock(2, 0)), ("hlc", HybridClock(2, 0))):
+        results[(name, "internal")] = _per_op(engine.internal)
+        results[(name, "send")] = _per_op(engine.send)
+        results[(name, "receive")] = _per_op(lambda: engine.receive([msg]))
+        results[(name, "read")] = _per_op(lambda: engine.value)
+        print("hlc update {:8s} ".format(name) + " ".join("{} {:.3f} us".format(op, results[(name, op)] * 1e6) for op in ("internal", "send", "receive", "read")))
+
+    folder = tempfile.mkdtemp()
+    for rates in ticks:
+        for clock_type in ("lamport", "hlc"):
+            for skew in skews if clock_type == "hlc" else (0,):
+                out = os.path.join(folder, "{}_{}_{}".format("".join(map(str, rates)), clock_type, skew))
+                os.makedirs(out)
+                sim = Simulation(rates, total_time=seconds, seed=1, folder=out, log_format="binary", clock_type=clock_type, epoch=1000.0)
+                if skew:
+                    sim.vms[0].engine.wall = lambda: sim.vms[0].now() + skew
+                sim.run()
+                traces = [analyze.Trace(path) for path in sorted(glob.glob(os.path.join(out, "VM*_cr*.trace")))]
+                spread = 0
+                for k in range(1, seconds):
+                    clocks = []
+                    for trace in traces:
+                        i = trace.at(round((1000.0 + k) * 1e9))
+                        if i >= 0:
+                            _, clock, msg_clock = trace.record(i)[:3]
+                            # a lamport receive jumps past the message, a hybrid clock reads the time
+                            clocks.append(max(clock, msg_clock) + 1 if clock_type == "lamport" else clock)
+                    if clocks:
+                        spread = max(spread, max(clocks) - min(clocks))
+                if clock_type == "lamport":
+                    results[(clock_type, tuple(rates))] = spread
+                    print("hlc drift {:8s} {} ticks/s: clocks up to {} events apart".format(clock_type, rates, spread))
+                else:
+                    lead = max(hlc_time(clock) - (t + trace.offset) / 1e9 for trace in traces for t, clock, *_ in trace.rows())
+                    results[(clock_type, tuple(rates), skew)] = (hlc_time(spread) * 1000, lead * 1000)
+                    print("hlc drift {:8s} {} ticks/s skew {:g} ms: clocks up to {:.1f} ms apart, {:.1f} ms ahead of time".format(
+                        clock_type, rates, skew * 1000, *results[(clock_type, tuple(rates), skew)]))
+                for trace in traces:
+                    trace.close()
+    return results
+
+
+BENCHMARKS = {
+    "wire": bench_wire,
+    "connect": bench_connect,
+    "tick": bench_tick,
+    "drain": bench_drain,
+    "clocks": bench_clocks,
+    "logging": bench_logging,
+    "simulate": bench_simulate,
+    "sweep": bench_sweep,
+    "transport": bench_transport,
+    "hotloop": bench_hotloop,
+    "metrics": bench_metrics,
+    "coalesce": bench_coalesce,
+    "causal": bench_causal,
+    "ordered": bench_ordered,
+    "trace": bench_trace,
+    "impair": bench_impair,
+    "hlc": bench_hlc,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the logical clock VMs")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, all by default: " + " ".join(BENCHMARKS))
+    parser.add_argument("--check", action="store_true", help="run the regression suite against the baseline instead, fail on a regression")
+    parser.add_argument("--baseline", default="bench_baseline.json", help="baseline of this machine for --check")
+    parser.add_argument("--threshold", type=float, default=0.25, help="how much worse than the baseline is a regression, 0.25 is 25%%")
+    parser.add_argument("--save", action="store_true", help="with --check, save the results as the new baseline")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmarks {}".format(" ".join(unknown)))
+    if args.check:
+        sys.exit(0 if check(args.baseline, args.threshold, args.save) else 1)
+    for name in args.names or list(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -11,254 +11,3147 @@ import logging
 import os
 import queue
 import threading
-from multiprocessing import Process
+import struct
+import json
+import cProfile
+from array import array
+import asyncio
+import selectors
+import argparse
+import heapq
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from collections import namedtuple, deque
+from multiprocessing import Process, Barrier, shared_memory, resource_tracker
 
 VM_PORTS = [4096, 4097, 4098]
 LOCAL_HOST = '127.0.0.1'
 
+# Wire protocol. Every message on a socket is one length prefixed binary frame
+#   | length (4) | version (1) | kind (1) | sender (2) | clock (8) | payload (length - 12) |
+# length counts every byte after the length field itself, so a frame is 4 + length bytes.
+# The payload is optional and carries extra clock state (e.g. a vector) when present.
+WIRE_VERSION = 1
+MSG_CLOCK = 0 # a plain logical clock update
+MSG_HELLO = 1 # first frame on a new connection, sender is the dialing VM
+MSG_BYE = 2 # last frame of a VM that finished its run, the link is not dialed again
+MSG_ORDERED = 3 # a broadcast delivered in the same total order by every VM, see TotalOrder
+MSG_ACK = 4 # tells every peer the sender has seen all ordered messages pulled so far
+FRAME_HEADER = struct.Struct("!IBBHQ")
+FRAME_BODY_MIN = FRAME_HEADER.size - 4
+FRAME_CLOCK = struct.Struct("!Q") # the clock field alone, for restamping a built frame
+FRAME_CLOCK_AT = FRAME_HEADER.size - FRAME_CLOCK.size
+MAX_FRAME = 1 << 20
 
-def setup_logger(logger_name, log_file, level=logging.INFO):
+# what listening does when the internal queue of a VM is full
+QUEUE_POLICIES = ("block", "drop_oldest")
+
+# a decoded frame as it sits in the internal queue of a VM
+Message = namedtuple("Message", ["kind", "sender", "clock", "payload"])
+
+
+class Peer():
+    """
+    What the tick loop needs to reach one connected peer, worked out once when it connects
+    """
+    __slots__ = ("index", "channel", "name")
+
+    def __init__(self, index, channel):
+        self.index = index
+        self.channel = channel # socket, stream writer or transport channel that send() takes
+        self.name = "VM" + str(index)
+
+
+class Link():
+    """
+    Supervised sending end of the connection to one peer, what Peer.channel holds for a
+    thread VM. sendall never raises: while the link is down frames wait in a bounded
+    buffer, oldest dropped first, and go out in order once the listener hands over a new
+    socket in fresh. Only the tick loop sends and only the listener sets fresh, so the
+    hot path takes no lock. A batching link only adds frames to out, and flush() writes
+    all of them with one sendall.
+    Params:
+        peer: index of the peer
+        sock: connected socket or transport channel, None when the first dial failed
+        capacity: frames held while the link is down, None for every frame
+        on_lost: called with (peer, sock) when sending on sock fails
+        batching: hold frames in out until flush()
+    """
+    __slots__ = ("peer", "sock", "fresh", "pending", "dropped", "gone", "on_lost", "batching", "out", "writes")
+    FLUSH_BYTES = 1 << 16 # a batch this large is written without waiting for flush()
+
+    def __init__(self, peer, sock, capacity=1024, on_lost=None, batching=False):
+        self.peer = peer
+        self.sock = sock
+        self.fresh = None
+        self.pending = deque(maxlen=capacity) # frames, or batches of them, while down
+        self.dropped = 0 # frames pushed out of a full buffer, or sent after the peer left
+        self.gone = False # the peer said goodbye, nothing more goes out
+        self.on_lost = on_lost
+        self.batching = batching
+        self.out = bytearray() # frames of the current batch
+        self.writes = 0 # sendall calls on the socket
+
+    def sendall(self, data):
+        if self.fresh is not None:
+            self.resume()
+        if self.gone:
+            self.dropped += 1
+            return
+        if self.batching:
+            # a copy, frames are reused buffers
+            self.out += data
+            if len(self.out) >= self.FLUSH_BYTES:
+                self.flush()
+            return
+        self.write(data)
+
+    def flush(self):
+        if self.out:
+            if self.fresh is not None:
+                self.resume()
+            self.write(self.out)
+            self.out.clear()
+
+    def write(self, data):
+        sock = self.sock
+        if sock is None:
+            self.hold(data)
+            return
+        try:
+            sock.sendall(data)
+            self.writes += 1
+        except OSError:
+            # part of the frame may be gone, a new stream gets all of it again
+            self.hold(data)
+            self.fail(sock)
+
+    def hold(self, data):
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        # frames are reused buffers, see VM.frame()
+        self.pending.append(bytes(data))
+
+    def fail(self, sock):
+        self.sock = None
+        if self.on_lost is not None:
+            self.on_lost(self.peer, sock)
+
+    def resume(self):
+        """
+        Switch to the socket the listener handed over and flush the held frames
+        """
+        self.sock, self.fresh = self.fresh, None
+        pending = self.pending
+        while pending:
+            try:
+                self.sock.sendall(pending[0])
+                self.writes += 1
+            except OSError:
+                self.fail(self.sock)
+                return
+            pending.popleft()
+
+
+# Network impairment. Every VM of a run talks over loopback, where a frame arrives at once
+# and nothing is ever lost. An Impairment stands for the network on one link, like netem but
+# without root: it works out when each frame arrives, or that it never does, and the
+# DelayLine of the VM sends it then. A Simulation asks the same Impairment in virtual time.
+class Impairment():
+    """
+    What the network does to the frames on one link, with state of its own, so every link
+    gets its own Impairment.
+    Params:
+        delay: seconds every frame takes
+        jitter: seconds of spread around delay, how depends on distribution
+        distribution: "uniform" spreads delay evenly by up to jitter either way, "normal"
+            has jitter as its standard deviation, "pareto" never comes in under delay and
+            has a heavy tail jitter above it on average
+        loss: probability that a frame is lost
+        reorder: probability that a frame skips the delay and overtakes the frames in
+            flight, like netem. Otherwise frames keep their order, however they are delayed
+        bandwidth: bytes per second the link carries, frames queue behind each other, None
+            for no cap
+        seed: seed of the random generator, for repeatable impairments
+    """
+    DISTRIBUTIONS = ("uniform", "normal", "pareto")
+
+    def __init__(self, delay=0.0, jitter=0.0, distribution="uniform", loss=0.0, reorder=0.0, bandwidth=None, seed=None):
+        assert delay >= 0 and jitter >= 0
+        assert distribution in self.DISTRIBUTIONS, "unknown delay distribution {}".format(distribution)
+        assert 0 <= loss <= 1 and 0 <= reorder <= 1
+        assert bandwidth is None or bandwidth > 0
+        self.config = {"delay": delay, "jitter": jitter, "distribution": distribution, "loss": loss, "reorder": reorder, "bandwidth": bandwidth}
+        self.delay = delay
+        self.jitter = jitter
+        self.distribution = distribution
+        self.loss = loss
+        self.reorder = reorder
+        self.bandwidth = bandwidth
+        self.rng = random.Random(seed)
+        self.last = 0.0 # arrival of the latest frame kept in order
+        self.busy = 0.0 # the link is busy sending until then, under a bandwidth cap
+        self.lost = 0
+        self.reordered = 0
+
+    @property
+    def fifo(self):
+        # frames arrive once each and in order, what delta encoded clock payloads need
+        return not self.loss and not self.reorder
+
+    def sample(self):
+        """
+        One delay in seconds, never negative
+        """
+        if not self.jitter:
+            return self.delay
+        if self.distribution == "uniform":
+            delay = self.delay + self.rng.uniform(-self.jitter, self.jitter)
+        elif self.distribution == "normal":
+            delay = self.rng.gauss(self.delay, self.jitter)
+        else:
+            delay = self.delay + self.jitter * (self.rng.paretovariate(2) - 1)
+        return max(0.0, delay)
+
+    def due(self, now, size):
+        """
+        When a frame of size bytes sent at now arrives, or None when it is lost
+        """
+        if self.loss and self.rng.random() < self.loss:
+            self.lost += 1
+            return None
+        if self.bandwidth is not None:
+            # on the wire once the frames before it are, and for as long as its bytes take
+            now = self.busy = max(now, self.busy) + size / self.bandwidth
+        if self.reorder and self.rng.random() < self.reorder:
+            self.reordered += 1
+            return now
+        t = max(now + self.sample(), self.last)
+        self.last = t
+        return t
+
+
+def impairments(spec, peers, seed=None):
+    """
+    A fresh Impairment for every peer in peers that spec impairs. spec is an Impairment or
+    a dict of its arguments for every link, or a dict of peer index to either of those for
+    some of them, e.g. {"delay": 0.01} or {2: {"loss": 0.1}}. JSON keys may be strings.
+    Links get their own seeds drawn from seed
+    """
+    if spec is None:
+        return {}
+    rng = random.Random(seed)
+    if isinstance(spec, dict) and spec and all(str(key).isdigit() for key in spec):
+        per_peer = {int(key): value for key, value in spec.items()}
+    else:
+        per_peer = {peer: spec for peer in peers}
+    links = {}
+    for peer in peers:
+        config = per_peer.get(peer)
+        if config is None:
+            continue
+        config = dict(config.config if isinstance(config, Impairment) else config)
+        config.setdefault("seed", rng.getrandbits(64))
+        links[peer] = Impairment(**config)
+    return links
+
+
+class ImpairedLink(Link):
+    """
+    A Link behind an impaired network, frames reach the socket through the DelayLine
+    when their Impairment lets them arrive
+    """
+    __slots__ = ("impairment", "line")
+
+    def __init__(self, peer, sock, impairment, line, **kwargs):
+        super().__init__(peer, sock, **kwargs)
+        self.impairment = impairment
+        self.line = line
+
+    def sendall(self, data):
+        # a copy, frames are reused buffers
+        self.line.submit(self.impairment, self, bytes(data))
+
+    def deliver(self, data):
+        Link.sendall(self, data)
+
+
+class DelayLine():
+    """
+    The frames in flight on the impaired links of a VM. The tick loop submits them, and
+    one thread sends each when it is due. A heap keeps them by due time, so a frame costs
+    O(log n) however many are in flight, and the thread only wakes for the earliest
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.heap = []
+        self.seq = 0 # tie breaker, frames due at the same time go in submit order
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.sent = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def submit(self, impairment, link, data):
+        due = impairment.due(self.clock(), len(data))
+        if due is None:
+            return
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.heap, (due, self.seq, link, data))
+            # only a new earliest frame can be due before the thread wakes up anyway
+            if self.heap[0][1] == self.seq:
+                self.cond.notify()
+
+    def run(self):
+        heap = self.heap
+        while True:
+            with self.cond:
+                while self.running and (not heap or heap[0][0] > self.clock()):
+                    self.cond.wait(heap[0][0] - self.clock() if heap else None)
+                if not self.running:
+                    return
+                now = self.clock()
+                due = []
+                while heap and heap[0][0] <= now:
+                    due.append(heapq.heappop(heap))
+            # sockets are written outside the lock, the tick loop keeps submitting
+            for _, _, link, data in due:
+                link.deliver(data)
+            self.sent += len(due)
+
+    def stop(self):
+        """
+        Stop sending, frames still in flight stay in the heap and are never sent
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(sender, clock, payload=b"", kind=MSG_CLOCK):
+    """
+    Pack one message into a frame ready for socket.sendall
+    """
+    return FRAME_HEADER.pack(FRAME_BODY_MIN + len(payload), WIRE_VERSION, kind, sender, clock) + payload
+
+
+class FrameDecoder():
+    """
+    Streaming decoder for the frame protocol. Bytes from the socket land in one reusable
+    bytearray through recv_into, and frames() walks the buffer in place, so a single recv
+    holding many merged frames yields many messages without decoding strings.
+    """
+    def __init__(self, capacity=65536):
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.start = 0 # first unconsumed byte
+        self.end = 0 # one past the last received byte
+        self.need = FRAME_HEADER.size # bytes needed past start for the next frame
+
+    def _reserve(self, n):
+        """
+        Make sure there is room for n more bytes after end, compacting or growing the buffer
+        """
+        if len(self.buf) - self.end >= n:
+            return
+        pending = self.end - self.start
+        if self.start:
+            self.view[0:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        if len(self.buf) - self.end < n:
+            buf = bytearray(max(2 * len(self.buf), pending + n))
+            buf[0:pending] = self.view[0:pending]
+            self.view.release()
+            self.buf, self.view = buf, memoryview(buf)
+
+    def recv_into(self, sock):
+        """
+        Read whatever the socket has into the buffer. Returns the number of bytes read,
+        0 means the peer closed the connection
+        """
+        self._reserve(max(self.need - (self.end - self.start), 4096))
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        """
+        Append bytes that were read elsewhere
+        """
+        self._reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        """
+        Yield every complete Message currently in the buffer
+        """
+        header_size = FRAME_HEADER.size
+        while self.end - self.start >= header_size:
+            length, version, kind, sender, clock = FRAME_HEADER.unpack_from(self.buf, self.start)
+            if version != WIRE_VERSION:
+                raise ProtocolError("unsupported wire version {}".format(version))
+            if length < FRAME_BODY_MIN or length > MAX_FRAME:
+                raise ProtocolError("bad frame length {}".format(length))
+            frame_end = self.start + 4 + length
+            if frame_end > self.end:
+                self.need = 4 + length
+                return
+            payload = bytes(self.view[self.start + header_size:frame_end]) if length > FRAME_BODY_MIN else b""
+            self.start = frame_end
+            yield Message(kind, sender, clock, payload)
+        self.need = header_size
+        if self.start == self.end:
+            self.start = self.end = 0
+
+
+# Clock engines. Every engine keeps the scalar Lamport clock of the original VM in value,
+# which is what goes in the frame header and the logs. Vector and matrix engines add their
+# own state in the frame payload. VM.step calls internal() for an internal event, send()
+# once per send event and payload(peer) for each peer the message goes to, and receive()
+# with every message pulled off the queue in one tick.
+# Payload layout: | encoding (1) | pad (3) | count (4) | ... | in little endian, so a
+# received vector is merged straight out of the frame through a memoryview cast.
+VEC_FULL = 0 # count entries follow, one per VM
+VEC_DELTA = 1 # count uint32 indices, then their count uint64 values
+MAT_ROWS = 2 # count uint32 row indices, then count rows of n uint64 values
+CAUSAL_SENT = 3 # count uint32 indices into the n*n SENT matrix, then their count uint64 values
+VEC_HEADER = struct.Struct("<BxxxI")
+
+
+def _as_native(view, typecode):
+    """
+    A little endian slice of a payload as a sequence of typecode items
+    """
+    if sys.byteorder == "little":
+        return view.cast(typecode)
+    values = array(typecode, view.tobytes())
+    values.byteswap()
+    return values
+
+
+def _to_little(values):
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+class LamportClock():
+    """
+    The scalar Lamport clock. A message carries the clock value before the send event
+    counts, and a receive jumps to one past the largest clock seen
+    """
+    name = "lamport"
+
+    def __init__(self, n, index, delta=True):
+        self.n = n
+        self.index = index
+        self.value = 0
+
+    def internal(self):
+        self.value += 1
+
+    def send(self):
+        """
+        Count a send event, returns the scalar to stamp on the message
+        """
+        stamp = self.value
+        self.value += 1
+        return stamp
+
+    def payload(self, peer):
+        return b""
+
+    def forget(self, peer):
+        """
+        Frames to peer may get lost, the next payload carries the whole clock
+        """
+
+    def receive(self, msgs):
+        value = self.value
+        for msg in msgs:
+            if msg.clock > value:
+                value = msg.clock
+        self.value = value + 1
+
+
+class VectorClock(LamportClock):
+    """
+    Vector clock next to the Lamport scalar, vector[j] counts the events of VM j this VM
+    knows of. Entries live in one array('Q') and merges are an element wise max in place.
+    With delta on, a message to a peer carries only the entries that changed since the
+    last message to that peer (Singhal-Kshemkalyani), which relies on FIFO links. Frames
+    lost on a failing link are made up for by forget(), the VM sends whole clocks while
+    the link is down.
+    """
+    name = "vector"
+
+    def __init__(self, n, index, delta=True):
+        super().__init__(n, index)
+        self.delta = delta
+        self.vector = array('Q', bytes(8 * n))
+        self.updated = array('Q', bytes(8 * n)) # own entry when entry j last changed
+        self.last_sent = {} # own entry when a message last went to each peer
+
+    def _tick_own(self):
+        self.vector[self.index] += 1
+        self.updated[self.index] = self.vector[self.index]
+
+    def internal(self):
+        super().internal()
+        self._tick_own()
+
+    def send(self):
+        stamp = super().send()
+        self._tick_own()
+        return stamp
+
+    def forget(self, peer):
+        self.last_sent.pop(peer, None)
+
+    def payload(self, peer):
+        since = self.last_sent.get(peer, 0)
+        self.last_sent[peer] = self.vector[self.index]
+        if self.delta:
+            updated = self.updated
+            changed = array('I', [j for j in range(self.n) if updated[j] > since])
+            # a delta entry costs 12 bytes against 8 for a full one
+            if 3 * len(changed) < 2 * self.n:
+                return VEC_HEADER.pack(VEC_DELTA, len(changed)) + _to_little(changed) + _to_little(array('Q', [self.vector[j] for j in changed]))
+        return VEC_HEADER.pack(VEC_FULL, self.n) + _to_little(self.vector)
+
+    def merge(self, payload):
+        """
+        Element wise max of a received vector into own vector, in place
+        """
+        encoding, count = VEC_HEADER.unpack_from(payload)
+        view = memoryview(payload)[VEC_HEADER.size:]
+        vector, updated = self.vector, self.updated
+        stamp = vector[self.index] + 1 # own entry of the receive event doing this merge
+        if encoding == VEC_FULL:
+            other = _as_native(view[:8 * count], 'Q')
+            for j in range(count):
+                if other[j] > vector[j]:
+                    vector[j] = other[j]
+                    updated[j] = stamp
+        elif encoding == VEC_DELTA:
+            indices = _as_native(view[:4 * count], 'I')
+            values = _as_native(view[4 * count:12 * count], 'Q')
+            for k in range(count):
+                j = indices[k]
+                if values[k] > vector[j]:
+                    vector[j] = values[k]
+                    updated[j] = stamp
+        else:
+            raise ProtocolError("unexpected vector encoding {}".format(encoding))
+
+    def receive(self, msgs):
+        for msg in msgs:
+            if msg.payload:
+                self.merge(msg.payload)
+        super().receive(msgs)
+        self._tick_own()
+
+
+class MatrixClock(LamportClock):
+    """
+    Matrix clock next to the Lamport scalar. Row j is what this VM knows of the vector clock
+    of VM j and row index is its own vector clock. The smallest entry of column k is the
+    number of events of VM k that every VM has seen, so anything older can be garbage
+    collected. Storage is one flat array('Q') of n*n, deltas are sent per changed row.
+    """
+    name = "matrix"
+
+    def __init__(self, n, index, delta=True):
+        super().__init__(n, index)
+        self.delta = delta
+        self.matrix = array('Q', bytes(8 * n * n))
+        self.updated = array('Q', bytes(8 * n)) # own entry when row j last changed
+        self.last_sent = {}
+
+    @property
+    def vector(self):
+        return memoryview(self.matrix)[self.index * self.n:(self.index + 1) * self.n]
+
+    def row(self, j):
+        return memoryview(self.matrix)[j * self.n:(j + 1) * self.n]
+
+    def _tick_own(self):
+        own = self.index * self.n + self.index
+        self.matrix[own] += 1
+        self.updated[self.index] = self.matrix[own]
+
+    def internal(self):
+        super().internal()
+        self._tick_own()
+
+    def send(self):
+        stamp = super().send()
+        self._tick_own()
+        return stamp
+
+    def forget(self, peer):
+        self.last_sent.pop(peer, None)
+
+    def payload(self, peer):
+        n = self.n
+        since = self.last_sent.get(peer, 0)
+        self.last_sent[peer] = self.matrix[self.index * n + self.index]
+        if self.delta:
+            rows = array('I', [j for j in range(n) if self.updated[j] > since])
+        else:
+            rows = array('I', range(n))
+        values = array('Q')
+        for j in rows:
+            values.extend(self.row(j))
+        return VEC_HEADER.pack(MAT_ROWS, len(rows)) + _to_little(rows) + _to_little(values)
+
+    def merge(self, payload, sender):
+        """
+        Max every received row into own rows in place, then the row of the sender into own row
+        """
+        encoding, count = VEC_HEADER.unpack_from(payload)
+        if encoding != MAT_ROWS:
+            raise ProtocolError("unexpected matrix encoding {}".format(encoding))
+        n, matrix, updated = self.n, self.matrix, self.updated
+        stamp = matrix[self.index * n + self.index] + 1
+        view = memoryview(payload)[VEC_HEADER.size:]
+        rows = _as_native(view[:4 * count], 'I')
+        values = _as_native(view[4 * count:4 * count + 8 * n * count], 'Q')
+        for k in range(count):
+            base, offset = rows[k] * n, k * n
+            changed = False
+            for l in range(n):
+                if values[offset + l] > matrix[base + l]:
+                    matrix[base + l] = values[offset + l]
+                    changed = True
+            if changed:
+                updated[rows[k]] = stamp
+        own, theirs = self.index * n, sender * n
+        for l in range(n):
+            if matrix[theirs + l] > matrix[own + l]:
+                matrix[own + l] = matrix[theirs + l]
+
+    def receive(self, msgs):
+        for msg in msgs:
+            if msg.payload:
+                self.merge(msg.payload, msg.sender)
+        super().receive(msgs)
+        self._tick_own()
+
+    def min_known(self, k):
+        """
+        Events of VM k that every VM is known to have seen
+        """
+        return min(self.matrix[j * self.n + k] for j in range(self.n))
+
+
+HLC_COUNTER_BITS = 16 # low bits of a hybrid clock, the high 48 are wall clock milliseconds
+
+
+def hlc_from_time(seconds):
+    """
+    The smallest hybrid clock value at a wall clock time, so the events between two times
+    are those whose clocks lie between the two values
+    """
+    return int(seconds * 1000) << HLC_COUNTER_BITS
+
+
+def hlc_time(value):
+    """
+    Wall clock seconds of a hybrid clock value, its counter dropped
+    """
+    return (value >> HLC_COUNTER_BITS) / 1000
+
+
+def hlc_counter(value):
+    return value & ((1 << HLC_COUNTER_BITS) - 1)
+
+
+class HybridClock(LamportClock):
+    """
+    Hybrid logical clock (Kulkarni et al.), wall clock milliseconds in the high 48 bits
+    and a counter in the low 16 bits of one 64 bit integer. Packed like this, every update
+    is a single max: the next value is one past the largest clock seen, unless the wall
+    clock is further ahead. It never runs behind the wall clock and stays close to it, so
+    clocks of different VMs compare as approximate real times while still ordering every
+    send before its receive. A counter overflowing carries into the milliseconds. Reading
+    value gives the clock of now without counting an event, and a message carries the
+    clock of its send event itself.
+    """
+    name = "hlc"
+
+    def __init__(self, n, index, delta=True, wall=time.time):
+        super().__init__(n, index)
+        self.wall = wall # seconds, a VM hands in its own wall clock
+        self.last = 0 # clock of the last event
+
+    @property
+    def value(self):
+        return max(self.last, int(self.wall() * 1000) << HLC_COUNTER_BITS)
+
+    @value.setter
+    def value(self, value):
+        self.last = value
+
+    def internal(self):
+        self.last = max(self.last + 1, int(self.wall() * 1000) << HLC_COUNTER_BITS)
+
+    def send(self):
+        self.internal()
+        return self.last
+
+    def receive(self, msgs):
+        value = self.last
+        for msg in msgs:
+            if msg.clock > value:
+                value = msg.clock
+        self.last = max(value + 1, int(self.wall() * 1000) << HLC_COUNTER_BITS)
+
+
+CLOCKS = {engine.name: engine for engine in (LamportClock, VectorClock, MatrixClock, HybridClock)}
+
+
+class CausalOrder():
+    """
+    Causal delivery of point to point messages (Raynal, Schiper and Toueg). sent[k*n + l]
+    counts the messages from VM k to VM l this VM knows were sent. A message to VM j
+    carries the entries that changed since the last message to j, in front of the clock
+    payload, which relies on FIFO links like the vector deltas. A message from VM k is
+    delivered once, for every VM x, as many messages from x have been delivered here as k
+    knew x had sent to this VM. Until then it is held back.
+    The hold-back buffer is one queue per sender, and since links are FIFO only the oldest
+    message of a sender can be next. That message waits for one missing (x, count) at a
+    time, and delivering the count-th message from x wakes exactly the senders waiting
+    for it. So checking costs O(n) per message over its whole wait, never a rescan of
+    what is held.
+    Params:
+        n: number of VMs
+        index: this VM
+        metrics: a Metrics registry for the hold-back depth and delivery delay, optional
+    """
+
+    def __init__(self, n, index, metrics=None):
+        self.n = n
+        self.index = index
+        self.sent = array('Q', bytes(8 * n * n))
+        self.deliv = array('Q', bytes(8 * n)) # messages from each VM delivered here
+        self.columns = {} # sender -> column index of its sent matrix, rebuilt from its deltas
+        self.changes = [] # indices of sent in the order they changed
+        self.start = 0 # position of changes[0] among all changes ever made
+        self.cursor = {} # peer -> position in changes at the last message to it
+        self.held = {} # sender -> deque of [dependencies, next x to check, message, arrival ns]
+        self.waiting = {} # (x, count) -> senders whose oldest held message waits for it
+        self.count_held = 0
+        self.ready = [] # deliver() refills this list every call
+        metrics = metrics or Metrics(n)
+        self.depth = metrics.histogram("holdback_depth", "messages") # after every batch of arrivals
+        self.delay = metrics.histogram("delivery_delay", "us") # from arrival to delivery
+        metrics.gauge("held", lambda: self.count_held)
+
+    def _changed(self, e):
+        self.changes.append(e)
+        # the log since the slowest peer grew large, whoever is behind gets everything
+        if len(self.changes) > 4 * self.n * self.n + 1024:
+            self.start += len(self.changes)
+            self.changes.clear()
+
+    def payload(self, peer):
+        """
+        The causal part of a message to peer, then count the message as sent
+        """
+        n, sent = self.n, self.sent
+        since = self.cursor.get(peer, 0)
+        if since < self.start:
+            changed = [e for e in range(n * n) if sent[e]]
+        else:
+            changed = sorted(set(self.changes[since - self.start:]))
+        self.cursor[peer] = self.start + len(self.changes)
+        payload = VEC_HEADER.pack(CAUSAL_SENT, len(changed)) + _to_little(array('I', changed)) + _to_little(array('Q', [sent[e] for e in changed]))
+        e = self.index * n + peer
+        sent[e] += 1
+        self._changed(e)
+        return payload
+
+    def split(self, msg):
+        """
+        Merge the causal part of msg and return the column of this VM in the sent matrix
+        of its sender, and the message with only the clock payload left
+        """
+        encoding, count = VEC_HEADER.unpack_from(msg.payload)
+        if encoding != CAUSAL_SENT:
+            raise ProtocolError("unexpected causal encoding {}".format(encoding))
+        end = VEC_HEADER.size + 12 * count
+        view = memoryview(msg.payload)[VEC_HEADER.size:end]
+        indices = _as_native(view[:4 * count], 'I')
+        values = _as_native(view[4 * count:], 'Q')
+        n, sent = self.n, self.sent
+        column = self.columns.get(msg.sender)
+        if column is None:
+            column = self.columns[msg.sender] = array('Q', bytes(8 * n))
+        for k in range(count):
+            e, value = indices[k], values[k]
+            # every message counted was really sent, so knowing of it early is safe
+            if value > sent[e]:
+                sent[e] = value
+                self._changed(e)
+            if e % n == self.index:
+                column[e // n] = value
+        return column, msg._replace(payload=msg.payload[end:])
+
+    def blocked(self, entry):
+        """
+        The (x, count) the held entry waits for, None once it can be delivered
+        """
+        deps, deliv = entry[0], self.deliv
+        for x in range(entry[1], self.n):
+            if deliv[x] < deps[x]:
+                entry[1] = x
+                return x, deps[x]
+        return None
+
+    def deliver(self, msgs, now_ns):
+        """
+        Take the messages pulled off the queue and return, in causal order, those that can
+        be delivered now together with the held ones they unblocked. The list is reused
+        """
+        ready = self.ready
+        ready.clear()
+        for msg in msgs:
+            deps, msg = self.split(msg)
+            entry = [deps, 0, msg, now_ns]
+            queue = self.held.get(msg.sender)
+            if queue:
+                # an older message of the sender is held, so is this one
+                entry[0] = array('Q', deps)
+                queue.append(entry)
+                self.count_held += 1
+                continue
+            wait = self.blocked(entry)
+            if wait is None:
+                self.accept(entry, now_ns)
+                continue
+            entry[0] = array('Q', deps) # later deltas of the sender change the column
+            self.held[msg.sender] = deque([entry])
+            self.count_held += 1
+            self.waiting.setdefault(wait, []).append(msg.sender)
+        self.depth.observe(self.count_held)
+        return ready
+
+    def accept(self, entry, now_ns):
+        """
+        Deliver one message, then every held message that was waiting for it in turn
+        """
+        work = []
+        while True:
+            msg = entry[2]
+            k = msg.sender
+            count = self.deliv[k] + 1
+            self.deliv[k] = count
+            e = k * self.n + self.index
+            if count > self.sent[e]:
+                self.sent[e] = count
+                self._changed(e)
+            self.ready.append(msg)
+            self.delay.observe((now_ns - entry[3]) // 1000)
+            woken = self.waiting.pop((k, count), None)
+            if woken:
+                work.extend(woken)
+            queue = self.held.get(k)
+            if queue and queue[0] is entry:
+                queue.popleft()
+                self.count_held -= 1
+                if queue:
+                    work.append(k) # the next message of k was not waiting on anything yet
+                else:
+                    del self.held[k]
+            # the next held message that can go
+            entry = None
+            while work and entry is None:
+                sender = work.pop()
+                head = self.held[sender][0]
+                wait = self.blocked(head)
+                if wait is None:
+                    entry = head
+                else:
+                    self.waiting.setdefault(wait, []).append(sender)
+            if entry is None:
+                return
+
+
+class TotalOrder():
+    """
+    Totally ordered broadcast on Lamport clocks, as in Lamport's mutual exclusion. Every
+    ordered message waits in a heap keyed by (clock, sender), so all VMs agree on one
+    order, and the head is delivered once no VM can still send anything before it. Links
+    are FIFO and the stamps of a VM only grow, so that is once every other VM has sent a
+    frame stamped at least as high. Receivers acknowledge ordered messages to everyone so
+    this happens without waiting for their next broadcast. One acknowledgement stands for
+    everything received before it, so a VM acknowledges once per tick, not per message.
+    Params:
+        n: number of VMs, every one of them a peer of every other
+        index: this VM
+        metrics: a Metrics registry for the delivery counts and delay, optional
+        on_deliver: called with (clock, sender) of every message in delivery order
+    """
+
+    def __init__(self, n, index, metrics=None, on_deliver=None):
+        self.index = index
+        self.latest = [-1] * n # stamp of the last frame from each VM, of any kind
+        self.others = [k for k in range(n) if k != index]
+        self.floor = -1 # smallest latest of the others when last computed, only grows
+        self.pending = [] # heap of (clock, sender, arrival ns)
+        self.owed = 0 # ordered messages pulled since this VM last told everyone
+        self.on_deliver = on_deliver
+        metrics = metrics or Metrics(n)
+        self.delivered = metrics.counter("ordered") # delivered messages by sender
+        self.delay = metrics.histogram("order_delay", "us") # from arrival, or sending, to delivery
+        metrics.gauge("order_pending", lambda: len(self.pending))
+
+    def sent(self, clock, now_ns):
+        """
+        This VM broadcast an ordered message stamped clock, which also tells everyone it
+        saw every message pulled so far
+        """
+        heapq.heappush(self.pending, (clock, self.index, now_ns))
+        self.owed = 0
+
+    def receive(self, msgs, now_ns):
+        for msg in msgs:
+            self.latest[msg.sender] = msg.clock
+            if msg.kind == MSG_ORDERED:
+                heapq.heappush(self.pending, (msg.clock, msg.sender, now_ns))
+                self.owed += 1
+
+    def deliver(self, now_ns):
+        """
+        Deliver every pending message no VM can still precede, returns how many
+        """
+        pending, delivered = self.pending, 0
+        while pending:
+            clock = pending[0][0]
+            # the sender of the head sent it, so only the others can hold it back
+            if clock > self.floor:
+                self.floor = min(self.latest[k] for k in self.others) if self.others else clock
+                if clock > self.floor:
+                    break
+            clock, sender, arrived = heapq.heappop(pending)
+            self.delivered[sender] += 1
+            self.delay.observe((now_ns - arrived) // 1000)
+            if self.on_deliver is not None:
+                self.on_deliver(clock, sender)
+            delivered += 1
+        return delivered
+
+
+class TickScheduler():
+    """
+    Absolute deadline tick schedule. Tick k is due at start + k/tick on time.monotonic, so
+    sleeping never accumulates error from one round to the next. When the loop falls at
+    least one whole tick behind, the overrun policy decides what happens to the late ticks:
+        catchup: run them back to back until the schedule is met again
+        skip: drop them and resume at the next deadline still in the future
+        coalesce: run a single tick in place of all of them
+    Dropped ticks are counted in missed, and the lateness of every tick that runs is kept
+    in a log2 histogram of microseconds for jitter reporting.
+    """
+    POLICIES = ("catchup", "skip", "coalesce")
+
+    def __init__(self, tick, total_ticks, policy="catchup", clock=time.monotonic, sleep=time.sleep):
+        assert tick > 0
+        assert policy in self.POLICIES, "unknown overrun policy {}".format(policy)
+        self.tick = tick
+        self.period = 1 / tick
+        self.total_ticks = total_ticks
+        self.policy = policy
+        self.clock = clock
+        self.sleep = sleep
+        self.start_time = None
+        self.k = 0 # index of the next due tick
+        self.ran = 0 # ticks actually run
+        self.missed = 0 # ticks dropped by skip or coalesce
+        self.overruns = 0 # times a due tick was found a whole tick or more late
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+        self.jitter_hist = [0] * 32 # bucket b counts lateness below 2**b microseconds
+        self.late_us = 0 # lateness of the tick that ran last
+
+    def start(self):
+        self.start_time = self.clock()
+        self.k = 0
+
+    def delay(self):
+        """
+        Seconds to wait before the next tick is due, 0 when it is already due, None once
+        every tick is done. Applies the overrun policy first
+        """
+        if self.start_time is None:
+            self.start()
+        if self.k >= self.total_ticks:
+            return None
+        now = self.clock()
+        deadline = self.start_time + self.k * self.period
+        behind = int((now - deadline) // self.period) # whole ticks the loop is behind
+        if behind >= 1:
+            self.overruns += 1
+            if self.policy == "skip":
+                late = min(behind + 1, self.total_ticks - self.k)
+                self.missed += late
+                self.k += late
+                if self.k >= self.total_ticks:
+                    return None
+                deadline = self.start_time + self.k * self.period
+            elif self.policy == "coalesce":
+                late = min(behind, self.total_ticks - self.k - 1)
+                self.missed += late
+                self.k += late
+                return 0
+        return max(0.0, deadline - now)
+
+    def next_due(self):
+        """
+        Monotonic time the next tick is due
+        """
+        return self.start_time + self.k * self.period
+
+    def fire(self):
+        """
+        Record that the due tick runs now
+        """
+        late = max(0.0, self.clock() - (self.start_time + self.k * self.period))
+        self.jitter_sum += late
+        self.jitter_max = max(self.jitter_max, late)
+        self.late_us = int(late * 1e6)
+        self.jitter_hist[min(self.late_us.bit_length(), 31)] += 1
+        self.k += 1
+        self.ran += 1
+
+    def ticks(self):
+        """
+        Blocking generator over the schedule, yields once per tick that runs
+        """
+        while True:
+            delay = self.delay()
+            if delay is None:
+                return
+            if delay > 0:
+                self.sleep(delay)
+            self.fire()
+            yield self.k - 1
+
+    def jitter_percentile(self, p):
+        """
+        Upper bound in seconds of the p-th percentile of tick lateness
+        """
+        target = p / 100 * self.ran
+        seen = 0
+        for b, count in enumerate(self.jitter_hist):
+            seen += count
+            if count and seen >= target:
+                return (1 << b) / 1e6
+        return 0.0
+
+    def stats(self):
+        elapsed = max(self.clock() - self.start_time, 1e-9) if self.start_time is not None else 0.0
+        achieved = self.ran / elapsed if elapsed else 0.0
+        return {
+            "tick": self.tick,
+            "ticks": self.ran,
+            "missed": self.missed,
+            "overruns": self.overruns,
+            "achieved_rate": achieved,
+            "shortfall": 1 - achieved / self.tick if elapsed else 0.0,
+            "jitter_mean": self.jitter_sum / self.ran if self.ran else 0.0,
+            "jitter_p99": self.jitter_percentile(99),
+            "jitter_max": self.jitter_max,
+        }
+
+
+class Histogram():
+    """
+    log2 histogram of non negative integers, bucket b counts values below 2**b like the
+    jitter histogram of TickScheduler, plus count, sum and max. unit names what is counted
+    """
+    __slots__ = ("unit", "counts", "count", "total", "max")
+
+    def __init__(self, unit=""):
+        self.unit = unit
+        self.counts = [0] * 65
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[value.bit_length()] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Upper bound of the p-th percentile, in unit
+        """
+        target = p / 100 * self.count
+        seen = 0
+        for b, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return (1 << b) - 1
+        return 0
+
+    def snapshot(self):
+        return {
+            "unit": self.unit,
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+            # upper bound of every bucket that counted anything
+            "buckets": {(1 << b) - 1: count for b, count in enumerate(self.counts) if count},
+        }
+
+
+class Metrics():
+    """
+    Registry of the counters, histograms and gauges of one VM, cheap enough to stay on
+    while clock event logging is off.
+    Every metric has one writer, the tick loop or the listener, so updates take no lock:
+    a counter is a list with one slot per VM, a histogram a Histogram, and a gauge a
+    function only called when a snapshot is taken. A snapshot read from another thread
+    may be a tick behind, which is all a dashboard needs.
+    Params:
+        n: number of VMs, the slots of every counter
+        names: presentable name of every VM, for the snapshot
+    """
+
+    def __init__(self, n, names=None):
+        self.names = names or ["VM" + str(j) for j in range(n)]
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.samples = None # a Sampler, when the tick loop is sampled
+        self.started = time.time()
+
+    def counter(self, name):
+        self.counters[name] = [0] * len(self.names)
+        return self.counters[name]
+
+    def histogram(self, name, unit=""):
+        self.histograms[name] = Histogram(unit)
+        return self.histograms[name]
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def snapshot(self):
+        """
+        Every metric as plain JSON types, counters by VM name with their total
+        """
+        counters = {}
+        for name, slots in self.counters.items():
+            counts = {self.names[j]: count for j, count in enumerate(slots) if count}
+            counts["total"] = sum(slots)
+            counters[name] = counts
+        snapshot = {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "counters": counters,
+            "gauges": {name: read() for name, read in self.gauges.items()},
+            "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+        }
+        if self.samples is not None:
+            snapshot["samples"] = self.samples.top()
+        return snapshot
+
+
+class MetricsServer():
+    """
+    Publish snapshots of a Metrics registry while a VM runs, from one daemon thread.
+    Every interval seconds a snapshot replaces the JSON file at path, and every connection
+    to the control socket on host:port gets one snapshot as a JSON line and is closed, e.g.
+        nc 127.0.0.1 <port>
+    Port 0 picks a free one, see self.port. Either of path and port may be None
+    """
+
+    def __init__(self, metrics, path=None, host=LOCAL_HOST, port=None, interval=1.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.control = None
+        if port is not None:
+            self.control = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.control.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.control.bind((host, port))
+            self.control.listen(5)
+            port = self.control.getsockname()[1]
+        self.port = port
+        self.wake_r, self.wake_w = socket.socketpair() # stop() wakes the thread with a byte
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def serve(self):
+        sel = selectors.DefaultSelector()
+        sel.register(self.wake_r, selectors.EVENT_READ)
+        if self.control is not None:
+            sel.register(self.control, selectors.EVENT_READ)
+        next_dump = time.monotonic() + self.interval
+        while self.running:
+            timeout = max(0.0, next_dump - time.monotonic()) if self.path else None
+            for key, _ in sel.select(timeout):
+                if key.fileobj is self.control:
+                    conn, _ = self.control.accept()
+                    try:
+                        conn.sendall((json.dumps(self.metrics.snapshot()) + "\n").encode())
+                    except OSError:
+                        pass
+                    conn.close()
+            if self.path and time.monotonic() >= next_dump:
+                self.dump()
+                next_dump += self.interval
+        sel.close()
+
+    def dump(self):
+        # readers never see half a file
+        partial = self.path + ".tmp"
+        with open(partial, "w") as f:
+            json.dump(self.metrics.snapshot(), f)
+        os.replace(partial, self.path)
+
+    def stop(self):
+        """
+        Stop serving and write the last snapshot, safe to call more than once
+        """
+        if self.thread is not None:
+            self.running = False
+            self.wake_w.send(b"x")
+            self.thread.join()
+            self.thread = None
+            if self.path:
+                self.dump()
+        for sock in (self.control, self.wake_r, self.wake_w):
+            if sock is not None:
+                sock.close()
+
+
+class Sampler():
+    """
+    Statistical profile of one thread: every interval seconds a daemon thread looks at the
+    frame the thread is running and counts it by function and line. Much cheaper than
+    cProfile for a whole run, but only sees the thread where it holds the GIL. Shares are
+    of wall time, so a loop that mostly sleeps has its sleep on top
+    """
+
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {} # (file, line, function) -> samples
+        self.total = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                code = frame.f_code
+                where = (code.co_filename, frame.f_lineno, code.co_name)
+                self.counts[where] = self.counts.get(where, 0) + 1
+                self.total += 1
+            del frame
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def top(self, k=20):
+        """
+        The k most sampled lines with their share of all samples
+        """
+        # a copy, the sampling thread keeps adding lines
+        counts = sorted(list(self.counts.items()), key=lambda item: -item[1])[:k]
+        return [{"where": "{}:{} {}".format(os.path.basename(f), line, name), "share": count / self.total}
+                for (f, line, name), count in counts]
+
+
+def setup_logger(logger_name, log_file, level=logging.INFO, console=True):
+    """
+    The caller only puts records on a queue, a QueueListener thread formats them and
+    writes them to the file, and to the console when console is on. With no log_file
+    and no console the logger discards everything
+    """
     l = logging.getLogger(logger_name)
+    close_logger(l) # a logger of the same name from an earlier VM
+    l.propagate = False
     formatter = logging.Formatter('%(asctime)s : %(message)s')
-    fileHandler = logging.FileHandler(log_file, mode='w')
-    fileHandler.setFormatter(formatter)
+    handlers = []
+    if log_file is not None:
+        fileHandler = logging.FileHandler(log_file, mode='w')
+        fileHandler.setFormatter(formatter)
+        handlers.append(fileHandler)
 
-    streamHandler = logging.StreamHandler()
-    streamHandler.setFormatter(formatter)
+    if console:
+        streamHandler = logging.StreamHandler()
+        streamHandler.setFormatter(formatter)
+        handlers.append(streamHandler)
 
     l.setLevel(level)
-    l.addHandler(fileHandler)
-    l.addHandler(streamHandler)
+    if not handlers:
+        l.addHandler(logging.NullHandler())
+        return l
+    records = queue.SimpleQueue()
+    l.listener = QueueListener(records, *handlers)
+    l.listener.start()
+    l.addHandler(QueueHandler(records))
     return l
 
+
+def close_logger(l):
+    """
+    Flush everything still queued for a logger from setup_logger and close its file
+    """
+    listener = getattr(l, "listener", None)
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        l.listener = None
+    for handler in l.handlers[:]:
+        l.removeHandler(handler)
+
+
+# one JSON object per line, the fields of EventLog.record in order
+EVENT_JSON = '{{"event":"{}","vm":{},"clock":{},"peer":{},"queue":{},"msg_clock":{},"t":{}}}\n'
+
+
+class EventLog():
+    """
+    JSON lines event log. record() only puts a tuple on a queue, a background thread
+    formats events and writes them to the file in batches. The first line holds the wall
+    clock time matching the monotonic timestamps, so runs of different VMs line up.
+    """
+    def __init__(self, path, name, index, tick, batch=4096, clock_ns=time.monotonic_ns, wall=None):
+        self.batch = batch
+        self.clock_ns = clock_ns
+        self.q = queue.SimpleQueue()
+        self.file = open(path, "w")
+        self.file.write('{{"event":"start","vm":{},"name":"{}","tick":{},"wall":{},"t":{}}}\n'.format(index, name, tick, time.time() if wall is None else wall, clock_ns()))
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def record(self, event, vm, clock, peer=-1, qsize=-1, msg_clock=-1):
+        self.q.put((event, vm, clock, peer, qsize, msg_clock, self.clock_ns()))
+
+    def _write(self):
+        fmt = EVENT_JSON.format
+        while True:
+            events = [self.q.get()]
+            while len(events) < self.batch:
+                try:
+                    events.append(self.q.get_nowait())
+                except queue.Empty:
+                    break
+            done = events[-1] is None
+            if done:
+                events.pop()
+            self.file.write("".join([fmt(*event) for event in events]))
+            if done:
+                break
+        self.file.close()
+
+    def close(self):
+        self.q.put(None)
+        self.thread.join()
+
+
+# Binary trace, a 64 byte header then one fixed width little endian record per clock event,
+# so a reader maps the file and indexes it like an array. count in the header is rewritten
+# after every batch, so a trace cut short by a crash reads up to its last batch
+TRACE_MAGIC = b"LCTRACE1"
+TRACE_HEADER = struct.Struct("<8sHHIdqQ24x") # magic, version, vm, tick, wall, t0 ns, count
+TRACE_COUNT_AT = 32
+TRACE_RECORD = struct.Struct("<qQqihBB") # t ns, clock, msg clock, queue, peer, vm, event
+TRACE_EVENTS = ("recv", "send", "broadcast", "internal") # event codes are positions here
+
+
+class TraceLog(EventLog):
+    """
+    EventLog writing the binary trace. The file grows by chunk records at a time, space the
+    OS reserves up front where it can, and is cut to its records when closed
+    """
+    def __init__(self, path, name, index, tick, batch=4096, clock_ns=time.monotonic_ns, wall=None, chunk=1 << 20):
+        self.batch = batch
+        self.clock_ns = clock_ns
+        self.chunk = chunk
+        self.codes = {event: code for code, event in enumerate(TRACE_EVENTS)}
+        self.q = queue.SimpleQueue()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.count = 0
+        self.capacity = 0
+        self.reserve()
+        os.pwrite(self.fd, TRACE_HEADER.pack(TRACE_MAGIC, 1, index, tick, time.time() if wall is None else wall, clock_ns(), 0), 0)
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def reserve(self):
+        self.capacity += self.chunk
+        size = TRACE_HEADER.size + self.capacity * TRACE_RECORD.size
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(self.fd, 0, size)
+        else:
+            os.ftruncate(self.fd, size)
+
+    def _write(self):
+        pack_into, size, codes = TRACE_RECORD.pack_into, TRACE_RECORD.size, self.codes
+        buf = bytearray(self.batch * size)
+        while True:
+            events = [self.q.get()]
+            while len(events) < self.batch:
+                try:
+                    events.append(self.q.get_nowait())
+                except queue.Empty:
+                    break
+            done = events[-1] is None
+            if done:
+                events.pop()
+            for i, (event, vm, clock, peer, qsize, msg_clock, t) in enumerate(events):
+                pack_into(buf, i * size, t, clock, msg_clock, qsize, peer, vm, codes[event])
+            while self.count + len(events) > self.capacity:
+                self.reserve()
+            os.pwrite(self.fd, memoryview(buf)[:len(events) * size], TRACE_HEADER.size + self.count * size)
+            self.count += len(events)
+            os.pwrite(self.fd, struct.pack("<Q", self.count), TRACE_COUNT_AT)
+            if done:
+                break
+        os.ftruncate(self.fd, TRACE_HEADER.size + self.count * size)
+        os.close(self.fd)
+
+# Topologies. A topology maps each VM index to the list of VM indices it dials, every
+# other link of that VM is accepted on its single listening socket. Who dials whom is
+# fixed, so both ends agree on the peer ids without any negotiation.
+def ring_topology(n):
+    """
+    P1 --> P2 --> ... --> Pn --> P1, each VM dials the next one
+    """
+    if n == 2:
+        return {0: [1], 1: []}
+    return {i: [(i+1) % n] for i in range(n)} if n > 1 else {0: []}
+
+
+def mesh_topology(n):
+    """
+    Full mesh, every VM dials all VMs with a larger index
+    """
+    return {i: list(range(i+1, n)) for i in range(n)}
+
+
+def graph_topology(n, edges):
+    """
+    Arbitrary undirected graph given as (i, j) pairs, the smaller index dials
+    """
+    topology = {i: [] for i in range(n)}
+    for i, j in set((min(e), max(e)) for e in edges if e[0] != e[1]):
+        topology[i].append(j)
+    return topology
+
+
+def free_ports(n, host=LOCAL_HOST):
+    """
+    Ask the OS for n currently unused ports by binding to port 0
+    """
+    socks = []
+    for _ in range(n):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind((host, 0))
+        socks.append(s)
+    ports = [s.getsockname()[1] for s in socks]
+    for s in socks:
+        s.close()
+    return ports
+
+
+# Transports. Every VM runs on this machine, so besides loopback TCP they can talk over
+# Unix domain sockets or over rings in shared memory. A transport gives VM one channel per
+# peer with the socket methods VM uses: sendall in send, recv_into, shutdown and close in
+# listen and close_down, so the tick logic is the same on every transport. Entries of the
+# ports list stay the VM ids that name the sockets and rings.
+class TcpTransport():
+    """
+    Loopback TCP, the original transport
+    """
+    name = "tcp"
+    family = socket.AF_INET
+    selectable = True # channels are file descriptors a selector can wait on
+
+    def address(self, port, host=LOCAL_HOST):
+        return (host, port)
+
+    def make_socket(self):
+        return socket.socket(self.family, socket.SOCK_STREAM)
+
+    def bind(self, port, backlog, host=LOCAL_HOST):
+        """
+        The listening socket of the VM with this port
+        """
+        s = self.make_socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(self.address(port, host))
+        s.listen(backlog)
+        return s
+
+    def release(self, port):
+        pass
+
+    def tune(self, sock, nodelay=True):
+        """
+        Set up a connected socket. TCP_NODELAY is set either way, so it is a choice and not
+        the default of the OS: on sends every write at once, off leaves Nagle's algorithm
+        to hold small writes until earlier ones are acknowledged
+        """
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+
+    def open_connection(self, port, host=LOCAL_HOST):
+        return asyncio.open_connection(*self.address(port, host))
+
+    def start_server(self, on_connect, port, backlog, host=LOCAL_HOST):
+        return asyncio.start_server(on_connect, host, port, reuse_address=True, backlog=backlog)
+
+
+class UnixTransport(TcpTransport):
+    """
+    Unix domain stream sockets, the same byte streams without the TCP/IP stack. The socket
+    of a VM is a file in the temp folder named after its port
+    """
+    name = "unix"
+    family = socket.AF_UNIX
+
+    def address(self, port, host=None):
+        return os.path.join(tempfile.gettempdir(), "logical_clock_{}.sock".format(port))
+
+    def tune(self, sock, nodelay=True):
+        pass # no Nagle on Unix domain sockets
+
+    def bind(self, port, backlog, host=None):
+        # a socket file left behind by an earlier run makes bind fail
+        self.release(port)
+        s = self.make_socket()
+        s.bind(self.address(port))
+        s.listen(backlog)
+        return s
+
+    def release(self, port):
+        try:
+            os.unlink(self.address(port))
+        except FileNotFoundError:
+            pass
+
+    def open_connection(self, port, host=None):
+        return asyncio.open_unix_connection(self.address(port))
+
+    def start_server(self, on_connect, port, backlog, host=None):
+        self.release(port)
+        return asyncio.start_unix_server(on_connect, self.address(port), backlog=backlog)
+
+
+class ShmRing():
+    """
+    Single producer, single consumer byte ring in a shared memory segment.
+    head and tail count every byte ever written and read. Each is stored by one side only,
+    with a single aligned 8 byte store after the data is copied, so no lock is needed.
+    The control block holds, in uint64 slots on their own cache lines,
+        head (0), tail (8), writer closed (16), reader closed (24), capacity (32)
+    """
+    CONTROL = 320 # bytes before the data
+    HEAD, TAIL, WRITER_CLOSED, READER_CLOSED, CAPACITY = 0, 8, 16, 24, 32
+
+    def __init__(self, name, capacity=1 << 16, create=False):
+        if create:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=self.CONTROL + capacity)
+            except FileExistsError:
+                # left behind by a run that crashed, the ports are ours now
+                shared_memory.SharedMemory(name=name).unlink()
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=self.CONTROL + capacity)
+        else:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name)
+            except ValueError:
+                # created but not sized yet
+                raise FileNotFoundError(name)
+        self.owner = create
+        self.ctl = self.shm.buf[:self.CONTROL].cast("Q")
+        if create:
+            self.ctl[self.CAPACITY] = capacity # written last, attaching waits for it
+        elif self.ctl[self.CAPACITY] == 0:
+            self.close()
+            raise FileNotFoundError(name)
+        self.capacity = self.ctl[self.CAPACITY]
+        self.data = self.shm.buf[self.CONTROL:self.CONTROL + self.capacity]
+
+    def write(self, data):
+        """
+        Copy all of data in, waiting while the ring is full.
+        Raises BrokenPipeError once the reader is gone, like a socket
+        """
+        ctl, cap = self.ctl, self.capacity
+        data = memoryview(data)
+        delay = 0.00001
+        while len(data):
+            if ctl[self.READER_CLOSED]:
+                raise BrokenPipeError("shared memory ring {} has no reader".format(self.shm.name))
+            head = ctl[self.HEAD]
+            n = min(len(data), cap - (head - ctl[self.TAIL]))
+            if n == 0:
+                time.sleep(delay)
+                delay = min(2 * delay, 0.001)
+                continue
+            start = head % cap
+            first = min(n, cap - start)
+            self.data[start:start + first] = data[:first]
+            if first < n:
+                self.data[:n - first] = data[first:n]
+            ctl[self.HEAD] = head + n
+            data = data[n:]
+
+    def read_into(self, buf):
+        """
+        Copy whatever is in the ring into buf, returns the number of bytes, 0 if there were none
+        """
+        ctl, cap = self.ctl, self.capacity
+        tail = ctl[self.TAIL]
+        n = min(ctl[self.HEAD] - tail, len(buf))
+        if n:
+            start = tail % cap
+            first = min(n, cap - start)
+            buf[:first] = self.data[start:start + first]
+            if first < n:
+                buf[first:n] = self.data[:n - first]
+            ctl[self.TAIL] = tail + n
+        return n
+
+    def close(self):
+        if self.shm is None:
+            return
+        if self.owner:
+            self.shm.unlink()
+        try:
+            self.data.release()
+            self.ctl.release()
+            self.shm.close()
+        except (BufferError, AttributeError):
+            pass # a copy in another thread still holds the buffer, it is unmapped with the object
+        self.shm = None
+
+
+class RingChannel():
+    """
+    One end of a link made of two ShmRings, one per direction, with the socket methods VM uses
+    """
+    def __init__(self, out_ring, in_ring):
+        self.out_ring = out_ring
+        self.in_ring = in_ring
+
+    def sendall(self, data):
+        self.out_ring.write(data)
+
+    def recv_into(self, buf):
+        """
+        Like recv_into of a non blocking socket, 0 means the peer closed its end
+        and BlockingIOError that nothing arrived yet
+        """
+        ring = self.in_ring
+        n = ring.read_into(buf)
+        if n == 0:
+            if not ring.ctl[ring.WRITER_CLOSED]:
+                raise BlockingIOError()
+            # bytes written right before the close
+            n = ring.read_into(buf)
+        return n
+
+    def shutdown(self, how=socket.SHUT_RDWR):
+        if self.out_ring.shm is not None:
+            self.out_ring.ctl[ShmRing.WRITER_CLOSED] = 1
+        if self.in_ring.shm is not None:
+            self.in_ring.ctl[ShmRing.READER_CLOSED] = 1
+
+    def close(self):
+        self.shutdown()
+        self.out_ring.close()
+        self.in_ring.close()
+
+
+class ShmTransport():
+    """
+    Rings in shared memory, one per direction of every link. The VM that accepts a link
+    creates both rings when it starts listening, the dialing VM attaches to them, so a
+    message is two memory copies and no system call. Listening polls the rings and sleeps
+    poll seconds when none of them had data.
+    Start the VM processes after resource_tracker.ensure_running(), so that all of them
+    share one tracker. Attaching registers a ring with the tracker of the process, which
+    would otherwise unlink it when the attaching process exits
+    """
+    name = "shm"
+    selectable = False
+
+    def __init__(self, capacity=1 << 16, poll=0.0002):
+        self.capacity = capacity
+        self.poll = poll
+
+    def ring_name(self, sender_port, receiver_port):
+        return "logical_clock_{}_{}".format(sender_port, receiver_port)
+
+    def create(self, port, peer_port):
+        """
+        Both rings of a link, by the accepting VM
+        """
+        return RingChannel(ShmRing(self.ring_name(port, peer_port), self.capacity, create=True),
+                           ShmRing(self.ring_name(peer_port, port), self.capacity, create=True))
+
+    def attach(self, port, peer_port):
+        """
+        The rings of a link, by the dialing VM. FileNotFoundError until the peer created them
+        """
+        out_ring = ShmRing(self.ring_name(port, peer_port))
+        try:
+            in_ring = ShmRing(self.ring_name(peer_port, port))
+        except FileNotFoundError:
+            out_ring.close()
+            raise
+        return RingChannel(out_ring, in_ring)
+
+    def release(self, port):
+        pass
+
+
+TRANSPORTS = {transport.name: transport for transport in (TcpTransport, UnixTransport, ShmTransport)}
+
+
 # VMs are assumed to exist in a same machine
-# Each VMs maintain two bidirectional sockets, one for each other machine.
-# Each socket is used by two threads. One for sending and one for receiving.
+# Each VM keeps one bidirectional socket per peer in self.peers, keyed by peer index.
+# The links are formed by the topology, by default the original ring of three.
 # Opening up one socket for each message is a bad practice.
 class VM():
     
-    def __init__(self, host, ports, folder, index, tick, total_time=60):
+    def __init__(self, host, ports, folder, index, tick, total_time=60, topology=None, overrun="catchup",
+                 batch=1, queue_size=0, queue_policy="block", clock_type="lamport",
+                 log_format="text", console=True, log_level=logging.INFO, seed=None, die=10, listener=None,
+                 transport="tcp", metrics_every=None, control_port=None, profile=None, outbox_size=None,
+                 reconnect_backoff=(0.01, 1.0), nodelay=True, coalesce=None, causal=False,
+                 ordered=False, ack="tick", hosts=None, timer=None, impair=None):
         """
         Params:
             host: the IP address of socket for virtual machine comunication
             ports: a list of ports for all vms
-            folder: base folder for log file
+            folder: base folder for log file, None for no log files
             index: the position of self in all |ports| VMs. ports[index] is own port
             tick: number of clock ticks per (real world) second for the VM
             total_time: the total time the process run for in seconds
-        Initialization automatically connects the VM to two other VMs
+            topology: dict of VM index to the VM indices it dials, ring_topology by default
+            overrun: what the tick scheduler does with ticks missed by an overrunning round,
+                one of TickScheduler.POLICIES
+            batch: messages pulled off the internal queue per tick, 0 pulls all of them.
+                A batch is folded into the logical clock with a single max
+            queue_size: bound of the internal queue, 0 means unbounded
+            queue_policy: what listening does when the queue is full, "block" stops reading
+                the sockets so TCP pushes back on the senders, "drop_oldest" evicts the
+                oldest queued message
+            clock_type: "lamport", "vector", "matrix" or "hlc", see CLOCKS
+            log_format: "text" writes clock events to the .log file, "json" to a .jsonl EventLog,
+                "binary" to a .trace TraceLog
+            console: echo the text log on the console
+            log_level: level of the text log, above logging.INFO clock events are not logged at all
+            seed: seed of the random generator that rolls the die, for repeatable runs
+            die: sides of the die rolled every tick without messages, 1 and 2 send to one peer
+                and 3 to all of them, so a tick sends with probability 3/die
+            listener: an already listening socket for this VM, e.g. bound to port 0 by a sweep,
+                so no port can be taken between choosing it and binding it
+            transport: "tcp", "unix" or "shm", how frames reach the peers, see TRANSPORTS
+            metrics_every: seconds between snapshots of self.metrics written to
+                <folder>/<name>.metrics.json while work() runs, None for none
+            control_port: port of a local control socket that answers every connection with
+                a metrics snapshot while work() runs, 0 picks a free one, None for none
+            profile: "cprofile" profiles the tick loop into <folder>/<name>.prof, "sample"
+                samples it and adds the hottest lines to the metrics, None for neither
+            outbox_size: frames held for a peer while its link is down, see Link. None holds
+                1024, or every frame for causal and ordered VMs, which cannot lose one
+            reconnect_backoff: (first, longest) seconds between attempts to dial a lost
+                peer again, doubling after every refused attempt
+            nodelay: set TCP_NODELAY on every TCP link, False leaves Nagle's algorithm on
+            coalesce: None writes every frame to its socket at once. Otherwise frames to a
+                peer are batched and written with one sendall: 0 at the end of every tick,
+                a number of microseconds once the next tick would come after the oldest
+                frame has waited that long, see end_tick()
+            causal: deliver messages in causal order, holding back any that arrive before
+                a message they depend on, see CausalOrder
+            ordered: broadcasts are delivered in the same total order by every VM, which
+                needs every VM to be a peer of every other, see TotalOrder
+            ack: "tick" acknowledges all ordered messages pulled in a tick with one frame
+                to every peer, "message" sends one for each of them
+            hosts: the address of every VM, next to its port, when they run on several
+                machines. By default every VM is at host. See cluster.py
+            timer: the monotonic clock of the tick scheduler, called for seconds and with a
+                sleep(seconds) method, e.g. a fake one so work() runs in virtual time.
+                None for time.monotonic and time.sleep
+            impair: impair the network on the links to peers, with an Impairment or a dict
+                of its arguments for all of them, or a dict of peer index to either, see
+                impairments(). Frames to an impaired peer are delayed, lost, reordered or
+                held to a bandwidth on their way to the socket, see DelayLine
+        connect() links the VM to its peers in the topology
         """
-        self.host = host
         self.index = index
         assert len(ports) > index, "index larger than number of VMs"
         self.port = ports[index]
         self.all_ports = ports
+        self.hosts = list(hosts) if hosts is not None else [host] * len(ports)
+        assert len(self.hosts) == len(ports), "one host per VM"
+        self.host = self.hosts[index]
+
+        # who this VM dials, and who dials this VM
+        if topology is None:
+            topology = ring_topology(len(ports))
+        self.dial = list(topology.get(index, []))
+        self.expect = sorted(j for j, targets in topology.items() if index in targets)
+        self.peers = {} # peer index -> socket, or channel of the transport
+        assert transport in TRANSPORTS, "unknown transport {}".format(transport)
+        assert listener is None or transport == "tcp", "a listener is a TCP socket"
+        self.transport = TRANSPORTS[transport]()
+        self.rings = {} # shm transport, peer index -> channel created for an accepted link
+        self.peer_order = [] # peers sorted by ring distance, (index+1) % n first
+        self.peer_info = {} # peer index -> Peer
+        self.peer_list = [] # Peer of every peer in peer_order
+        # link supervision, see lost(). A link is down from the moment either thread sees it
+        # fail until the listener takes over a new socket from redial() or from the peer
+        # causal and ordered delivery would hold back everything after a frame the outbox
+        # dropped forever, so their links keep every frame while down
+        assert outbox_size is None or not (causal or ordered), "causal and ordered delivery need an outbox that drops nothing"
+        if outbox_size is None and not (causal or ordered):
+            outbox_size = 1024
+        self.outbox_size = outbox_size
+        self.reconnect_backoff = reconnect_backoff
+        self.down = set() # peers whose link is down
+        self.finished = set() # peers that said goodbye
+        self.links_lock = threading.Lock() # only taken when a link fails or comes back
+        self.handoff = queue.SimpleQueue() # (peer, socket) dialed again, for the listener
+        self.need_to_listen = False
+        self.nodelay = nodelay
+        assert coalesce is None or coalesce >= 0
+        self.coalesce = coalesce
+        # what the network does to the frames for each peer, sent by the delay line thread
+        self.impairments = impairments(impair, self.dial + self.expect, None if seed is None else "impair {}".format(seed))
+        self.delays = DelayLine() if self.impairments else None
+        fifo = all(impairment.fifo for impairment in self.impairments.values())
+        assert coalesce is None or not self.impairments, "batches are flushed by the tick loop, delayed frames by the delay line"
+        self.unflushed = False # a frame went into a batch since the last flush
+        self.held_since = None # monotonic time the oldest frame of the batches was seen
 
         # clock rate ticks, clock is the variable for the logical clock
         assert tick > 0
         self.tick = tick
         self.total_time = total_time
-        self.clock = 0 # initialization starting from 1
+        assert overrun in TickScheduler.POLICIES
+        self.overrun = overrun
+        # the logical clock, self.clock is the scalar lamport value of the engine
+        assert clock_type in CLOCKS, "unknown clock type {}".format(clock_type)
+        self.engine = CLOCKS[clock_type](len(ports), index, delta=queue_policy != "drop_oldest" and fifo) # deltas need every message in order
+        if clock_type == "hlc":
+            self.engine.wall = self.now # virtual time in a simulation
         self.name = "VM"+str(index)+"_cr"+str(self.tick) # a presentable VM name
+        # the fixed parts of the text log lines
+        self.text_recv = self.name + ' Received Message '
+        self.text_send = self.name + ' Send Message ' + self.name + ':'
+        self.text_broadcast = self.name + ' send message ' + self.name + ':'
+        self.text_internal = self.name + ' Internal Event with logical clock '
+        # frames without payload are restamped in place, see frame()
+        self.out_frame = bytearray(encode_frame(index, 0))
 
         # generate a log file and maintain a log handle
-        log_file = folder + "/" +self.name+".log"
-        self.logger = setup_logger(self.name,log_file)
+        # clock events go to the text log, or to a JSON lines event log, or nowhere when
+        # log_level is above INFO
+        assert log_format in ("text", "json", "binary")
+        log_file = folder + "/" +self.name+".log" if folder is not None else None
+        self.logger = setup_logger(self.name,log_file,level=log_level,console=console)
         self.logger.debug("{} successfully instantiated".format(self.name))
+        self.log_events = log_level <= logging.INFO
+        self.events = None
+        if log_format != "text" and self.log_events and folder is not None:
+            if log_format == "json":
+                self.events = EventLog(folder + "/" + self.name + ".jsonl", self.name, index, tick, clock_ns=self.now_ns, wall=self.now())
+            else:
+                self.events = TraceLog(folder + "/" + self.name + ".trace", self.name, index, tick, clock_ns=self.now_ns, wall=self.now())
+        self.rng = random.Random(seed)
+        assert die >= 3, "a die needs the three sending faces"
+        self.die = die # read when the plan is made on the first tick after peers connect
+        self.plan = None # what each equally likely roll does, see make_plan()
+        self.rolls = iter(()) # the rest of the current block of rolls
+        self.listen_s = listener
+        self.in_s = self.out_s = None
+        self.started = None # wall clock time the tick loop started
+        self.timer = timer
+        # readiness, set once peers can dial this VM and once connect() linked every peer,
+        # so nobody has to sleep until then
+        self.listening = threading.Event()
+        self.connected = threading.Event()
+        if listener is not None:
+            self.listening.set()
 
         # Internal Queue. Messages received from sockets will be pulled into this internal
         # Queue. This queue models the internal system queue
-        self.q = queue.Queue()
-        self.q_lock = threading.Lock() # two process listen and dumping simultaneously so use lock
-        
+        # The queue does its own locking, so listen and work share it without an extra lock
+        assert batch >= 0 and queue_size >= 0
+        assert queue_policy in QUEUE_POLICIES, "unknown queue policy {}".format(queue_policy)
+        self.q = queue.Queue(maxsize=queue_size)
+        self.q_items = self.q.queue # the deque inside the queue, its len() needs no lock
+        self.inbox = [] # drain() refills this list every tick
+        self.batch = batch
+        self.queue_policy = queue_policy
+        self.dropped = 0 # messages evicted by drop_oldest
+
+        # queue depth over time, one (second, max depth, depth at end, dropped) row per tick second
+        self.depth_series = []
+        self.depth_max = 0
+        self.steps = 0
+
+        # counters, histograms and gauges, see Metrics. The listener only writes received,
+        # the tick loop everything else. Internal events are counted against this VM itself
+        self.metrics = Metrics(len(ports))
+        self.m_sent = self.metrics.counter("sent")
+        self.m_received = self.metrics.counter("received")
+        self.m_internal = self.metrics.counter("internal")
+        self.m_reconnects = self.metrics.counter("reconnects")
+        self.m_depth = self.metrics.histogram("queue_depth", "messages") # every tick
+        self.m_jump = self.metrics.histogram("clock_jump", "ticks") # every receive event
+        self.m_overrun = self.metrics.histogram("tick_overrun", "us") # how late every tick started
+        self.m_send = self.metrics.histogram("send_latency", "ns") # every send() call
+        self.metrics.gauge("clock", lambda: self.clock)
+        self.metrics.gauge("queue", lambda: len(self.q_items))
+        self.metrics.gauge("dropped", lambda: self.dropped)
+        self.metrics.gauge("outbox", lambda: sum(len(link.pending) for link in self.links()))
+        self.metrics.gauge("unsent", lambda: sum(link.dropped for link in self.links()))
+        self.metrics.gauge("writes", lambda: sum(link.writes for link in self.links())) # sendall calls, one per frame unless coalescing
+        if self.impairments:
+            self.metrics.gauge("in_flight", lambda: len(self.delays))
+            self.metrics.gauge("lost", lambda: sum(impairment.lost for impairment in self.impairments.values()))
+        # between the queue and the clock update, messages wait here for their causal past
+        assert not causal or (queue_policy != "drop_oldest" and fifo), "causal delivery needs every message in order"
+        self.causal = CausalOrder(len(ports), index, self.metrics) if causal else None
+        assert not ordered or set(self.dial) | set(self.expect) == set(range(len(ports))) - {index}, "ordered broadcasts need a full mesh"
+        assert not ordered or (queue_policy != "drop_oldest" and fifo), "ordered broadcasts need every message in order"
+        assert ack in ("tick", "message")
+        self.total = TotalOrder(len(ports), index, self.metrics) if ordered else None
+        self.ack_each = ack == "message"
+        self.metrics_file = folder + "/" + self.name + ".metrics.json" if metrics_every and folder is not None else None
+        self.metrics_every = metrics_every
+        self.control_port = control_port
+        self.metrics_server = None
+        assert profile in (None, "cprofile", "sample"), "unknown profiler {}".format(profile)
+        self.profile = profile
+        self.profile_file = folder + "/" + self.name + ".prof" if folder is not None else None
+        self.profiler = None
+
         # during initialization, build connection to two other processes
         # self.connect()
 
-    # The three VMs uses sockets to form communication
-    # P1 --> P2 --> P3 --> P1
-    # P1 initiates a connection to P2, P2 initiates a connection to P3, 
-    # P3 initiates a connection to P1
-    def initiate_socket(self):
+    # wall clock and monotonic clock of the VM, a simulation replaces them with virtual time
+    def now(self):
+        return time.time()
+
+    def now_ns(self):
+        return time.monotonic_ns()
+
+    @property
+    def clock(self):
+        return self.engine.value
+
+    @clock.setter
+    def clock(self, value):
+        self.engine.value = value
+
+    def add_peer(self, peer, sock):
+        """
+        Register the socket of a connected peer, or None for a peer that could not be
+        reached yet. out_s and in_s keep naming the next and previous VM of the ring
+        whenever those are peers
+        """
+        n = len(self.all_ports)
+        self.peers[peer] = sock
+        if sock is None:
+            self.down.add(peer)
+        else:
+            self.down.discard(peer)
+        self.peer_order = sorted(self.peers, key=lambda j: (j - self.index) % n)
+        self.peer_info[peer] = Peer(peer, self.link(peer, sock))
+        self.peer_list = [self.peer_info[j] for j in self.peer_order]
+        # the next roll makes a new plan for the new peers
+        self.plan = None
+        self.rolls = iter(())
+        if peer == (self.index+1) % n:
+            self.out_s = sock
+        if peer == (self.index-1) % n:
+            self.in_s = sock
+
+    def link(self, peer, sock):
+        """
+        What the tick loop sends to peer on, a Link that survives the socket failing
+        """
+        if peer in self.impairments:
+            return ImpairedLink(peer, sock, self.impairments[peer], self.delays, capacity=self.outbox_size, on_lost=self.lost)
+        return Link(peer, sock, self.outbox_size, self.lost, batching=self.coalesce is not None)
+
+    def links(self):
+        return [peer.channel for peer in self.peer_list if isinstance(peer.channel, Link)]
+
+    # Every VM dials the peers in its dial list and announces itself with a hello frame
+    # P1 dials P2, P2 dials P3, P3 dials P1 in the default ring
+    def initiate_socket(self, timeout=0):
         """
-        This function establish a connection to the next process, and retain a socket handle
-        self.out_s for future communication
+        This function establishes a connection to every VM in the dial list and retains
+        the socket handles in self.peers. A refused connection is retried until timeout
+        seconds pass, the default single attempt relies on the peers already listening.
+        A peer still unreachable after that is registered with its link down, and the
+        VM keeps dialing it with backoff once work() starts
         """
-        # find the index of the process to connect
-        to_connect = int( (self.index+1) % len(self.all_ports))
-        self.out_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.out_s.settimeout(300)
+        for to_connect in self.dial:
+            deadline = time.monotonic() + timeout
+            delay = 0.005
+            while True:
+                try:
+                    self.add_peer(to_connect, self.dial_peer(to_connect))
+                    self.logger.info("{} connected to VM{} on {} port on {}.".format(self.name, to_connect, self.hosts[to_connect], self.all_ports[to_connect]))
+                    break
+                # nobody listening yet, FileNotFoundError for a socket file or rings not created yet
+                except (ConnectionRefusedError, FileNotFoundError):
+                    if time.monotonic() < deadline:
+                        time.sleep(delay)
+                        delay = min(2 * delay, 0.5)
+                        continue
+                except Exception:
+                    pass
+                self.logger.error("{} failed to connect to VM{} on {} port {}. Error".format(self.name, to_connect, self.hosts[to_connect], self.all_ports[to_connect]))
+                self.add_peer(to_connect, None)
+                break
+
+    def dial_peer(self, to_connect):
+        """
+        Open the link to one peer on the transport of this VM, a socket announces this VM
+        with a hello frame
+        """
+        if not self.transport.selectable:
+            return self.transport.attach(self.port, self.all_ports[to_connect])
+        out_s = self.transport.make_socket()
         try:
-            self.out_s.connect((LOCAL_HOST, self.all_ports[to_connect]))        
-            self.logger.info("{} connected to VM{} on {} port on {}.".format(self.name, to_connect, LOCAL_HOST, self.all_ports[to_connect]))
+            out_s.settimeout(300)
+            out_s.connect(self.transport.address(self.all_ports[to_connect], self.hosts[to_connect]))
+            self.transport.tune(out_s, self.nodelay)
+            out_s.sendall(encode_frame(self.index, 0, kind=MSG_HELLO))
+            out_s.settimeout(None)
         except:
-            self.logger.error("{} failed to connect to VM{} on {} port {}. Error".format(self.name, to_connect, LOCAL_HOST, self.all_ports[to_connect]))
-            sys.exit()
-    
-    # P1 listens for P3, P2 listens for P1, P3 listens for P2
+            out_s.close()
+            raise
+        return out_s
+
+    def open_listener(self):
+        """
+        Bind the single listening socket of this VM, or create the rings of every link it
+        accepts. Once this returns, peers can dial
+        """
+        if getattr(self, "listen_s", None) is not None or self.rings:
+            return
+        if not self.transport.selectable:
+            self.rings = {j: self.transport.create(self.port, self.all_ports[j]) for j in self.expect}
+        else:
+            self.listen_s = self.transport.bind(self.port, max(5, len(self.expect)), self.host)
+        self.listening.set()
+
+    # P1 listens for P3, P2 listens for P1, P3 listens for P2 in the default ring
     def receive_socket(self):
         """
-        This function listens for a connection to the previous process, and retain a socket handle        self.in_s for future communication
+        This function accepts a connection from every VM that dials this one on the single
+        listening socket. Each dialer's hello frame gives the peer id, and the handle
+        is retained in self.peers for future communication
         """
-        to_connect = int( (self.index-1) % len(self.all_ports)) # the index of incoming connection vm
+        pending = set(self.expect)
+        self.open_listener()
+        # rings in shared memory are a link as soon as they exist
+        for to_connect, channel in self.rings.items():
+            pending.discard(to_connect)
+            self.add_peer(to_connect, channel)
+            self.logger.info("{} has incoming connection from VM{} on {} port on {}.".format(self.name, to_connect, self.host, self.port))
+        while pending:
+            try:
+                in_s, to_connect = self.accept_peer()
+            except OSError:
+                self.logger.error("{} failed to receive incoming connection from VMs {} on {} port {}. Error".format(self.name, sorted(pending), self.host, self.port))
+                return
+            if in_s is None:
+                continue
+            if to_connect not in pending:
+                self.logger.error("{} rejected a second incoming connection from VM{}".format(self.name, to_connect))
+                in_s.close()
+                continue
+            pending.discard(to_connect)
+            self.add_peer(to_connect, in_s)
+            self.logger.info("{} has incoming connection from VM{} on {} port on {}.".format(self.name, to_connect, self.host, self.port))
+
+    def accept_peer(self, listener=None):
+        """
+        Accept one connection on listener, the listening socket by default, and read its
+        hello frame. Returns the socket and the index of the dialing VM, or (None, None) for
+        a connection that is not from a VM expected to dial this one. Raises OSError if
+        accepting fails
+        """
+        in_s, _ = (listener or self.listen_s).accept()
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.bind((LOCAL_HOST, self.port)) 
-            s.listen(5)
-            self.in_s, _ = s.accept() # listen for one incoming connection, acquire handle
-            self.logger.info("{} has incoming connection from VM{} on {} port on {}.".format(self.name, to_connect, LOCAL_HOST, self.port))
-        except:
-            self.logger.error("{} failed to receive incoming connection from VM{} on {} port {}. Error".format(self.name, to_connect, LOCAL_HOST, self.all_ports[to_connect]))
-            sys.exit()
+            # read exactly the hello frame, later frames stay in the socket for listen
+            in_s.settimeout(5)
+            hello = in_s.recv(FRAME_HEADER.size, socket.MSG_WAITALL)
+            in_s.settimeout(None)
+            self.transport.tune(in_s, self.nodelay)
+            _, version, kind, to_connect, _ = FRAME_HEADER.unpack(hello)
+        except (OSError, struct.error):
+            in_s.close()
+            return None, None
+        if version != WIRE_VERSION or kind != MSG_HELLO or to_connect not in self.expect:
+            self.logger.error("{} rejected an unexpected incoming connection on port {}".format(self.name, self.port))
+            in_s.close()
+            return None, None
+        return in_s, to_connect
     
     # a wrapper function to operate receive_socket in a thread, and then having
     # VM initate connections
     # the two functions initiate_socket and receive_socket cannot run sequentially, otherwise P1 try to connect to P2 and wait,
     # P2 try to connect to P3 and wait, P3 try to connect to P1 and wait. Locks.
     # So use threads
-    def connect(self):
+    def connect(self, ready=None, timeout=300):
         """
         Threads can access and modify the instance simultaneously. Take care.
         But since initate_socket and receive_socket is alterning different things.
+        Params:
+            ready: an optional barrier shared by all VMs, e.g. multiprocessing.Barrier. Every VM
+                waits on it once it listens, so dialing can start without retrying.
+                Without it, refused connections are retried for up to timeout seconds
         """
         # VMs first start to listen
+        self.open_listener()
         receive_thread = threading.Thread(target=self.receive_socket)
         receive_thread.start()
         # indicate I am listening
         self.logger.info("{} listening on port {}".format(self.name, self.port))
 
-        # wait a little bit for other VMs to ready for listen
-        time.sleep(3)
+        # wait for other VMs to be ready for listen
+        if ready is not None:
+            ready.wait(timeout)
+            timeout = 0
 
         # initiate a connection to other's listening port
-        self.initiate_socket()
+        self.initiate_socket(timeout=timeout)
 
-        # make sure the handle self.in_s is in place
+        # make sure every incoming handle is in place
         receive_thread.join()
+        self.connected.set()
     
-    def listen(self, socket):
+    def listen(self, *sockets):
         """
-        Given a socket that connects to an external VM, always listen for messages that come 
-        in using recv and dump it in the internal queue
+        Given sockets that connect to external VMs, always listen for messages that come
+        in using recv and dump them in the internal queue. One thread serves all sockets
+        through a selector, so the thread count does not grow with the number of peers.
+        A socket the peer closed or that failed is dropped and its link reported lost.
+        The same thread accepts peers dialing again on the listening socket and takes over
+        the sockets redial() opened, so it always blocks in select, never spins
         """
+        if not self.transport.selectable:
+            return self.poll(*sockets)
+        owner = {sock: j for j, sock in self.peers.items() if sock is not None}
+        reading = {} # peer index -> the socket read for it
+        sel = selectors.DefaultSelector()
+        for sock in sockets:
+            peer = owner.get(sock)
+            sel.register(sock, selectors.EVENT_READ, (FrameDecoder(), peer))
+            if peer is not None:
+                reading[peer] = sock
+        # close_down may close the listening socket and clear listen_s while this thread
+        # is still in select, so keep the one registered
+        listening = self.listen_s
+        if listening is not None:
+            sel.register(listening, selectors.EVENT_READ)
+        while self.need_to_listen and sel.get_map():
+            while not self.handoff.empty():
+                self.watch(sel, reading, *self.handoff.get())
+            for key, _ in sel.select(timeout=0.1):
+                if key.fileobj is listening:
+                    try:
+                        in_s, peer = self.accept_peer(listening)
+                    except OSError:
+                        sel.unregister(listening)
+                        continue
+                    if in_s is not None:
+                        self.watch(sel, reading, peer, in_s)
+                    continue
+                socket, (decoder, peer) = key.fileobj, key.data
+                try:
+                    if self.pull(socket, decoder):
+                        continue
+                except Exception as err:
+                    #self.logger.error("Failed to receive message!")
+                    pass
+                # the peer closed its end or the socket failed, stop watching this socket
+                sel.unregister(socket)
+                socket.close()
+                if reading.get(peer) is socket:
+                    del reading[peer]
+                if peer is not None:
+                    self.lost(peer, socket)
+        sel.close()
+
+    def watch(self, sel, reading, peer, sock):
+        # listen to the new socket of a peer in place of its old one
+        old = reading.pop(peer, None)
+        if old is not None:
+            sel.unregister(old)
+            old.close()
+        sel.register(sock, selectors.EVENT_READ, (FrameDecoder(), peer))
+        reading[peer] = sock
+        self.attach(peer, sock)
+
+    def poll(self, *channels):
+        """
+        listen for channels that have no file descriptor, like shared memory rings. Each
+        channel is tried in turn, and when none had data the thread sleeps for the poll
+        interval of the transport. A ring is not opened again once its peer closed it
+        """
+        owner = {channel: j for j, channel in self.peers.items()}
+        decoders = {channel: FrameDecoder() for channel in channels}
+        while self.need_to_listen and decoders:
+            idle = True
+            for channel, decoder in list(decoders.items()):
+                try:
+                    if self.pull(channel, decoder):
+                        idle = False
+                        continue
+                except BlockingIOError:
+                    continue
+                except Exception as err:
+                    pass
+                del decoders[channel]
+                channel.close()
+                if channel in owner:
+                    self.lost(owner[channel], channel)
+            if idle:
+                time.sleep(self.transport.poll)
+
+    def pull(self, sock, decoder):
+        """
+        Move what a peer sent into the internal queue. False once the peer closed its end
+        """
+        # one recv may carry several frames, or only part of one
+        if decoder.recv_into(sock) == 0:
+            return False
+        # as soon as a full frame is decoded, put it into the local queue
+        for msg in decoder.frames():
+            if msg.kind == MSG_BYE:
+                self.farewell(msg.sender)
+                continue
+            self.enqueue(msg)
+            # log info
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("{} pulled a message from VM{} at system time {}".format(self.name, msg.sender, datetime.datetime.now().strftime("%m_%d_%y_%H:%M:%S")))
+        return True
+
+    def farewell(self, peer):
+        """
+        peer finished its run, frames for it are dropped from now on instead of held
+        """
+        self.finished.add(peer)
+        info = self.peer_info.get(peer)
+        if info is not None and isinstance(info.channel, Link):
+            info.channel.gone = True
+        self.logger.info("{} was told VM{} finished".format(self.name, peer))
+
+    def lost(self, peer, sock):
+        """
+        The link to peer failed on sock, noticed by the tick loop or by the listener,
+        whichever was first. Reports about a socket already replaced are ignored. The VM
+        that dialed the peer dials it again, the other one waits for that on its listener
+        """
+        with self.links_lock:
+            if peer in self.down or self.peers.get(peer) is not sock:
+                return
+            self.down.add(peer)
+        # links closing once either end finished its run are no loss
+        if peer in self.finished or not self.need_to_listen:
+            return
+        self.logger.warning("{} lost its link to VM{}".format(self.name, peer))
+        if self.need_to_listen and peer in self.dial and self.transport.selectable:
+            threading.Thread(target=self.redial, args=(peer,), daemon=True).start()
+
+    def attach(self, peer, sock):
+        """
+        The listener took over a new socket to peer, the tick loop switches to it at its
+        next send
+        """
+        with self.links_lock:
+            self.peers[peer] = sock
+            self.down.discard(peer)
+        self.peer_info[peer].channel.fresh = sock
+        self.m_reconnects[peer] += 1
+        self.logger.info("{} linked to VM{} again".format(self.name, peer))
+
+    def redial(self, peer):
+        """
+        Dial a lost peer until it answers, waiting twice as long after every failed attempt
+        up to the longest backoff, and hand the socket to the listener
+        """
+        delay, longest = self.reconnect_backoff
+        while self.need_to_listen and peer not in self.finished:
+            try:
+                sock = self.dial_peer(peer)
+            except OSError:
+                time.sleep(delay)
+                delay = min(2 * delay, longest)
+                continue
+            self.handoff.put((peer, sock))
+            return
+
+    def supervise(self):
+        """
+        Start dialing the peers that could not be reached while connecting
+        """
+        for peer in sorted(self.down):
+            if peer in self.dial and self.transport.selectable:
+                threading.Thread(target=self.redial, args=(peer,), daemon=True).start()
+
+    def enqueue(self, msg):
+        """
+        Put a received message in the internal queue under the queue policy. Returns False
+        if listening was switched off while waiting for room
+        """
+        self.m_received[msg.sender] += 1
+        if self.queue_policy == "drop_oldest":
+            while True:
+                try:
+                    self.q.put_nowait(msg)
+                    return True
+                except queue.Full:
+                    try:
+                        self.q.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
         while self.need_to_listen:
             try:
-                # blocking call to listen for bytes on sockets
-                # being lenient here, not fully defining the protocol for sockets
-                msg = socket.recv(1024).decode()
-                # as soon as hear a msg from socket, put it into the local queue
-                if msg != "":
-                    with self.q_lock:
-                        self.q.put(msg)
-                    # log info
-                    self.logger.debug("{} pulled a message {} at system time {}".format(self.name, msg, datetime.datetime.now().strftime("%m_%d_%y_%H:%M:%S")))
-
-            except Exception as err:
-                #self.logger.error("Failed to receive message!")
-                socket.close()
+                self.q.put(msg, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def drain(self):
+        """
+        Pull up to batch messages off the internal queue, all of them when batch is 0.
+        The list returned is reused by the next call
+        """
+        msgs = self.inbox
+        msgs.clear()
+        limit = self.batch or -1
+        # looking at the length first saves raising queue.Empty on every quiet tick
+        while len(msgs) != limit and self.q_items:
+            try:
+                msgs.append(self.q.get_nowait())
+            except queue.Empty:
+                break
+        return msgs
+
+    def record_depth(self):
+        """
+        Track the queue depth, closing one row of depth_series every tick ticks
+        """
+        depth = len(self.q_items)
+        self.m_depth.observe(depth)
+        if depth > self.depth_max:
+            self.depth_max = depth
+        self.steps += 1
+        if self.steps % self.tick == 0:
+            self.depth_series.append((self.steps // self.tick, self.depth_max, depth, self.dropped))
+            self.depth_max = 0
 
     def send(self, msg, socket):
         """
-        A wrapper send function through socket
+        A wrapper send function through socket, msg is an encoded frame. The Link of a peer
+        never fails, it holds the frame until the link is back. A bare socket that fails
+        is closed, and the VM keeps running
         """
+        self.unflushed = True
         try:
-            socket.send(msg.encode())
+            socket.sendall(msg)
         except Exception as err:
             self.logger.error(" Failed to send message!")
             socket.close()
-            sys.exit()
+
+    def end_tick(self, next_due):
+        """
+        Flush policy of coalesced sends, run after every tick with the monotonic time the
+        next tick is due. A frame never waits past the coalesce window for company: the
+        batches are flushed at the last tick before the window of the oldest frame ends.
+        Links stay FIFO and frames carry the clock of their send event, so holding them is
+        no different for the logical clocks than a slower network
+        """
+        if self.coalesce is None or not self.unflushed:
+            return
+        if self.held_since is None:
+            self.held_since = time.monotonic()
+        if next_due - self.held_since >= self.coalesce / 1e6:
+            self.flush()
+
+    def flush(self):
+        for link in self.links():
+            link.flush()
+        self.unflushed = False
+        self.held_since = None
     
     def close_down(self):
-        try:
-            self.in_s.shutdown(socket.SHUT_RDWR)
-            self.in_s.close()
-        except:
-            pass
-        
-        try:
-            self.out_s.shutdown(socket.SHUT_RDWR)
-            self.out_s.close()
-        except:
-            pass
+        self.stop_metrics()
+        if self.delays is not None:
+            self.delays.stop()
+        self.flush()
+        # tell the peers this is the end of the run, so they do not dial again
+        bye = encode_frame(self.index, self.clock, kind=MSG_BYE)
+        for sock in self.peers.values():
+            if sock is None:
+                continue
+            try:
+                sock.sendall(bye)
+            except Exception:
+                pass
+        for sock in list(self.peers.values()) + list(self.rings.values()) + [getattr(self, "in_s", None), getattr(self, "out_s", None)]:
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except:
+                pass # e.g. already reset by the peer, closing is still needed
+            sock.close()
+        # sockets dialed again that the listener never took over
+        while not self.handoff.empty():
+            self.handoff.get()[1].close()
+
+        if getattr(self, "listen_s", None) is not None:
+            self.listen_s.close()
+            self.listen_s = None
+            self.transport.release(self.port)
+        self.close_logs()
+
+    def close_logs(self):
+        if self.events is not None:
+            self.events.close()
+            self.events = None
+        close_logger(self.logger)
+
+    def log_event(self, start_time, event, clock, peer=-1, qsize=-1, msg_clock=-1):
+        """
+        Log one clock event, either as a line of the original text log or in the event log
+        event is one of "recv", "send", "broadcast", "internal"
+        """
+        if self.events is not None:
+            self.events.record(event, self.index, clock, peer, qsize, msg_clock)
+        elif event == "recv":
+            self.logger.info(self.text_recv + self.peer_name(peer) + ':' + str(msg_clock) + ' with queue size ' + str(qsize) + ' and internal logic clock ' + str(clock)+" at system time "+ str(self.now()-start_time)[0:5])
+        elif event == "send":
+            self.logger.info(self.text_send + str(clock) + " to " + self.peer_name(peer) +" at system time "+ str(self.now()-start_time)[0:5])
+        elif event == "broadcast":
+            self.logger.info(self.text_broadcast + str(clock) + " to all other VMs at system time "+ str(self.now()-start_time)[0:5])
+        else:
+            self.logger.info(self.text_internal + str(clock) + " at system time "+ str(self.now()-start_time)[0:5])
+
+    def peer_name(self, peer):
+        info = self.peer_info.get(peer)
+        return info.name if info is not None else "VM" + str(peer)
+
+    def make_plan(self):
+        """
+        One (event, Peer) entry per equally likely outcome of rolling the die. Faces 1 and 2
+        send to one peer, in the ring of three 1 is the next VM and 2 the previous one, and
+        with more peers a face and a uniformly chosen peer make one outcome. Face 3 sends to
+        all peers, every other face is an internal event
+        """
+        peers = self.peer_list
+        if not peers:
+            return [("internal", None)]
+        width = 1 if len(peers) <= 2 else len(peers)
+        plan = []
+        for face in range(1, self.die + 1):
+            if face <= 2:
+                plan.extend([("send", peers[(face-1) % len(peers)])] if width == 1 else [("send", peer) for peer in peers])
+            elif face == 3:
+                plan.extend([("broadcast", None)] * width)
+            else:
+                plan.extend([("internal", None)] * width)
+        return plan
+
+    def roll(self):
+        """
+        The (event, Peer) of one roll. Rolls are drawn a second's worth of ticks at a time
+        """
+        action = next(self.rolls, None)
+        if action is None:
+            if self.plan is None:
+                self.plan = self.make_plan()
+            self.rolls = iter(self.rng.choices(self.plan, k=self.tick))
+            action = next(self.rolls)
+        return action
+
+    def frame(self, stamp, peer, kind=MSG_CLOCK):
+        """
+        The frame carrying stamp to peer. Without a payload it is the same buffer every
+        time with only the clock field changed, so send() must not keep it
+        """
+        if self.down and peer in self.down:
+            # the outbox may drop this frame and the failed socket may have lost some,
+            # so while the link is down deltas start over from the whole clock
+            self.engine.forget(peer)
+        payload = self.engine.payload(peer)
+        if self.causal is not None:
+            payload = self.causal.payload(peer) + payload
+        if payload or kind != MSG_CLOCK:
+            return encode_frame(self.index, stamp, payload, kind=kind)
+        FRAME_CLOCK.pack_into(self.out_frame, FRAME_CLOCK_AT, stamp)
+        return self.out_frame
+
+    def step(self, start_time):
+        """
+        One clock tick: either pull a batch of messages off the internal queue, or roll the die and
+        send to one, all or none of the peers. Shared by every runtime so they all make
+        the same logical clock decisions.
+        """
+        self.record_depth()
+        # if there are messages in internal que, pull a batch off
+        msgs = self.drain() # decoded Message frames
+        if self.causal is not None:
+            # only what can be delivered counts, a tick whose messages were all held back rolls
+            msgs = self.causal.deliver(msgs, self.now_ns())
+        if msgs:
+            if self.log_events:
+                qsize = len(self.q_items)
+                for msg in msgs:
+                    self.log_event(start_time, "recv", self.clock, msg.sender, qsize, msg.clock)
+            # the whole batch is one receive event
+            before = self.clock
+            self.engine.receive(msgs)
+            self.m_jump.observe(self.clock - before)
+            if self.total is not None:
+                now = self.now_ns()
+                self.total.receive(msgs, now)
+                self.total.deliver(now)
+
+        # otherwise try to send a message
+        else:
+            event, peer = self.roll()
+
+            # send to a single peer the clock value
+            if event == "send":
+                stamp = self.engine.send()
+                if self.log_events:
+                    self.log_event(start_time, event, stamp, peer.index)
+                self.m_sent[peer.index] += 1
+                sending = time.perf_counter_ns()
+                self.send(self.frame(stamp, peer.index), peer.channel)
+                self.m_send.observe(time.perf_counter_ns() - sending)
+
+            # send to all peers the clock value, in total order when asked to
+            elif event == "broadcast":
+                if self.total is not None:
+                    now = self.now_ns()
+                    self.total.sent(self.broadcast(start_time, MSG_ORDERED), now)
+                    self.total.deliver(now)
+                else:
+                    self.broadcast(start_time)
 
+            # otherwise no communication and simply just internal event
+            else:
+                if self.log_events:
+                    self.log_event(start_time, "internal", self.clock)
+                self.m_internal[self.index] += 1
+                self.engine.internal()
 
-    def work(self):
-        start_time = time.time() # for recording the start time of system time
+        # acknowledge what this tick pulled, even when the tick also received
+        if self.total is not None and self.total.owed:
+            for _ in range(self.total.owed if self.ack_each else 1):
+                self.broadcast(start_time, MSG_ACK)
+            self.total.owed = 0
 
-        # two threads always listening in the background and putting msgs in que
+    def broadcast(self, start_time, kind=MSG_CLOCK):
+        """
+        One send event to all peers, returns its stamp
+        """
+        stamp = self.engine.send()
+        if self.log_events:
+            self.log_event(start_time, "broadcast", stamp)
+        # every send only copies the frame into kernel buffers, no need for extra threads
+        for peer in self.peer_list:
+            self.m_sent[peer.index] += 1
+            sending = time.perf_counter_ns()
+            self.send(self.frame(stamp, peer.index, kind), peer.channel)
+            self.m_send.observe(time.perf_counter_ns() - sending)
+        return stamp
+
+    def work(self, start_at=None):
+        """
+        Run the tick loop for total_time seconds. start_at is a wall clock time to wait for
+        first, so VMs on different machines start their clocks together, see cluster.py
+        """
+        if start_at is not None:
+            time.sleep(max(0, start_at - time.time()))
+        start_time = self.started = time.time() # for recording the start time of system time
+
+        # one thread always listening in the background and putting msgs in que
         self.need_to_listen = True # an indicator for stopping the listening thread
-        threading.Thread(target=self.listen,args=(self.out_s,)).start()
-        threading.Thread(target=self.listen, args=(self.in_s,)).start()
+        threading.Thread(target=self.listen, args=tuple(sock for sock in self.peers.values() if sock is not None)).start()
+        self.supervise()
+        if self.delays is not None:
+            self.delays.start()
         
         # now main process work according to clock rates
-        # always running for total_time seconds
-        for ti in range(self.total_time):
-            # for tick times every second, wakes up, read and send messages
-            for i in range(self.tick):
-                wake_up_this_round_time = time.time()
-                # if there is message in internal que, pull one off
-                if not self.q.empty():
-                    with self.q_lock:
-                        msg = self.q.get() # msg in form "vm_name:clock_val"
-                        msg_logic_clock_val = msg.split(":")[-1]
-                        self.logger.info(self.name +' Received Message '+ msg + ' with queue size ' + str(self.q.qsize())+ ' and internal logic clock ' + str(self.clock)+" at system time "+ str(time.time()-start_time)[0:5])
-                        self.clock = max(self.clock, int(msg_logic_clock_val)) + 1
-
-                # otherwise try to send a message
-                else:
-                    r_num = random.randint(1, 10)
-
-                    # send to out vm machine the clock value
-                    if r_num == 1:
-                        out_vm = "VM"+str( (self.index+1) % 3) # a presentable VM name
-                        msg = self.name +":"+str(self.clock)
-                        self.logger.info(self.name +' Send Message '+ msg + " to " + out_vm +" at system time "+ str(time.time()-start_time)[0:5])
-                        self.send(msg, self.out_s)
-
-                    # send to in vm machine the clock value
-                    elif r_num == 2:
-                        out_vm = "VM"+str( (self.index-1) % 3) # a presentable VM name
-                        msg = self.name +":"+str(self.clock)
-                        self.logger.info(self.name +' send message '+ msg + " to " + out_vm +" at system time "+ str(time.time()-start_time)[0:5])
-                        self.send(msg, self.in_s)
-
-                    # send to both vms machines the clock value
-                    elif r_num == 3:
-                        msg = self.name +":"+str(self.clock)
-                        self.logger.info(self.name +' send message '+ msg + " to both other VMs at system time "+ str(time.time()-start_time)[0:5])
-                        t_out_send = threading.Thread(target=self.send, args=(str(self.clock),self.out_s))
-                        t_in_send = threading.Thread(target=self.send, args=(str(self.clock),self.in_s))
-                        t_out_send.start()
-                        t_in_send.start()
-                        t_out_send.join()
-                        t_in_send.join()
-
-                    # otherwise no communication and simply just internal event
-                    else:
-                        self.logger.info(self.name +' Internal Event with logical clock '+ str(self.clock) + " at system time "+ str(time.time()-start_time)[0:5])
-
-                    self.clock += 1
-
-                # sleep for 1/rate before waking up again
-                # adjust for the operation in this round
-                round_time = time.time() - wake_up_this_round_time
-                time.sleep(1/self.tick - round_time)
+        # always running for total_time seconds, tick times every second
+        # every wake up is scheduled from the start, so time spent in a round is not lost
+        self.scheduler = self.make_scheduler()
+        self.start_metrics()
+        for _ in self.scheduler.ticks():
+            self.step(start_time)
+            self.end_tick(self.scheduler.next_due())
+            self.m_overrun.observe(self.scheduler.late_us)
 
+        self.flush()
         self.need_to_listen = False # indicate the listening thread can stop working now
-        
-        
+        self.stop_metrics()
+        self.log_schedule()
+
+    def make_scheduler(self):
+        if self.timer is None:
+            return TickScheduler(self.tick, self.total_time * self.tick, policy=self.overrun)
+        return TickScheduler(self.tick, self.total_time * self.tick, policy=self.overrun, clock=self.timer, sleep=self.timer.sleep)
+
+    def start_metrics(self):
+        """
+        Start publishing metrics and profiling the tick loop, whichever the VM was asked to
+        """
+        if self.metrics_file is not None or self.control_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_file, port=self.control_port, interval=self.metrics_every or 1.0).start()
+            if self.control_port is not None:
+                self.logger.info("{} serves metrics on {} port {}".format(self.name, LOCAL_HOST, self.metrics_server.port))
+        if self.profile == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.profile == "sample":
+            self.metrics.samples = Sampler(threading.get_ident()).start()
+
+    def stop_metrics(self):
+        """
+        Stop the profilers, then the metrics server after its last snapshot. Also called
+        by close_down, so a run that ended early keeps what it measured
+        """
+        if self.profiler is not None:
+            self.profiler.disable()
+            if self.profile_file is not None:
+                self.profiler.dump_stats(self.profile_file)
+                self.logger.info("{} wrote the profile of its tick loop to {}".format(self.name, self.profile_file))
+            self.profiler = None
+        if self.metrics.samples is not None and self.metrics.samples.running:
+            self.metrics.samples.stop()
+            for line in self.metrics.samples.top(5):
+                self.logger.info("{} tick loop spent {:.1%} of samples in {}".format(self.name, line["share"], line["where"]))
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+    def log_schedule(self):
+        """
+        Log how closely the tick scheduler kept to the configured clock rate
+        """
+        stats = self.scheduler.stats()
+        self.logger.info("{} ran {} ticks at {:.3f} per second for clock rate {}, missed {}, overran {} times, jitter mean {:.6f} p99 {:.6f} max {:.6f}".format(
+            self.name, stats["ticks"], stats["achieved_rate"], self.tick, stats["missed"], stats["overruns"], stats["jitter_mean"], stats["jitter_p99"], stats["jitter_max"]))
+        peak = max((row[1] for row in self.depth_series), default=0)
+        self.logger.info("{} queue depth peaked at {}, {} messages left in queue, {} dropped".format(self.name, peak, self.q.qsize(), self.dropped))
+
+    def summary(self):
+        """
+        What a finished run reports back, e.g. to a sweep
+        """
+        stats = self.scheduler.stats() if getattr(self, "scheduler", None) is not None else {}
+        return {
+            "vm": self.index,
+            "tick": self.tick,
+            "clock": self.clock,
+            "ticks": stats.get("ticks", 0),
+            "total_ticks": self.total_time * self.tick,
+            "started": self.started,
+            "achieved_rate": stats.get("achieved_rate", 0.0),
+            "missed": stats.get("missed", 0),
+            "peak_queue": max((row[1] for row in self.depth_series), default=0),
+            "left_in_queue": self.q.qsize(),
+            "dropped": self.dropped,
+            "reconnects": sum(self.m_reconnects),
+            "held": self.causal.count_held if self.causal is not None else 0,
+            "ordered": sum(self.total.delivered) if self.total is not None else 0,
+            "order_pending": len(self.total.pending) if self.total is not None else 0,
+            # microseconds from arrival, or sending, to delivery in total order
+            "order_delay_us": [self.total.delay.percentile(50), self.total.delay.percentile(99)] if self.total is not None else None,
+            # frames for peers that never got them, held when the run ended or dropped
+            "unsent": sum(len(link.pending) + link.dropped for link in self.links()),
+            # frames the impaired network lost, and those still in flight when it stopped
+            "lost": sum(impairment.lost for impairment in self.impairments.values()),
+            "in_flight": len(self.delays) if self.delays is not None else 0,
+        }
+
+
+# The same VM on a single asyncio event loop. Connection setup, all listeners, the tick loop
+# and all sends share one OS thread, so there are no listener threads and no per-send threads.
+# self.peers holds asyncio StreamWriters instead of sockets, which is all step() needs.
+class AsyncVM(VM):
+
+    async def initiate_socket(self, timeout=300):
+        """
+        Dial every VM in the dial list concurrently. Instead of sleeping until they listen,
+        keep retrying a refused connection until it is accepted or timeout seconds pass
+        """
+        self.readers = getattr(self, "readers", {})
+
+        async def dial(to_connect):
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    reader, writer = await self.transport.open_connection(self.all_ports[to_connect], self.hosts[to_connect])
+                    writer.write(encode_frame(self.index, 0, kind=MSG_HELLO))
+                    self.readers[to_connect] = reader
+                    self.add_peer(to_connect, writer)
+                    self.logger.info("{} connected to VM{} on {} port on {}.".format(self.name, to_connect, self.hosts[to_connect], self.all_ports[to_connect]))
+                    return
+                except (ConnectionRefusedError, FileNotFoundError):
+                    if time.monotonic() < deadline:
+                        await asyncio.sleep(0.01)
+                        continue
+                except Exception:
+                    pass
+                # run without this peer rather than not at all
+                self.logger.error("{} failed to connect to VM{} on {} port {}. Error".format(self.name, to_connect, self.hosts[to_connect], self.all_ports[to_connect]))
+                return
+
+        await asyncio.gather(*[dial(to_connect) for to_connect in self.dial])
+
+    async def receive_socket(self):
+        """
+        Serve on own port and wait until every VM that dials this one has said hello.
+        Connections are handled concurrently by the server
+        """
+        self.readers = getattr(self, "readers", {})
+        pending = set(self.expect)
+        done = asyncio.get_running_loop().create_future()
+        if not pending:
+            done.set_result(None)
+
+        async def on_connect(reader, writer):
+            try:
+                hello = await reader.readexactly(FRAME_HEADER.size)
+            except Exception:
+                writer.close()
+                return
+            _, version, kind, to_connect, _ = FRAME_HEADER.unpack(hello)
+            if version != WIRE_VERSION or kind != MSG_HELLO or to_connect not in pending:
+                self.logger.error("{} rejected an unexpected incoming connection on port {}".format(self.name, self.port))
+                writer.close()
+                return
+            pending.discard(to_connect)
+            self.readers[to_connect] = reader
+            self.add_peer(to_connect, writer)
+            self.logger.info("{} has incoming connection from VM{} on {} port on {}.".format(self.name, to_connect, self.host, self.port))
+            if not pending and not done.done():
+                done.set_result(None)
+
+        try:
+            if self.listen_s is not None:
+                self.server = await asyncio.start_server(on_connect, sock=self.listen_s)
+                self.listen_s = None # the server owns it now
+            else:
+                self.server = await self.transport.start_server(on_connect, self.port, backlog=max(100, len(self.expect)), host=self.host)
+        except Exception:
+            self.logger.error("{} failed to receive incoming connection from VMs {} on {} port {}. Error".format(self.name, self.expect, self.host, self.port))
+            raise
+        self.logger.info("{} listening on port {}".format(self.name, self.port))
+        self.listening.set()
+        await done
+
+    async def connect(self, ready=None, timeout=300):
+        """
+        Serving and dialing run concurrently on the loop, so no topology can deadlock.
+        ready is an optional barrier like in VM.connect, or an asyncio.Event set once every
+        VM in this loop is serving
+        """
+        assert self.transport.selectable, "AsyncVM runs on stream transports, tcp or unix"
+        assert not self.impairments, "impaired links run on thread VMs and in simulations"
+        assert self.coalesce is None, "coalesced writes run on thread VMs"
+        receiving = asyncio.create_task(self.receive_socket())
+        if ready is not None:
+            while getattr(self, "server", None) is None and not receiving.done():
+                await asyncio.sleep(0)
+            if asyncio.iscoroutinefunction(ready.wait):
+                await asyncio.wait_for(ready.wait(), timeout)
+            else:
+                await asyncio.to_thread(ready.wait, timeout)
+            timeout = 0
+        await self.initiate_socket(timeout=timeout)
+        await receiving
+        self.connected.set()
+
+    async def listen(self, reader):
+        """
+        Read from a stream and dump every decoded frame in the internal queue
+        """
+        decoder = FrameDecoder()
+        while self.need_to_listen:
+            try:
+                data = await reader.read(65536)
+            except Exception:
+                break
+            if not data:
+                break
+            decoder.feed(data)
+            for msg in decoder.frames():
+                if msg.kind == MSG_BYE:
+                    self.farewell(msg.sender)
+                    continue
+                if self.queue_policy == "block":
+                    # stop reading this stream until work() makes room
+                    while self.q.full() and self.need_to_listen:
+                        await asyncio.sleep(1/self.tick)
+                if not self.enqueue(msg):
+                    return
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("{} pulled a message from VM{} at system time {}".format(self.name, msg.sender, datetime.datetime.now().strftime("%m_%d_%y_%H:%M:%S")))
+
+    def link(self, peer, writer):
+        # a closed stream is not opened again
+        return writer
+
+    def send(self, msg, writer):
+        """
+        Queue a frame on the stream, the event loop flushes it while the tick loop sleeps.
+        The stream may keep what it could not send yet, so it gets a copy of the reused frame.
+        Frames for a peer whose stream closed are dropped, the tick loop keeps running
+        """
+        if writer.is_closing():
+            return
+        try:
+            writer.write(bytes(msg))
+        except Exception as err:
+            self.logger.error(" Failed to send message!")
+            writer.close()
+
+    async def work(self, start_at=None):
+        if start_at is not None:
+            await asyncio.sleep(max(0, start_at - time.time()))
+        start_time = self.started = time.time()
+
+        self.need_to_listen = True
+        listeners = [asyncio.create_task(self.listen(reader)) for reader in self.readers.values()]
+
+        self.scheduler = self.make_scheduler()
+        self.start_metrics()
+        while True:
+            delay = self.scheduler.delay()
+            if delay is None:
+                break
+            if self.timer is not None:
+                # virtual time, the loop still gets a turn every tick
+                self.timer.sleep(delay)
+                delay = 0
+            await asyncio.sleep(delay)
+            self.scheduler.fire()
+            self.step(start_time)
+            self.m_overrun.observe(self.scheduler.late_us)
+            # only waits when a peer is slow to read and the write buffer is full
+            for writer in self.peers.values():
+                await writer.drain()
+
+        self.need_to_listen = False
+        self.stop_metrics()
+        self.log_schedule()
+        for listener in listeners:
+            listener.cancel()
+        await asyncio.gather(*listeners, return_exceptions=True)
+
+    async def close_down(self):
+        self.stop_metrics()
+        bye = encode_frame(self.index, self.clock, kind=MSG_BYE)
+        for writer in self.peers.values():
+            try:
+                if not writer.is_closing():
+                    writer.write(bye)
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+        if getattr(self, "server", None) is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.transport.release(self.port)
+        self.close_logs()
+
+    async def run(self, ready=None):
+        await self.connect(ready)
+        await self.work()
+        await self.close_down()
+
+
+# A VM inside a Simulation. Its peers are plain VM indices, send hands the frame to the
+# simulation instead of a socket, and its clocks read the virtual time of the simulation,
+# so the text and event logs look like those of a real run.
+class SimVM(VM):
+
+    def __init__(self, sim, *args, **kwargs):
+        self.sim = sim
+        super().__init__(*args, **kwargs)
+        self.need_to_listen = True
+        for peer in self.dial + self.expect:
+            self.add_peer(peer, peer)
+        self.logger.addFilter(self._virtual_time)
+
+    def _virtual_time(self, record):
+        # stamp log records with virtual time, for the asctime of the text log
+        record.created = self.now()
+        record.msecs = (record.created % 1) * 1000
+        return True
+
+    def now(self):
+        return self.sim.epoch + self.sim.now
+
+    def now_ns(self):
+        return int(self.sim.now * 1e9)
+
+    def link(self, peer, index):
+        return index
+
+    def send(self, msg, peer):
+        # the frame is delivered later, so keep a copy of the reused one
+        self.sim.transmit(self.index, peer, bytes(msg))
+
+
+class Simulation():
+    """
+    Deterministic discrete event run of VMs with no sockets, threads or sleeping.
+    Ticks and message deliveries are events on a heap ordered by virtual time, and each
+    VM runs the same step() as a real one. Messages take delay seconds plus up to jitter
+    more, and stay in order on every link like on TCP, unless the impair argument of the VMs
+    impairs the link further. Everything random comes from seed,
+    so a configuration always gives the same run.
+    Params:
+        ticks: clock rate of every VM
+        total_time: virtual seconds to run for
+        folder: where the VMs write their logs, None for no logs at all
+        the rest goes to every SimVM, e.g. batch, queue_size, clock_type, log_format
+    """
+    TICK, DELIVER = 1, 0 # deliveries due at the same moment as a tick go first
+
+    def __init__(self, ticks, total_time=60, seed=0, delay=0.001, jitter=0.0, folder=None, topology=None, epoch=None, **vm_kwargs):
+        self.ticks = list(ticks)
+        self.total_time = total_time
+        self.seed = seed
+        self.delay = delay
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.now = 0.0 # virtual seconds since the start
+        self.epoch = time.time() if epoch is None else epoch
+        self.heap = []
+        self.seq = 0 # tie breaker, keeps equal times in insertion order
+        self.link_free = {} # (sender, receiver) -> time of the last delivery on the link
+        self.blocked = {} # receiver -> sender -> frames waiting for room in a full "block" queue
+        self.messages = 0
+        vm_kwargs.setdefault("console", False)
+        if folder is None:
+            vm_kwargs.setdefault("log_level", logging.WARNING)
+        ports = [0] * len(self.ticks)
+        self.vms = [SimVM(self, LOCAL_HOST, ports, folder, i, tick, total_time=total_time, topology=topology,
+                          seed=self.rng.getrandbits(64), **vm_kwargs) for i, tick in enumerate(self.ticks)]
+
+    def push(self, t, kind, vm, data):
+        self.seq += 1
+        heapq.heappush(self.heap, (t, kind, self.seq, vm, data))
+
+    def transmit(self, sender, receiver, frame):
+        t = self.now + self.delay
+        if self.jitter:
+            t += self.rng.uniform(0, self.jitter)
+        impairment = self.vms[sender].impairments.get(receiver)
+        if impairment is not None:
+            # on top of the loopback delay, the impairment keeps the order of the link
+            # unless it reorders, and may lose the frame
+            t = impairment.due(t, len(frame))
+            if t is None:
+                return
+        else:
+            t = max(t, self.link_free.get((sender, receiver), 0.0))
+            self.link_free[(sender, receiver)] = t
+        self.push(t, self.DELIVER, receiver, frame)
+        self.messages += 1
+
+    def deliver(self, vm, frame):
+        _, _, msg_kind, sender, clock = FRAME_HEADER.unpack_from(frame)
+        vm.enqueue(Message(msg_kind, sender, clock, frame[FRAME_HEADER.size:]))
+
+    def release(self, vm):
+        # frames held back from vm go on to its queue as far as there is room, every link in order
+        for held in self.blocked[vm.index].values():
+            while held and not (vm.queue_policy == "block" and vm.q.full()):
+                self.deliver(vm, held.popleft())
+
+    def run(self):
+        """
+        Run every event and return a summary of the VMs
+        """
+        start_time = self.epoch
+        for vm in self.vms:
+            self.push(0.0, self.TICK, vm.index, 0)
+        heap = self.heap
+        while heap:
+            t, kind, _, index, data = heapq.heappop(heap)
+            self.now = t
+            vm = self.vms[index]
+            if kind == self.TICK:
+                vm.step(start_time)
+                k = data + 1
+                if k < self.total_time * vm.tick:
+                    self.push(k / vm.tick, self.TICK, index, k)
+                if index in self.blocked:
+                    self.release(vm)
+            else:
+                sender = FRAME_HEADER.unpack_from(data)[3]
+                held = self.blocked.get(index, {}).get(sender)
+                if held or vm.queue_policy == "block" and vm.q.full():
+                    # the receiver is not reading, the frame and any after it on the link
+                    # wait for its next tick, those still waiting when it stops stay in flight
+                    self.blocked.setdefault(index, {}).setdefault(sender, deque()).append(data)
+                    continue
+                self.deliver(vm, data)
+        for vm in self.vms:
+            vm.close_logs()
+        return {
+            "ticks": self.ticks,
+            "seed": self.seed,
+            "total_time": self.total_time,
+            "clocks": [vm.clock for vm in self.vms],
+            "peak_queue": [max((row[1] for row in vm.depth_series), default=0) for vm in self.vms],
+            "left_in_queue": [vm.q.qsize() for vm in self.vms],
+            "dropped": [vm.dropped for vm in self.vms],
+            "lost": [sum(impairment.lost for impairment in vm.impairments.values()) for vm in self.vms],
+            "in_flight": [sum(map(len, self.blocked.get(vm.index, {}).values())) for vm in self.vms],
+            "messages": self.messages,
+        }
+
+
+def simulate(config):
+    """
+    Run one Simulation from a dict of its arguments
+    """
+    return Simulation(**config).run()
+
+
+def run_simulations(configs, workers=None):
+    """
+    Run many simulations in a process pool, results come back in the order of configs
+    """
+    configs = list(configs)
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(simulate, configs, chunksize=max(1, len(configs) // (4 * workers))))
+
+
 # running a virtual machine
 # a wrapper function to call the object instance' method
-def run_vm(host, ports, exp_folder, index, tick):
+# results: an optional multiprocessing queue that gets vm.summary() when the run ends,
+# also when an error ends it early
+# the rest goes to the VM, e.g. total_time, die, listener
+def run_vm(host, ports, exp_folder, index, tick, use_async=False, ready=None, topology=None, results=None, **vm_kwargs):
     # instantiate an object in the 
-    vm = VM(host=host, ports=ports, folder=exp_folder, index=index, tick=tick)
-    # 
-    vm.connect()
-    vm.work()
-    vm.close_down()
+    if use_async:
+        vm = AsyncVM(host=host, ports=ports, folder=exp_folder, index=index, tick=tick, topology=topology, **vm_kwargs)
+    else:
+        vm = VM(host=host, ports=ports, folder=exp_folder, index=index, tick=tick, topology=topology, **vm_kwargs)
+    try:
+        if use_async:
+            asyncio.run(vm.run(ready))
+        else:
+            # 
+            vm.connect(ready)
+            vm.work()
+    finally:
+        # a run ended early by an error still stops its listener, so the process exits,
+        # and still closes its sockets, socket files and rings
+        vm.need_to_listen = False
+        if not use_async:
+            vm.close_down()
+        if results is not None:
+            results.put(vm.summary())
 
 
 if __name__ == "__main__":
-    
+    parser = argparse.ArgumentParser(description="Run logical clock VMs, one process each")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run every VM on an asyncio event loop")
+    parser.add_argument("--vms", type=int, default=len(VM_PORTS), help="number of VMs, more than three use free ports")
+    parser.add_argument("--topology", choices=["ring", "mesh"], default="ring")
+    parser.add_argument("--transport", choices=sorted(TRANSPORTS), default="tcp", help="how VMs on this machine reach each other")
+    parser.add_argument("--ticks", type=int, nargs="+", help="clock rate of every VM, random from 1 to 6 by default")
+    parser.add_argument("--simulate", action="store_true", help="run in virtual time without sockets, finishes at once")
+    parser.add_argument("--seed", type=int, help="seed of a simulated run")
+    parser.add_argument("--metrics", type=float, metavar="SECONDS", help="write a metrics snapshot of every VM this often")
+    parser.add_argument("--control-port", type=int, help="VM i answers metrics requests on this port + i, 0 picks free ports")
+    parser.add_argument("--profile", choices=["cprofile", "sample"], help="profile the tick loop of every VM")
+    parser.add_argument("--coalesce", type=int, metavar="US", help="batch the frames to a peer for up to this many microseconds, 0 for one write per tick")
+    parser.add_argument("--nagle", action="store_true", help="leave Nagle's algorithm on instead of setting TCP_NODELAY")
+    parser.add_argument("--causal", action="store_true", help="deliver messages in causal order")
+    parser.add_argument("--ordered", action="store_true", help="deliver broadcasts in one total order, needs --topology mesh")
+    parser.add_argument("--clock", choices=sorted(CLOCKS), default="lamport", help="logical clock of every VM")
+    parser.add_argument("--log-format", choices=["text", "json", "binary"], default="text", help="clock events as text lines, JSON lines or a binary .trace")
+    parser.add_argument("--delay", type=float, default=0.0, metavar="MS", help="impair every link with this delay")
+    parser.add_argument("--jitter", type=float, default=0.0, metavar="MS", help="spread of the delay of impaired links")
+    parser.add_argument("--distribution", choices=Impairment.DISTRIBUTIONS, default="uniform", help="distribution of the delay of impaired links")
+    parser.add_argument("--loss", type=float, default=0.0, metavar="P", help="probability an impaired link loses a frame")
+    parser.add_argument("--reorder", type=float, default=0.0, metavar="P", help="probability a frame overtakes those in flight on an impaired link")
+    parser.add_argument("--bandwidth", type=float, metavar="BYTES", help="bytes per second an impaired link carries")
+    args = parser.parse_args()
+    if args.use_async and args.coalesce is not None:
+        parser.error("--coalesce batches the writes of thread VMs, not of --async ones")
+    impair = None
+    if args.delay or args.jitter or args.loss or args.reorder or args.bandwidth:
+        impair = {"delay": args.delay / 1000, "jitter": args.jitter / 1000, "distribution": args.distribution,
+                  "loss": args.loss, "reorder": args.reorder, "bandwidth": args.bandwidth}
+
     # base of the log file
     if not os.path.exists('logs'):
         os.makedirs('logs')
@@ -266,22 +3159,46 @@ if __name__ == "__main__":
     # each experiment has a unique folder for three log file
     exp_folder = "logs/"+datetime.datetime.now().strftime("%m_%d_%y_%H:%M:%S")
     os.makedirs(exp_folder)
-    
+
+    n = len(args.ticks) if args.ticks else args.vms
+    tick_list = args.ticks or [random.randint(1,6) for i in range(n)]
+    topology = ring_topology(n) if args.topology == "ring" else mesh_topology(n)
+
+    if args.simulate:
+        seed = args.seed if args.seed is not None else random.randrange(2**32)
+        summary = Simulation(tick_list, seed=seed, folder=exp_folder, topology=topology, causal=args.causal, ordered=args.ordered, log_format=args.log_format, impair=impair, clock_type=args.clock).run()
+        print("Simulated {} with seed {}: {}".format(exp_folder, seed, summary))
+        sys.exit(0)
+
+    ports = VM_PORTS if n == len(VM_PORTS) else free_ports(n)
+    # every VM waits here once it listens, then all of them dial
+    ready = Barrier(len(ports))
+    if args.transport == "shm":
+        resource_tracker.ensure_running() # one tracker for the rings of every VM process
+
     #tick_list = [12,12,12]
     try: 
         ps = []
-        for i in range(len(VM_PORTS)):
-            tick = random.randint(1,6)
-            proc = Process(target=run_vm, args=(LOCAL_HOST, VM_PORTS, exp_folder, i, tick))
+        for i in range(len(ports)):
+            tick = tick_list[i]
+            control_port = None if args.control_port is None else args.control_port + i if args.control_port else 0
+            proc = Process(target=run_vm, args=(LOCAL_HOST, ports, exp_folder, i, tick, args.use_async, ready, topology),
+                           kwargs={"transport": args.transport, "metrics_every": args.metrics, "control_port": control_port, "profile": args.profile,
+                                   "coalesce": args.coalesce, "nodelay": not args.nagle, "causal": args.causal,
+                                   "ordered": args.ordered, "log_format": args.log_format, "impair": impair, "clock_type": args.clock})
             proc.start()
             ps.append(proc)
 
         
         # make sure the main threads wait, and the childs processes don't become ofans
-        time.sleep(70)
+        # every VM stops by itself after its 60 seconds, only one that hangs is terminated
+        deadline = time.monotonic() + 60 + 30
         for proc in ps:
+            proc.join(max(0, deadline - time.monotonic()))
+        hung = [proc for proc in ps if proc.is_alive()]
+        for proc in hung:
             proc.terminate()
-        print("All processes stopped naturally.")
+        print("All processes stopped naturally." if not hung else "{} processes did not stop and were terminated.".format(len(hung)))
 
     except KeyboardInterrupt: # if user decides to stop the processes in the middle
         for proc in ps:
@@ -0,0 +1,276 @@
+"""
+Run the VMs of one experiment spread over several machines.
+A cluster spec is a JSON file naming the host:port of every VM, e.g.
+    {"vms": ["10.0.0.1:7000", "10.0.0.1:7001", "10.0.0.2:7000"], "barrier": "10.0.0.1:6999",
+     "ticks": [1, 2, 6], "topology": "ring", "total_time": 60, "vm": {"log_format": "binary"}}
+On every machine one launcher starts the VMs placed on it, one process each
+    python3 cluster.py spec.json --host 10.0.0.1
+    python3 cluster.py spec.json --vm 2
+The launcher on the host of the barrier also serves it. Every VM checks in once it listens,
+and all of them dial once everyone listens. Once all are connected the barrier hands out
+one wall clock time, a moment ahead, at which every VM starts ticking, so the clocks of
+all machines begin together as far as their system clocks agree.
+Locally, loopback addresses stand in for hosts (all of 127.0.0.0/8 reaches this machine
+on Linux), or network namespaces with their own addresses do
+    python3 cluster.py --local 12 --hosts 127.0.0.2 127.0.0.3 127.0.0.4 --duration 10
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import socket
+import argparse
+import datetime
+import threading
+import selectors
+from multiprocessing import Process, Queue
+
+from clock import VM, ring_topology, mesh_topology, free_ports
+
+
+def parse_address(text):
+    """
+    (host, port) of "host:port", IPv6 hosts in brackets like "[::1]:7000"
+    """
+    host, port = text.rsplit(":", 1)
+    return host.strip("[]"), int(port)
+
+
+def load_spec(spec):
+    """
+    A cluster spec from a JSON file, or an already loaded dict, with its defaults filled in
+    """
+    if not isinstance(spec, dict):
+        with open(spec) as f:
+            spec = json.load(f)
+    addresses = [parse_address(vm) for vm in spec["vms"]]
+    n = len(addresses)
+    topology = spec.get("topology", "ring")
+    if topology == "ring":
+        topology = ring_topology(n)
+    elif topology == "mesh":
+        topology = mesh_topology(n)
+    else:
+        topology = {int(i): targets for i, targets in topology.items()} # JSON keys are strings
+    ticks = spec.get("ticks") or [random.randint(1, 6) for _ in range(n)]
+    assert len(ticks) == n, "one tick rate per VM"
+    barrier = spec.get("barrier") or "{}:{}".format(addresses[0][0], addresses[0][1] - 1)
+    return {
+        "hosts": [host for host, _ in addresses],
+        "ports": [port for _, port in addresses],
+        "barrier": parse_address(barrier),
+        "ticks": ticks,
+        "topology": topology,
+        "total_time": spec.get("total_time", 60),
+        "vm": spec.get("vm", {}), # any other VM argument, the same for every VM
+    }
+
+
+def local_spec(n, hosts, **spec):
+    """
+    A spec of n VMs dealt round robin over local addresses standing in for hosts, on
+    ports free right now
+    """
+    per_host = (n + len(hosts) - 1) // len(hosts)
+    # the first host also serves the barrier
+    ports = {host: iter(free_ports(per_host + (host == hosts[0]), host)) for host in hosts}
+    vms = ["{}:{}".format(hosts[i % len(hosts)], next(ports[hosts[i % len(hosts)]])) for i in range(n)]
+    return dict(spec, vms=vms, barrier="{}:{}".format(hosts[0], next(ports[hosts[0]])))
+
+
+class BarrierServer():
+    """
+    A barrier over TCP for parties VMs on any machine. A VM waits by connecting and sending
+    one line with the round it waits in, and gets one line back once all parties wait in
+    that round: the wall clock time lead seconds ahead, the same for every VM
+    """
+
+    def __init__(self, address, parties, lead=0.5):
+        self.address = address
+        self.parties = parties
+        self.lead = lead
+        self.rounds = {} # round -> sockets waiting in it
+
+    def start(self):
+        self.server = socket.create_server(self.address)
+        self.stop_r, self.stop_w = socket.socketpair()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def serve(self):
+        sel = selectors.DefaultSelector()
+        sel.register(self.server, selectors.EVENT_READ)
+        sel.register(self.stop_r, selectors.EVENT_READ)
+        while True:
+            for key, _ in sel.select():
+                if key.fileobj is self.stop_r:
+                    sel.close()
+                    return
+                if key.fileobj is self.server:
+                    conn, _ = self.server.accept()
+                    sel.register(conn, selectors.EVENT_READ, b"")
+                    continue
+                conn = key.fileobj
+                sel.unregister(conn)
+                try:
+                    line = key.data + conn.recv(64)
+                except OSError:
+                    # a VM that reset its connection waits no more, the others still do
+                    conn.close()
+                    continue
+                if not line.endswith(b"\n"):
+                    if line and len(line) < 64:
+                        sel.register(conn, selectors.EVENT_READ, line) # the rest is on its way
+                    else:
+                        conn.close()
+                    continue
+                words = line.split()
+                if not words:
+                    conn.close()
+                    continue
+                waiting = self.rounds.setdefault(words[0], [])
+                waiting.append(conn)
+                if len(waiting) == self.parties:
+                    reply = "{!r}\n".format(time.time() + self.lead).encode()
+                    for conn in self.rounds.pop(words[0]):
+                        try:
+                            conn.sendall(reply)
+                        except OSError:
+                            pass
+                        conn.close()
+
+    def stop(self):
+        self.stop_w.send(b"x")
+        self.thread.join()
+        for waiting in self.rounds.values():
+            for conn in waiting:
+                conn.close()
+        for s in (self.server, self.stop_r, self.stop_w):
+            s.close()
+
+
+class NetBarrier():
+    """
+    One VM's end of a BarrierServer, with the wait() of multiprocessing.Barrier so
+    VM.connect takes it. Every wait is the next round, and returns the start time the
+    server handed out. A server that cannot be reached or does not answer in time
+    breaks the barrier
+    """
+
+    def __init__(self, address, index):
+        self.address = address
+        self.index = index
+        self.round = 0
+
+    def wait(self, timeout=None):
+        self.round += 1
+        deadline = time.monotonic() + (timeout if timeout is not None else 300)
+        while True:
+            try:
+                conn = socket.create_connection(self.address, timeout=max(0.01, deadline - time.monotonic()))
+                break
+            except OSError:
+                # the launcher serving the barrier may not have started yet
+                if time.monotonic() >= deadline:
+                    raise threading.BrokenBarrierError("no barrier at {}:{}".format(*self.address))
+                time.sleep(0.05)
+        with conn:
+            try:
+                conn.sendall("{} {}\n".format(self.round, self.index).encode())
+                conn.settimeout(max(0.01, deadline - time.monotonic()))
+                with conn.makefile() as f:
+                    return float(f.readline())
+            except (OSError, ValueError):
+                raise threading.BrokenBarrierError("barrier round {} did not complete".format(self.round))
+
+
+def run_cluster_vm(spec, index, folder, results=None, timeout=300):
+    """
+    One VM of the spec: listen, dial once every VM listens, then start ticking at the
+    time the barrier hands out once every VM is connected
+    """
+    barrier = NetBarrier(spec["barrier"], index)
+    vm = VM(spec["hosts"][index], spec["ports"], folder, index, spec["ticks"][index], total_time=spec["total_time"],
+            topology=spec["topology"], hosts=spec["hosts"], **dict({"console": False}, **spec["vm"]))
+    try:
+        vm.connect(barrier, timeout)
+        vm.work(start_at=barrier.wait(timeout))
+    finally:
+        vm.need_to_listen = False
+        vm.close_down()
+        if results is not None:
+            results.put(vm.summary())
+
+
+def launch(spec, folder, host=None, indices=None, serve=None, grace=30, timeout=300):
+    """
+    Start the VMs of spec on this machine, those at host or those in indices or else all
+    of them, and return their summaries once they finished. serve runs the barrier here,
+    by default when the barrier is at host or all VMs run here
+    """
+    spec = load_spec(spec)
+    if indices is None:
+        indices = [i for i, h in enumerate(spec["hosts"]) if host is None or h == host]
+    if serve is None:
+        serve = host is None and len(indices) == len(spec["hosts"]) or host == spec["barrier"][0]
+    os.makedirs(folder, exist_ok=True)
+    server = BarrierServer(spec["barrier"], len(spec["hosts"])).start() if serve else None
+    results = Queue()
+    procs = [Process(target=run_cluster_vm, args=(spec, i, folder, results, timeout)) for i in indices]
+    try:
+        for proc in procs:
+            proc.start()
+        # VMs wait for the whole cluster to connect, then run total_time
+        deadline = time.monotonic() + timeout + spec["total_time"] + grace
+        for proc in procs:
+            proc.join(max(0, deadline - time.monotonic()))
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        summaries = []
+        for _ in procs:
+            try:
+                summaries.append(results.get(timeout=1))
+            except queue.Empty:
+                break
+        return sorted(summaries, key=lambda vm: vm["vm"])
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the VMs of a cluster spec that are placed on this machine")
+    parser.add_argument("spec", nargs="?", help="cluster spec JSON file")
+    parser.add_argument("--host", help="run the VMs at this address of the spec")
+    parser.add_argument("--vm", type=int, nargs="+", help="run these VMs of the spec")
+    parser.add_argument("--local", type=int, metavar="N", help="write a spec of N VMs over --hosts and run all of them here")
+    parser.add_argument("--hosts", nargs="+", default=["127.0.0.1"], help="local addresses standing in for hosts with --local")
+    parser.add_argument("--ticks", type=int, nargs="+", help="clock rate of every VM with --local, random from 1 to 6 by default")
+    parser.add_argument("--duration", type=int, default=60, help="seconds every VM runs with --local")
+    parser.add_argument("--topology", choices=["ring", "mesh"], default="ring")
+    parser.add_argument("--out", help="log folder, logs/cluster_<time> by default")
+    args = parser.parse_args()
+    if (args.spec is None) == (args.local is None):
+        parser.error("give a spec file or --local N")
+
+    folder = args.out or os.path.join("logs", "cluster_" + datetime.datetime.now().strftime("%m_%d_%y_%H:%M:%S"))
+    os.makedirs(folder, exist_ok=True)
+    spec = args.spec
+    if args.local:
+        spec = local_spec(args.local, args.hosts, ticks=args.ticks, topology=args.topology, total_time=args.duration)
+        with open(os.path.join(folder, "cluster.json"), "w") as f:
+            json.dump(spec, f, indent=1)
+    try:
+        summaries = launch(spec, folder, host=args.host, indices=args.vm)
+    except KeyboardInterrupt:
+        sys.exit("Stopped by user, logs are in {}".format(folder))
+    started = [vm["started"] for vm in summaries if vm["started"] is not None]
+    for vm in summaries:
+        print("VM{} clock {} after {}/{} ticks, {:.1f} ticks/s".format(vm["vm"], vm["clock"], vm["ticks"], vm["total_ticks"], vm["achieved_rate"]))
+    if started:
+        print("{} VMs started within {:.1f} ms of each other, logs in {}".format(len(started), (max(started) - min(started)) * 1000, folder))
@@ -0,0 +1,197 @@
+"""
+Parameter sweeps of real logical clock experiments.
+Every combination of tick rates, die size (a tick sends with probability 3/die) and duration
+is one experiment of one process per VM. Each experiment gets its own listening sockets
+bound to port 0, so any number of them run side by side, and as many run at once as the
+cores allow. A result is collected the moment its VMs finish instead of after a fixed wait,
+and is appended to results.jsonl in the sweep folder.
+Run by
+    python3 sweep.py --ticks 116 136 166 --die 10 5 --duration 60 --repeat 3
+    python3 sweep.py --ticks 1,1,6 12,12,12 --duration 10 30 --simulate
+The experiment folders look like the ones in logs/, so analyze.py reads them as well.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import datetime
+from multiprocessing import Process, Queue
+from multiprocessing.connection import wait
+
+from clock import run_vm, run_simulations, LOCAL_HOST, ring_topology, mesh_topology
+
+
+def parse_ticks(text):
+    """
+    Tick rates of one experiment, "116" for single digit rates or "12,12,12"
+    """
+    return [int(t) for t in text.split(",")] if "," in text else [int(t) for t in text]
+
+
+def grid(ticks, dies=(10,), durations=(60,), repeat=1):
+    """
+    Every combination of tick rates, die size and duration, repeat times over
+    """
+    return [{"ticks": list(t), "die": die, "total_time": duration, "run": run}
+            for t in ticks for die in dies for duration in durations for run in range(repeat)]
+
+
+def folder_name(config):
+    # tick_116_random_up_10 like the experiments in logs/, plus the duration and run
+    ticks = config["ticks"]
+    rates = "".join(map(str, ticks)) if max(ticks) < 10 else "_".join(map(str, ticks))
+    return "tick_{}_random_up_{}_{}s_run{}".format(rates, config["die"], config["total_time"], config["run"])
+
+
+def listeners(n, host=LOCAL_HOST):
+    """
+    n sockets already listening on ports the OS picked. They are handed to the VM
+    processes, so no other experiment can take a port in between
+    """
+    socks = []
+    for _ in range(n):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind((host, 0))
+        s.listen(max(5, n))
+        socks.append(s)
+    return socks
+
+
+class Experiment():
+    """
+    The VM processes of one configuration and the queue they report their summaries on
+    """
+
+    def __init__(self, config, folder, host=LOCAL_HOST, topology="ring", use_async=False, grace=30):
+        self.config = config
+        self.folder = folder
+        self.host = host
+        self.topology = topology
+        self.use_async = use_async
+        self.grace = grace # seconds past total_time before a hung VM is terminated
+
+    def start(self):
+        os.makedirs(self.folder, exist_ok=True)
+        ticks = self.config["ticks"]
+        n = len(ticks)
+        topology = ring_topology(n) if self.topology == "ring" else mesh_topology(n)
+        socks = listeners(n, self.host)
+        ports = [s.getsockname()[1] for s in socks]
+        self.results = Queue()
+        self.procs = []
+        for i, tick in enumerate(ticks):
+            # every peer already listens, so VMs dial at once without a barrier
+            proc = Process(target=run_vm, args=(self.host, ports, self.folder, i, tick, self.use_async, None, topology, self.results),
+                           kwargs={"total_time": self.config["total_time"], "die": self.config["die"], "listener": socks[i], "console": False})
+            proc.start()
+            self.procs.append(proc)
+        # the children hold their own copies
+        for s in socks:
+            s.close()
+        self.started = time.monotonic()
+        self.deadline = self.started + self.config["total_time"] + self.grace
+
+    @property
+    def sentinels(self):
+        return [proc.sentinel for proc in self.procs]
+
+    def done(self):
+        return not any(proc.is_alive() for proc in self.procs)
+
+    def collect(self):
+        """
+        Join the processes, terminating any still running, and build the result
+        """
+        hung = [proc for proc in self.procs if proc.is_alive()]
+        for proc in hung:
+            proc.terminate()
+        for proc in self.procs:
+            proc.join()
+        vms = []
+        for _ in self.procs:
+            try:
+                vms.append(self.results.get(timeout=1))
+            except queue.Empty:
+                break
+        vms.sort(key=lambda vm: vm["vm"])
+        # ok when every VM stopped by itself and reported, complete when each also ran all its ticks
+        ok = not hung and len(vms) == len(self.procs) and all(proc.exitcode == 0 for proc in self.procs)
+        complete = ok and all(vm["ticks"] == vm["total_ticks"] for vm in vms)
+        return dict(self.config, folder=self.folder, ok=ok, complete=complete, wall=time.monotonic() - self.started,
+                    exitcodes=[proc.exitcode for proc in self.procs], vms=vms)
+
+
+def sweep(configs, root, jobs=None, host=LOCAL_HOST, topology="ring", use_async=False, grace=30):
+    """
+    Run every configuration as a real experiment under root, yielding results in the order
+    they finish. jobs caps the experiments running at once, by default so that there is no
+    more than one VM process per core, but always at least one experiment
+    """
+    pending = list(configs)
+    if jobs is None:
+        most = max(len(config["ticks"]) for config in pending) if pending else 1
+        jobs = max(1, (os.cpu_count() or 1) // most)
+    running = []
+    while pending or running:
+        while pending and len(running) < jobs:
+            config = pending.pop(0)
+            experiment = Experiment(config, os.path.join(root, folder_name(config)), host, topology, use_async, grace)
+            experiment.start()
+            running.append(experiment)
+        # sleep until any VM process exits or the earliest experiment is overdue
+        timeout = max(0, min(e.deadline for e in running) - time.monotonic())
+        wait([s for e in running for s in e.sentinels], timeout)
+        now = time.monotonic()
+        for experiment in [e for e in running if e.done() or now >= e.deadline]:
+            running.remove(experiment)
+            yield experiment.collect()
+
+
+def simulate_grid(configs, workers=None, topology="ring"):
+    """
+    The same sweep in virtual time, each run seeded by its run number
+    """
+    sims = [{"ticks": config["ticks"], "total_time": config["total_time"], "seed": config["run"], "die": config["die"],
+             "topology": ring_topology(len(config["ticks"])) if topology == "ring" else mesh_topology(len(config["ticks"]))}
+            for config in configs]
+    return [dict(config, ok=True, complete=True, simulated=summary) for config, summary in zip(configs, run_simulations(sims, workers))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep logical clock experiments over a grid of parameters")
+    parser.add_argument("--ticks", type=parse_ticks, nargs="+", default=[[1, 1, 6]], help="tick rates of the VMs of one experiment, e.g. 116 or 12,12,12")
+    parser.add_argument("--die", type=int, nargs="+", default=[10], help="sides of the die, a tick sends with probability 3/die")
+    parser.add_argument("--duration", type=int, nargs="+", default=[60], help="seconds every experiment runs")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of every combination")
+    parser.add_argument("-j", "--jobs", type=int, help="experiments at once, one VM process per core by default")
+    parser.add_argument("--topology", choices=["ring", "mesh"], default="ring")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run every VM on an asyncio event loop")
+    parser.add_argument("--simulate", action="store_true", help="run the grid in virtual time without sockets")
+    parser.add_argument("--out", help="sweep folder, logs/sweep_<time> by default")
+    args = parser.parse_args()
+
+    configs = grid(args.ticks, args.die, args.duration, args.repeat)
+    root = args.out or os.path.join("logs", "sweep_" + datetime.datetime.now().strftime("%m_%d_%y_%H:%M:%S"))
+    os.makedirs(root, exist_ok=True)
+    start = time.monotonic()
+    if args.simulate:
+        results = simulate_grid(configs, args.jobs, args.topology)
+    else:
+        results = sweep(configs, root, args.jobs, topology=args.topology, use_async=args.use_async)
+
+    failed = 0
+    try:
+        with open(os.path.join(root, "results.jsonl"), "a") as f:
+            for done, result in enumerate(results, 1):
+                f.write(json.dumps(result) + "\n")
+                f.flush()
+                failed += not result["ok"]
+                clocks = result["simulated"]["clocks"] if args.simulate else [vm["clock"] for vm in result["vms"]]
+                print("[{}/{}] ticks {} die {} {}s run {}: clocks {}{}".format(
+                    done, len(configs), result["ticks"], result["die"], result["total_time"], result["run"], clocks, "" if result["complete"] else " stopped early" if result["ok"] else " FAILED"))
+    except KeyboardInterrupt:
+        sys.exit("Stopped by user, finished results are in {}".format(root))
+    print("{} experiments in {:.1f} s, {} failed, results in {}".format(len(configs), time.monotonic() - start, failed, root))
@@ -4,9 +4,108 @@ import unittest
 import socket
 import time
 from clock import setup_logger
-from clock import VM
+from clock import VM, AsyncVM, Link, Impairment, DelayLine, impairments
+from clock import encode_frame, FrameDecoder, Message, ProtocolError, MSG_CLOCK, MSG_HELLO, MSG_ORDERED, MSG_ACK
+from clock import ring_topology, mesh_topology, graph_topology, free_ports
+from clock import TickScheduler, Histogram, Metrics, MetricsServer, Sampler, CausalOrder, TotalOrder
+from clock import TRANSPORTS, ShmTransport, ShmRing
+from clock import Simulation, run_simulations
+import analyze
+import sweep
+import cluster
+from clock import LamportClock, VectorClock, MatrixClock, VEC_HEADER, VEC_FULL, VEC_DELTA
+from clock import HybridClock, HLC_COUNTER_BITS, hlc_from_time, hlc_time, hlc_counter
+from clock import TRACE_HEADER, TRACE_RECORD, TRACE_EVENTS
 import threading
-from multiprocessing import Process
+import asyncio
+import random
+import json
+import struct
+import sys
+import select
+import shutil
+import glob
+import atexit
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import Process, Queue, Barrier
+
+
+# Every test process writes its logs to a folder of its own and every test binds ports the
+# OS picked, so test processes can run side by side, under test.py -j or pytest-xdist.
+# Set TEST_LOGS to keep the logs
+if os.environ.get("TEST_LOGS"):
+    TEST_LOGS = os.path.join(os.environ["TEST_LOGS"], str(os.getpid()))
+else:
+    TEST_LOGS = tempfile.mkdtemp(prefix="clock_test_")
+    atexit.register(shutil.rmtree, TEST_LOGS, True)
+
+
+def logs(*parts):
+    """
+    A log folder of this test process, made if needed
+    """
+    folder = os.path.join(TEST_LOGS, *parts)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def wait_until(condition, timeout=5):
+    """
+    Poll for state no event announces, failing once timeout seconds pass
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("still waiting after {} s".format(timeout))
+        time.sleep(0.001)
+
+
+def reset(sock):
+    # the peer answered with a reset, so the next write on sock fails
+    poller = select.poll()
+    poller.register(sock, 0) # errors and hang ups are always reported
+    return any(events & (select.POLLERR | select.POLLHUP) for _, events in poller.poll(0))
+
+
+def wire(vms):
+    """
+    Link the VMs along their topology without connect(), by loopback TCP pairs made on
+    one port the OS picked. TCP packs small frames, so a VM that stopped reading at the
+    end of its run does not hold up a faster one as soon as a socket pair would
+    """
+    with socket.create_server(('127.0.0.1', 0)) as server:
+        for vm in vms:
+            for j in vm.dial:
+                near = socket.create_connection(server.getsockname())
+                far, _ = server.accept()
+                vm.add_peer(j, near)
+                vms[j].add_peer(vm.index, far)
+    for vm in vms:
+        vm.connected.set()
+
+
+def decode_one(frame):
+    # the single Message in frame
+    decoder = FrameDecoder()
+    decoder.feed(frame)
+    return next(decoder.frames())
+
+
+class FakeClock():
+    """
+    Virtual monotonic time, sleep only moves the clock forward
+    """
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
 
 
 class VMTestIndividual(unittest.TestCase):
@@ -18,21 +117,19 @@ class VMTestIndividual(unittest.TestCase):
     """
     def setUp(self):
 
-        if not os.path.exists('logs/test/'):
-            os.makedirs('logs/test/')
-
-        self.vm0 = VM('127.0.0.1',[4096,4097, 4098],'logs/test/',0, 1)
-        self.vm1 = VM('127.0.0.1',[4096,4097, 4098],'logs/test/',1, 2)
-        self.vm2 = VM('127.0.0.1',[4096,4097, 4098],'logs/test/',2, 6)
+        self.ports = free_ports(3)
+        self.vm0 = VM('127.0.0.1',self.ports,logs(),0, 1)
+        self.vm1 = VM('127.0.0.1',self.ports,logs(),1, 2)
+        self.vm2 = VM('127.0.0.1',self.ports,logs(),2, 6)
         
     
     def test_instantiation(self):
         """
         Testing VM object instantiation
         """
-        self.assertEqual(self.vm0.port, 4096)
-        self.assertEqual(self.vm1.port, 4097)
-        self.assertEqual(self.vm2.port, 4098)
+        self.assertEqual(self.vm0.port, self.ports[0])
+        self.assertEqual(self.vm1.port, self.ports[1])
+        self.assertEqual(self.vm2.port, self.ports[2])
         
         self.assertIsNotNone(self.vm0.logger)
 
@@ -45,14 +142,10 @@ class VMTestIndividual(unittest.TestCase):
         test if the socket listening and successfully acquire a handle
         """
 
-        #print("Wait for the ports from last test to clear")
-        #time.sleep(15)
-        #print("Finished waiting for the ports from last test to clear")
-
         # when vm2 not listening, cannot connect
         out_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # when vm2 has not started to listen, vm1 cannot make connection
-        self.assertRaises(ConnectionRefusedError, out_s.connect,('127.0.0.1', 4098))    
+        self.assertRaises(ConnectionRefusedError, out_s.connect,('127.0.0.1', self.ports[2]))    
         #out_s.shutdown(socket.SHUT_RDWR)
         out_s.close()
         
@@ -60,14 +153,16 @@ class VMTestIndividual(unittest.TestCase):
         # starting vm2 listening, and make sure it is ready
         thread = threading.Thread(target=self.vm2.receive_socket)
         thread.start()
-        time.sleep(1)
-        # when vm2 listening, can connect now
+        self.assertTrue(self.vm2.listening.wait(5))
+        # when vm2 listening, can connect now and introduce itself as vm1
         out_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        out_s.connect(('127.0.0.1', 4098))
+        out_s.connect(('127.0.0.1', self.ports[2]))
+        out_s.sendall(encode_frame(1, 0, kind=MSG_HELLO))
         thread.join()
         
         # vm2 should now possess a socket handle
         self.assertIsInstance(self.vm2.in_s, type(out_s))
+        self.assertIs(self.vm2.peers[1], self.vm2.in_s)
 
         # clean up after testing
         out_s.shutdown(socket.SHUT_RDWR)
@@ -77,24 +172,24 @@ class VMTestIndividual(unittest.TestCase):
 
     def test_initiate_socket(self):
         
-        #print("Wait for the ports from last test to clear")
-        #time.sleep(15)
-        #print("Finished waiting for the ports from last test to clear")
         # before any server starts listening
         # initate_socket will catch ConnectionRefusedError
-        # and raise SystemExit instead
+        # and register VM1 with its link down instead, to dial again once work starts
         # this will also generate an error log
-        self.assertRaises(SystemExit, self.vm0.initiate_socket)
+        self.vm0.initiate_socket()
+        self.assertEqual(self.vm0.down, {1})
+        self.assertIsNone(self.vm0.peers[1])
         
         # now start a listening socket
         thread = threading.Thread(target=self.vm1.receive_socket)
         thread.start()
-        time.sleep(1)
+        self.assertTrue(self.vm1.listening.wait(5))
        
         # connect and test again
         self.vm0.initiate_socket()
         thread.join()
         self.assertIsInstance(self.vm0.out_s, type(self.vm1.in_s))
+        self.assertEqual(self.vm0.down, set())
 
         # clean up after testing
         self.vm0.close_down()
@@ -109,69 +204,64 @@ class VMTestListenSend(unittest.TestCase):
     """
     def setUp(self):
 
-        if not os.path.exists('logs/test/'):
-            os.makedirs('logs/test/')
-
-        self.vm0 = VM('127.0.0.1',[4099,4100, 4101],'logs/test/',0, 1)
-        self.vm1 = VM('127.0.0.1',[4099,4100, 4101],'logs/test/',1, 2)
-        self.vm2 = VM('127.0.0.1',[4099,4100, 4101],'logs/test/',2, 6)
+        self.ports = free_ports(3)
+        self.vm0 = VM('127.0.0.1',self.ports,logs(),0, 1)
+        self.vm1 = VM('127.0.0.1',self.ports,logs(),1, 2)
+        self.vm2 = VM('127.0.0.1',self.ports,logs(),2, 6)
 
 
     def test_listen(self):
         """
         The listen function maintains a socket that keep pushing msgs received to queue
         """
-        #print("Wait for the ports from last test to clear")
-        #time.sleep(15)
-        #print("Finished waiting for the ports from last test to clear")
-
-
         # starting vm2 receiving connection, and make sure it is ready
         thread = threading.Thread(target=self.vm2.receive_socket)
         thread.start()
-        time.sleep(1)
+        self.assertTrue(self.vm2.listening.wait(5))
         # when vm2 listening, can connect now
         send_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        send_s.connect(('127.0.0.1', 4101))
+        send_s.connect(('127.0.0.1', self.ports[2]))
+        send_s.sendall(encode_frame(1, 0, kind=MSG_HELLO))
         thread.join()
 
         
         # vm2 starts listening, but has not opened the start_listening switch 
         self.vm2.need_to_listen = False
-        threading.Thread(target=self.vm2.listen,args=(self.vm2.in_s,)).start()
+        idle = threading.Thread(target=self.vm2.listen,args=(self.vm2.in_s,))
+        idle.start()
         self.assertEqual(self.vm2.q.qsize(),0)
-        send_s.send("Message before listening".encode()) # this message is not going to be received yet
+        send_s.send(encode_frame(0, 1)) # this message is not going to be received yet
+        idle.join()
         self.assertEqual(self.vm2.q.qsize(),0)
 
         # now open the start_listening switch and try again
         self.vm2.need_to_listen = True
-        threading.Thread(target=self.vm2.listen,args=(self.vm2.in_s,)).start()
-        time.sleep(0.2) # wait for the listen to happen
+        listener = threading.Thread(target=self.vm2.listen,args=(self.vm2.in_s,))
+        listener.start()
         # now the previous message should appear in the queue
-        self.assertEqual(self.vm2.q.qsize(),1)
-        before_msg = self.vm2.q.get()
-        self.assertEqual(before_msg, "Message before listening")
-
-        # send messages and test
-        send_s.send("First message".encode())
-        time.sleep(0.2)
-        self.assertEqual(self.vm2.q.qsize(),1)
-        send_s.send("Second message:10".encode())
-        time.sleep(0.2)
-        self.assertEqual(self.vm2.q.qsize(),2)
-        
-        # message sent, now check vm2's queue
-        msg1 = self.vm2.q.get()
-        self.assertEqual(msg1, "First message")
-        msg2 = self.vm2.q.get()
-        self.assertEqual(msg2, "Second message:10")
+        before_msg = self.vm2.q.get(timeout=2)
+        self.assertEqual(before_msg, Message(MSG_CLOCK, 0, 1, b""))
+
+        # send messages and test, each one arrives on its own
+        send_s.send(encode_frame(0, 5))
+        msg1 = self.vm2.q.get(timeout=2)
+        self.assertEqual((msg1.sender, msg1.clock), (0, 5))
+        send_s.send(encode_frame(1, 10))
+        msg2 = self.vm2.q.get(timeout=2)
+        self.assertEqual((msg2.sender, msg2.clock), (1, 10))
+        self.assertEqual(self.vm2.q.qsize(),0)
+
+        # frames merged into one segment by TCP are still split into separate messages
+        send_s.send(encode_frame(0, 11) + encode_frame(0, 12) + encode_frame(0, 13))
+        self.assertEqual([self.vm2.q.get(timeout=2).clock for _ in range(3)], [11, 12, 13])
       
         # finally test how does the listening socket behave when the sending socket closes
         send_s.shutdown(socket.SHUT_RDWR)
         send_s.close()
-        self.assertEqual(self.vm2.q.qsize(),0)
         # stop the listening thread
         self.vm2.need_to_listen = False
+        listener.join()
+        self.assertEqual(self.vm2.q.qsize(),0)
         
         self.vm2.close_down()
 
@@ -181,14 +271,10 @@ class VMTestListenSend(unittest.TestCase):
         the primary puurose to test is robustness against failed listener
         """
 
-        #print("Wait for the ports from last test to clear")
-        #time.sleep(15)
-        #print("Finished waiting for the ports from last test to clear")
-
         # first start a listening socket from vm1
         thread = threading.Thread(target=self.vm1.receive_socket)
         thread.start()
-        time.sleep(1)
+        self.assertTrue(self.vm1.listening.wait(5))
        
         # connect and test again
         self.vm0.initiate_socket()
@@ -197,27 +283,30 @@ class VMTestListenSend(unittest.TestCase):
 
         # now vm1 starts to listen
         self.vm1.need_to_listen = True
-        threading.Thread(target=self.vm1.listen,args=(self.vm1.in_s,)).start()
+        listener = threading.Thread(target=self.vm1.listen,args=(self.vm1.in_s,))
+        listener.start()
         
         # vm0 sending message now
-        self.vm0.send("First Message:2", self.vm0.out_s)
-        time.sleep(0.2)
-        self.assertEqual(self.vm1.q.qsize(),1)
+        self.vm0.send(encode_frame(0, 2), self.vm0.out_s)
+        old_msg = self.vm1.q.get(timeout=2)
 
         # now test if vm1 breaks
         self.vm1.need_to_listen = False
         self.vm1.in_s.shutdown(socket.SHUT_RDWR)
+        listener.join()
+        self.vm1.in_s.close() # unless the listener saw the end of stream and closed it
 
         # immediate next send will not fail
-        self.vm0.send("A message that will never reach, but with no error", self.vm0.out_s)
+        self.vm0.send(encode_frame(0, 3), self.vm0.out_s)
         # verify only old message is there
-        old_msg = self.vm1.q.get()
-        self.assertEqual(old_msg,"First Message:2")
+        self.assertEqual(old_msg.clock, 2)
         self.assertEqual(self.vm1.q.qsize(),0)
         
-        time.sleep(0.2)
-        # the second send attempt will fail
-        self.assertRaises(SystemExit, self.vm0.send, "A message that will never reach, and with error", self.vm0.out_s)
+        # vm1 answers the frame with a reset
+        wait_until(lambda: reset(self.vm0.out_s))
+        # the second send attempt will fail, closing the socket without ending the VM
+        self.vm0.send(encode_frame(0, 4), self.vm0.out_s)
+        self.assertEqual(self.vm0.out_s.fileno(), -1)
 
         self.assertEqual(self.vm1.q.qsize(),0)
     
@@ -225,12 +314,1273 @@ class VMTestListenSend(unittest.TestCase):
         self.vm0.close_down()
         self.vm1.close_down()
 
-def test_vm_connect_helper(host, ports, exp_folder, index, tick):
-    # instantiate an object in the 
-    vm = VM(host=host, ports=ports, folder=exp_folder, index=index, tick=tick)
-    # 
-    vm.connect()
-    time.sleep(5)
+class FrameDecoderTest(unittest.TestCase):
+    """
+    Testing the wire protocol framing without sockets
+    """
+    def test_round_trip(self):
+        decoder = FrameDecoder()
+        decoder.feed(encode_frame(2, 17))
+        decoder.feed(encode_frame(1, 2**40, payload=b"\x01\x02"))
+        msgs = list(decoder.frames())
+        self.assertEqual(msgs, [Message(MSG_CLOCK, 2, 17, b""), Message(MSG_CLOCK, 1, 2**40, b"\x01\x02")])
+        self.assertEqual(decoder.start, 0)
+        self.assertEqual(decoder.end, 0)
+
+    def test_partial_frames(self):
+        # feed a stream of frames one byte at a time
+        data = b"".join(encode_frame(0, i) for i in range(50))
+        decoder = FrameDecoder(capacity=16)
+        clocks = []
+        for i in range(len(data)):
+            decoder.feed(data[i:i+1])
+            clocks.extend(msg.clock for msg in decoder.frames())
+        self.assertEqual(clocks, list(range(50)))
+
+    def test_large_payload_grows_buffer(self):
+        decoder = FrameDecoder(capacity=32)
+        decoder.feed(encode_frame(0, 1, payload=bytes(1000)))
+        msgs = list(decoder.frames())
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(len(msgs[0].payload), 1000)
+
+    def test_bad_version(self):
+        frame = bytearray(encode_frame(0, 1))
+        frame[4] = 99
+        decoder = FrameDecoder()
+        decoder.feed(frame)
+        self.assertRaises(ProtocolError, list, decoder.frames())
+
+    def test_recv_into(self):
+        a, b = socket.socketpair()
+        a.sendall(b"".join(encode_frame(1, i) for i in range(1000)))
+        a.close()
+        decoder = FrameDecoder(capacity=64)
+        clocks = []
+        while decoder.recv_into(b):
+            clocks.extend(msg.clock for msg in decoder.frames())
+        b.close()
+        self.assertEqual(clocks, list(range(1000)))
+
+
+class AsyncVMTest(unittest.TestCase):
+    """
+    Testing the asyncio runtime, all three VMs share one event loop in this test
+    """
+    def setUp(self):
+
+        ports = free_ports(3)
+        # a minute of ticks in virtual time
+        self.vms = [AsyncVM('127.0.0.1', ports, logs(), i, tick, total_time=60, timer=FakeClock()) for i, tick in enumerate([2, 3, 5])]
+
+    def test_connect_and_work(self):
+        async def scenario():
+            # connect in reverse order, retries replace the fixed sleep
+            await asyncio.gather(*[vm.connect() for vm in reversed(self.vms)])
+            for vm in self.vms:
+                self.assertIsInstance(vm.out_s, asyncio.StreamWriter)
+                self.assertIsInstance(vm.in_s, asyncio.StreamWriter)
+                self.assertEqual(len(vm.peers), 2)
+
+            # a frame written on vm0's outgoing stream reaches vm1
+            self.vms[1].need_to_listen = True
+            listener = asyncio.create_task(self.vms[1].listen(self.vms[1].readers[0]))
+            self.vms[0].send(encode_frame(0, 40), self.vms[0].out_s)
+            await self.vms[0].out_s.drain()
+            for _ in range(100):
+                if self.vms[1].q.qsize():
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(self.vms[1].q.get().clock, 40)
+            listener.cancel()
+
+            await asyncio.gather(*[vm.work() for vm in self.vms])
+            for vm in self.vms:
+                # the clock moves forward at least once every tick
+                self.assertEqual(vm.summary()["ticks"], 60 * vm.tick)
+                self.assertGreaterEqual(vm.clock, 60 * vm.tick)
+                await vm.close_down()
+
+        asyncio.run(scenario())
+
+
+class TransportTest(unittest.TestCase):
+    """
+    Unix domain sockets and shared memory rings under the same send and listen
+    """
+    def test_ring(self):
+        transport = ShmTransport(capacity=64)
+        port = free_ports(1)[0]
+        near, far = transport.create(port, port + 1), transport.attach(port + 1, port)
+        buf = memoryview(bytearray(256))
+        with self.assertRaises(BlockingIOError):
+            far.recv_into(buf)
+        # more than the capacity wraps around, the writer waits for the reader
+        data = bytes(range(200))
+        writer = threading.Thread(target=near.sendall, args=(data,))
+        writer.start()
+        got = bytearray()
+        while len(got) < len(data):
+            try:
+                n = far.recv_into(buf)
+                got += buf[:n]
+            except BlockingIOError:
+                time.sleep(0.001)
+        writer.join()
+        self.assertEqual(bytes(got), data)
+        # both directions, and end of stream once the writer closed
+        far.sendall(b"back")
+        self.assertEqual(near.recv_into(buf), 4)
+        near.sendall(b"last")
+        near.close()
+        self.assertEqual(far.recv_into(buf), 4)
+        self.assertEqual(far.recv_into(buf), 0)
+        with self.assertRaises(BrokenPipeError):
+            far.sendall(b"nobody reads")
+        far.close()
+        with self.assertRaises(FileNotFoundError):
+            ShmRing(transport.ring_name(port, port + 1))
+
+    def test_vms(self):
+        for name in ("tcp", "unix", "shm"):
+            ports = free_ports(2)
+            vms = [VM('127.0.0.1', ports, None, i, 1, transport=name, console=False) for i in range(2)]
+            threads = [threading.Thread(target=vm.connect, kwargs={"timeout": 5}) for vm in vms]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual([list(vm.peers) for vm in vms], [[1], [0]])
+            listeners = [threading.Thread(target=vm.listen, args=tuple(vm.peers.values())) for vm in vms]
+            for vm, listener in zip(vms, listeners):
+                vm.need_to_listen = True
+                listener.start()
+            # the same step as in work(), a three faced die always sends
+            vms[0].die = 3
+            vms[0].step(time.time())
+            vms[1].send(encode_frame(1, 7), vms[1].peers[0])
+            self.assertEqual(vms[1].q.get(timeout=2).sender, 0, name)
+            self.assertEqual(vms[0].q.get(timeout=2).clock, 7, name)
+            for vm in vms:
+                vm.need_to_listen = False
+            for listener in listeners:
+                listener.join()
+            for vm in vms:
+                vm.close_down()
+            if name == "unix":
+                self.assertFalse(os.path.exists(vms[1].transport.address(ports[1])))
+
+
+class ReconnectTest(unittest.TestCase):
+    """
+    Links to peers survive failures, frames wait in a bounded buffer and lost peers are dialed again
+    """
+    class Flaky():
+        def __init__(self, fail=False):
+            self.frames = []
+            self.fail = fail
+
+        def sendall(self, data):
+            if self.fail:
+                raise BrokenPipeError()
+            self.frames.append(bytes(data))
+
+    def test_link(self):
+        lost = []
+        bad = self.Flaky(fail=True)
+        link = Link(1, bad, capacity=3, on_lost=lambda peer, sock: lost.append((peer, sock)))
+        for clock in range(5):
+            link.sendall(encode_frame(0, clock))
+        # one report of the failure, and the oldest frames make room
+        self.assertEqual(lost, [(1, bad)])
+        self.assertEqual((len(link.pending), link.dropped), (3, 2))
+        # the held frames go out first and in order on the new socket
+        good = self.Flaky()
+        link.fresh = good
+        link.sendall(encode_frame(0, 5))
+        self.assertEqual(good.frames, [encode_frame(0, clock) for clock in (2, 3, 4, 5)])
+        # nothing goes out to a peer that said goodbye
+        link.gone = True
+        link.sendall(encode_frame(0, 6))
+        self.assertEqual((len(good.frames), link.dropped), (4, 3))
+
+    def test_deltas_survive_drops(self):
+        vms = [VM('127.0.0.1', [0, 0, 0], None, i, 1, console=False, clock_type="vector", outbox_size=2) for i in range(2)]
+        vms[0].add_peer(1, self.Flaky(fail=True))
+        other = VectorClock(3, 2)
+        other.internal()
+        stamp = other.send()
+        frames = []
+        for k in range(6):
+            if k == 1:
+                # VM0 learns of VM2 while its link to VM1 is down, the outbox drops the frame telling it
+                vms[0].engine.receive([Message(MSG_CLOCK, 2, stamp, other.payload(0))])
+            vms[0].engine.internal()
+            vms[0].peer_info[1].channel.sendall(vms[0].frame(vms[0].engine.send(), 1))
+        self.assertGreater(vms[0].peer_info[1].channel.dropped, 0)
+        good = self.Flaky()
+        vms[0].attach(1, good)
+        for _ in range(3):
+            vms[0].peer_info[1].channel.sendall(vms[0].frame(vms[0].engine.send(), 1))
+        for frame in good.frames:
+            vms[1].engine.receive([decode_one(frame)])
+        self.assertEqual(list(vms[1].engine.vector)[0::2], list(vms[0].engine.vector)[0::2])
+
+    def test_reconnect(self):
+        ports = free_ports(2)
+        vms = [VM('127.0.0.1', ports, None, i, 100, total_time=1, console=False, reconnect_backoff=(0.01, 0.1)) for i in range(2)]
+        threads = [threading.Thread(target=vm.connect, kwargs={"timeout": 5}) for vm in vms]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        workers = [threading.Thread(target=vm.work) for vm in vms]
+        for worker in workers:
+            worker.start()
+        wait_until(lambda: vms[1].m_received[0] > 0)
+        # a transient failure, VM1 drops its end of the link in the middle of the run
+        vms[1].peers[0].shutdown(socket.SHUT_RDWR)
+        wait_until(lambda: sum(vms[0].m_reconnects) and sum(vms[1].m_reconnects))
+        received = vms[1].m_received[0]
+        for worker in workers:
+            worker.join()
+        summaries = [vm.summary() for vm in vms]
+        for vm in vms:
+            vm.close_down()
+        # both clock loops ran every tick, and VM0 dialed VM1 again
+        self.assertEqual([summary["ticks"] for summary in summaries], [100, 100])
+        self.assertEqual([summary["reconnects"] for summary in summaries], [1, 1])
+        self.assertGreater(vms[1].m_received[0], received)
+
+
+class CoalesceTest(unittest.TestCase):
+    """
+    Frames to a peer batched into one write, and TCP_NODELAY set on purpose
+    """
+    def make_vm(self, coalesce):
+        vm = VM('127.0.0.1', [0, 0], None, 0, 100, die=3, log_level=logging.WARNING, console=False, coalesce=coalesce)
+        vm.add_peer(1, ReconnectTest.Flaky())
+        return vm
+
+    def test_one_write_per_tick(self):
+        vm = self.make_vm(0)
+        for _ in range(3):
+            vm.send(encode_frame(0, 1), vm.peer_info[1].channel)
+        self.assertEqual(vm.peers[1].frames, [])
+        vm.end_tick(time.monotonic() + 0.01)
+        self.assertEqual(vm.peers[1].frames, [encode_frame(0, 1) * 3])
+        self.assertEqual(vm.peer_info[1].channel.writes, 1)
+
+    def test_not_async(self):
+        # the asyncio loop writes every frame at once, so it refuses a window it would ignore
+        vm = AsyncVM('127.0.0.1', [0, 0], None, 0, 100, log_level=logging.WARNING, console=False, coalesce=0)
+        with self.assertRaises(AssertionError):
+            asyncio.run(vm.connect())
+
+    def test_window(self):
+        vm = self.make_vm(1000)
+        sink = vm.peers[1]
+        vm.step(time.time())
+        # the next tick comes well inside the window, the frame waits for it
+        vm.end_tick(time.monotonic() + 0.0002)
+        self.assertEqual(sink.frames, [])
+        vm.step(time.time())
+        # waiting for the tick after would keep the first frame past the window
+        vm.end_tick(vm.held_since + 0.001)
+        decoder = FrameDecoder()
+        decoder.feed(b"".join(sink.frames))
+        self.assertEqual((len(sink.frames), [msg.clock for msg in decoder.frames()]), (1, [0, 1]))
+        self.assertIsNone(vm.held_since)
+
+    def test_nodelay(self):
+        for nodelay in (True, False):
+            ports = free_ports(2)
+            vms = [VM('127.0.0.1', ports, None, i, 1, console=False, nodelay=nodelay) for i in range(2)]
+            threads = [threading.Thread(target=vm.connect, kwargs={"timeout": 5}) for vm in vms]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for vm in vms:
+                self.assertEqual(bool(vm.peers[1 - vm.index].getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)), nodelay)
+            for vm in vms:
+                vm.close_down()
+
+
+class ImpairmentTest(unittest.TestCase):
+    """
+    Delay, jitter, loss, reordering and bandwidth caps on the links of a VM
+    """
+    class Recorder():
+        def __init__(self):
+            self.got = []
+
+        def deliver(self, data):
+            self.got.append((time.monotonic(), data))
+
+    def test_due(self):
+        self.assertEqual(Impairment(delay=0.05).due(1.0, 16), 1.05)
+        # jittered frames keep their order
+        jittery = Impairment(delay=0.05, jitter=0.05, seed=1)
+        dues = [jittery.due(i * 0.001, 16) for i in range(1000)]
+        self.assertEqual(dues, sorted(dues))
+        self.assertGreater(len(set(dues)), 100)
+        for distribution in Impairment.DISTRIBUTIONS:
+            delays = [Impairment(delay=0.01, jitter=0.01, distribution=distribution, seed=i).sample() for i in range(200)]
+            self.assertGreaterEqual(min(delays), 0)
+        self.assertGreaterEqual(min(Impairment(delay=0.01, jitter=0.01, distribution="pareto", seed=i).sample() for i in range(200)), 0.01)
+        lossy = Impairment(loss=1)
+        self.assertEqual([lossy.due(0, 16) for _ in range(3)], [None] * 3)
+        self.assertEqual((lossy.lost, lossy.fifo), (3, False))
+        # a frame that overtakes skips the delay
+        self.assertEqual(Impairment(delay=1, reorder=1).due(2.0, 16), 2.0)
+        # 10 byte frames at 100 bytes per second leave one after the other
+        capped = Impairment(bandwidth=100)
+        self.assertEqual([round(capped.due(0, 10), 6) for _ in range(3)], [0.1, 0.2, 0.3])
+        # every link gets its own, and peers can be picked, also by JSON keys
+        links = impairments({"delay": 0.01}, [1, 2], seed=1)
+        self.assertIsNot(links[1], links[2])
+        self.assertEqual(sorted(impairments({"2": {"loss": 0.1}}, [1, 2])), [2])
+
+    def test_delay_line(self):
+        line = DelayLine().start()
+        recorder = self.Recorder()
+        start = time.monotonic()
+        far = Impairment(delay=60)
+        near = Impairment(delay=0.05)
+        # frames due much later stay in flight, those due soon still go out on time
+        for i in range(1000):
+            line.submit(far, recorder, b"late")
+        for i in range(100):
+            line.submit(near, recorder, bytes([i]))
+        wait_until(lambda: len(recorder.got) == 100)
+        self.assertGreaterEqual(recorder.got[0][0] - start, 0.05)
+        self.assertEqual([data for _, data in recorder.got], [bytes([i]) for i in range(100)])
+        self.assertEqual(len(line), 1000)
+        line.stop()
+        self.assertEqual((line.sent, len(line)), (100, 1000))
+
+    def test_vm(self):
+        vms = [VM('127.0.0.1', [0, 0], None, i, 10, console=False, die=3, impair={"delay": 0.05}) for i in range(2)]
+        wire(vms)
+        self.assertIsInstance(vms[0].peer_info[1].channel, Link)
+        vms[1].need_to_listen = True
+        listener = threading.Thread(target=vms[1].listen, args=tuple(vms[1].peers.values()))
+        listener.start()
+        vms[0].delays.start()
+        start = time.monotonic()
+        vms[0].step(time.time())
+        self.assertEqual(vms[1].q.get(timeout=2).sender, 0)
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        vms[1].need_to_listen = False
+        listener.join()
+        for vm in vms:
+            vm.close_down()
+        self.assertEqual(vms[0].summary()["in_flight"], 0)
+        # lost or reordered frames turn off delta payloads, and causal and total order need them in order
+        self.assertFalse(VM('127.0.0.1', [0, 0], None, 0, 1, console=False, clock_type="vector", impair={"loss": 0.1}).engine.delta)
+        with self.assertRaises(AssertionError):
+            VM('127.0.0.1', [0, 0], None, 0, 1, console=False, causal=True, impair={"reorder": 0.1})
+
+    def test_simulation(self):
+        clean = Simulation([1, 1, 6], total_time=60, seed=1).run()
+        lossy = Simulation([1, 1, 6], total_time=60, seed=1, impair={"loss": 0.5}).run()
+        self.assertEqual(lossy, Simulation([1, 1, 6], total_time=60, seed=1, impair={"loss": 0.5}).run())
+        self.assertGreater(sum(lossy["lost"]), 0)
+        self.assertEqual(clean["lost"], [0, 0, 0])
+        # half the messages from the fast VM never arrive, so the slow ones queue less
+        self.assertLess(sum(lossy["peak_queue"]), sum(clean["peak_queue"]))
+        # a delay longer than the run keeps every message in flight
+        late = Simulation([1, 1, 6], total_time=10, seed=1, impair={"delay": 100}).run()
+        self.assertEqual(late["clocks"], [10, 10, 60])
+
+
+class CausalTest(unittest.TestCase):
+    """
+    Messages held back until their causal past is delivered
+    """
+    def message(self, order, sender, to):
+        return Message(MSG_CLOCK, sender, 0, order.payload(to))
+
+    def test_holdback(self):
+        a, b, c = (CausalOrder(3, i) for i in range(3))
+        m1 = self.message(a, 0, 2)
+        m2 = self.message(a, 0, 1)
+        self.assertEqual([m.sender for m in b.deliver([m2], 0)], [0])
+        m3 = self.message(b, 1, 2)
+        # m3 overtook m1, which A sent before the message that caused m3
+        self.assertEqual(c.deliver([m3], 1000), [])
+        self.assertEqual(c.count_held, 1)
+        delivered = c.deliver([m1], 6000)
+        self.assertEqual([(m.sender, m.payload) for m in delivered], [(0, b""), (1, b"")])
+        self.assertEqual((c.count_held, c.held, c.waiting), (0, {}, {}))
+        self.assertEqual(c.delay.percentile(100), 7) # m3 waited 5 us, in the 4-7 bucket
+
+    def test_many_held(self):
+        a, b, c = (CausalOrder(3, i) for i in range(3))
+        first = self.message(a, 0, 2)
+        b.deliver([self.message(a, 0, 1)], 0)
+        later = [self.message(b, 1, 2) for _ in range(1000)]
+        self.assertEqual(c.deliver(later, 0), [])
+        self.assertEqual(c.count_held, 1000)
+        # only the oldest message of B waits on A, the rest wait behind it
+        self.assertEqual(c.waiting, {(0, 1): [1]})
+        self.assertEqual(len(c.deliver([first], 0)), 1001)
+        self.assertEqual(c.count_held, 0)
+
+    def test_simulation(self):
+        # the slow VM falls behind and jitter reorders messages across links
+        sim = Simulation([30, 20, 10], total_time=10, seed=2, jitter=0.3, topology=mesh_topology(3), causal=True, clock_type="vector", die=4)
+        sim.run()
+        for vm in sim.vms:
+            delivered = sum(vm.causal.deliv)
+            self.assertEqual(vm.causal.count_held + delivered + vm.q.qsize(), sum(vm.m_received))
+            self.assertEqual(vm.summary()["held"], vm.causal.count_held)
+        self.assertGreater(max(vm.metrics.histograms["holdback_depth"].max for vm in sim.vms), 0)
+
+    def test_no_lost_frames(self):
+        # a frame dropped from the outbox would leave everything after it held back
+        with self.assertRaises(AssertionError):
+            VM('127.0.0.1', [0, 0], None, 0, 1, console=False, causal=True, outbox_size=16)
+        with self.assertRaises(AssertionError):
+            VM('127.0.0.1', [0, 0], None, 0, 1, console=False, causal=True, queue_policy="drop_oldest", queue_size=4)
+        link = VM('127.0.0.1', [0, 0], None, 0, 1, console=False, causal=True).link(1, None)
+        for clock in range(2000):
+            link.sendall(encode_frame(0, clock))
+        self.assertEqual((len(link.pending), link.dropped), (2000, 0))
+        self.assertEqual(VM('127.0.0.1', [0, 0], None, 0, 1, console=False).link(1, None).pending.maxlen, 1024)
+
+
+class TotalOrderTest(unittest.TestCase):
+    """
+    Broadcasts delivered in one (clock, sender) order everywhere
+    """
+    def test_order(self):
+        order = []
+        total = TotalOrder(3, 0, on_deliver=lambda clock, sender: order.append((clock, sender)))
+        total.sent(4, 0)
+        total.receive([Message(MSG_ORDERED, 2, 4, b""), Message(MSG_ORDERED, 1, 6, b"")], 0)
+        # VM2 stamped the same clock as VM0's own message, the lower index goes first.
+        # The message of VM1 waits until VM2 can no longer send anything before it
+        self.assertEqual(total.deliver(0), 2)
+        self.assertEqual(total.owed, 2)
+        total.receive([Message(MSG_ACK, 2, 7, b"")], 0)
+        self.assertEqual(total.deliver(0), 1)
+        self.assertEqual(order, [(4, 0), (4, 2), (6, 1)])
+
+    def test_acks(self):
+        vm = VM('127.0.0.1', [0, 0, 0], None, 0, 10, die=3, log_level=logging.WARNING, console=False,
+                topology=mesh_topology(3), ordered=True)
+        for peer in (1, 2):
+            vm.add_peer(peer, ReconnectTest.Flaky())
+        vm.q.put(Message(MSG_ORDERED, 1, 5, b""))
+        vm.q.put(Message(MSG_ORDERED, 2, 5, b""))
+        vm.batch = 0
+        vm.step(time.time())
+        # both pulled in one tick, one acknowledgement stamped after them goes to each peer
+        for peer in (1, 2):
+            decoder = FrameDecoder()
+            decoder.feed(b"".join(vm.peers[peer].frames))
+            self.assertEqual([(msg.kind, msg.clock) for msg in decoder.frames()], [(MSG_ACK, 6)])
+        # each sender is past the stamp of the other one, so both are delivered
+        self.assertEqual((sum(vm.total.delivered), vm.total.owed), (2, 0))
+        with self.assertRaises(AssertionError):
+            # a ring of four leaves VM2 out
+            VM('127.0.0.1', [0, 0, 0, 0], None, 0, 10, console=False, ordered=True)
+        # a frame dropped from the queue or the outbox would hold back every later broadcast
+        with self.assertRaises(AssertionError):
+            VM('127.0.0.1', [0, 0], None, 0, 10, console=False, ordered=True, topology=mesh_topology(2), queue_policy="drop_oldest", queue_size=4)
+        with self.assertRaises(AssertionError):
+            VM('127.0.0.1', [0, 0], None, 0, 10, console=False, ordered=True, topology=mesh_topology(2), outbox_size=16)
+        link = VM('127.0.0.1', [0, 0], None, 0, 10, console=False, ordered=True, topology=mesh_topology(2)).link(1, None)
+        for clock in range(2000):
+            link.sendall(encode_frame(0, clock))
+        self.assertEqual((len(link.pending), link.dropped), (2000, 0))
+
+    def test_simulation(self):
+        for ack in ("tick", "message"):
+            sim = Simulation([30, 20, 10, 25], total_time=10, seed=1, jitter=0.05, topology=mesh_topology(4), ordered=True, ack=ack, batch=0)
+            orders = [[] for _ in sim.vms]
+            for vm, order in zip(sim.vms, orders):
+                vm.total.on_deliver = lambda clock, sender, order=order: order.append((clock, sender))
+            sim.run()
+            self.assertGreater(len(orders[0]), 10)
+            self.assertEqual(orders[0], sorted(orders[0]))
+            for order in orders[1:]:
+                self.assertEqual(order, orders[0])
+
+
+class TopologyTest(unittest.TestCase):
+    """
+    Testing topologies and the connection manager with more than three VMs
+    """
+    def test_topologies(self):
+        self.assertEqual(ring_topology(3), {0: [1], 1: [2], 2: [0]})
+        self.assertEqual(ring_topology(2), {0: [1], 1: []})
+        self.assertEqual(mesh_topology(3), {0: [1, 2], 1: [2], 2: []})
+        self.assertEqual(graph_topology(4, [(1, 0), (2, 3), (0, 1), (3, 3)]), {0: [1], 1: [], 2: [3], 3: []})
+
+    def test_mesh_connect(self):
+        n = 6
+        ports = free_ports(n)
+        vms = [VM('127.0.0.1', ports, logs(), i, 1, topology=mesh_topology(n)) for i in range(n)]
+        ready = threading.Barrier(n)
+        threads = [threading.Thread(target=vm.connect, args=(ready,)) for vm in vms]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for vm in vms:
+            self.assertEqual(sorted(vm.peers), [j for j in range(n) if j != vm.index])
+            # peers are ordered by ring distance starting at the next VM
+            self.assertEqual(vm.peer_order[0], (vm.index + 1) % n)
+
+        # a frame sent to a peer arrives tagged with the sender id
+        vms[4].send(encode_frame(4, 9), vms[4].peers[1])
+        vms[1].need_to_listen = True
+        listener = threading.Thread(target=vms[1].listen, args=tuple(vms[1].peers.values()))
+        listener.start()
+        msg = vms[1].q.get(timeout=2)
+        self.assertEqual((msg.sender, msg.clock), (4, 9))
+        vms[1].need_to_listen = False
+        listener.join()
+        for vm in vms:
+            vm.close_down()
+
+    def test_async_mesh_connect(self):
+        n = 12
+        ports = free_ports(n)
+        vms = [AsyncVM('127.0.0.1', ports, logs(), i, 1, topology=mesh_topology(n)) for i in range(n)]
+
+        async def scenario():
+            await asyncio.gather(*[vm.connect() for vm in vms])
+            for vm in vms:
+                self.assertEqual(len(vm.peers), n - 1)
+            for vm in vms:
+                await vm.close_down()
+
+        asyncio.run(scenario())
+
+
+class TickSchedulerTest(unittest.TestCase):
+    """
+    Testing the tick scheduler on a fake clock, with some rounds overrunning
+    """
+    def run_schedule(self, policy, work):
+        # work maps tick index to the seconds that round takes
+        clock = FakeClock()
+        sched = TickScheduler(10, 20, policy=policy, clock=clock, sleep=clock.sleep)
+        fired = []
+        for k in sched.ticks():
+            fired.append((k, round(clock.now - 100.0, 6)))
+            clock.now += work.get(k, 0.001)
+        return sched, fired
+
+    def test_no_drift(self):
+        sched, fired = self.run_schedule("catchup", {})
+        # every tick fires exactly on its deadline even though each round takes time
+        self.assertEqual(fired, [(k, round(k * 0.1, 6)) for k in range(20)])
+        self.assertEqual(sched.missed, 0)
+        self.assertEqual(sched.jitter_max, 0.0)
+
+    def test_catchup(self):
+        sched, fired = self.run_schedule("catchup", {3: 0.35})
+        self.assertEqual(len(fired), 20)
+        # the three late ticks run back to back, then the schedule is met again
+        self.assertEqual([t for k, t in fired if 4 <= k <= 6], [0.65, 0.651, 0.652])
+        self.assertEqual(fired[7], (7, 0.7))
+        self.assertEqual(sched.missed, 0)
+        # ticks 4 and 5 both started more than a whole tick late
+        self.assertEqual(sched.overruns, 2)
+
+    def test_skip(self):
+        sched, fired = self.run_schedule("skip", {3: 0.35})
+        # ticks 4 to 6 are dropped, tick 7 fires on time
+        self.assertEqual([k for k, t in fired], [0, 1, 2, 3] + list(range(7, 20)))
+        self.assertEqual(fired[4], (7, 0.7))
+        self.assertEqual(sched.missed, 3)
+
+    def test_coalesce(self):
+        sched, fired = self.run_schedule("coalesce", {3: 0.35})
+        # one late tick stands for ticks 4 and 5, tick 6 was due already and runs late too
+        self.assertEqual([k for k, t in fired], [0, 1, 2, 3] + list(range(6, 20)))
+        self.assertEqual(fired[4], (6, 0.65))
+        self.assertEqual(sched.missed, 2)
+        self.assertEqual(sched.stats()["ticks"], 18)
+
+    def test_stats(self):
+        sched, fired = self.run_schedule("catchup", {3: 0.35})
+        stats = sched.stats()
+        self.assertAlmostEqual(stats["achieved_rate"], 20 / 1.901, places=3)
+        self.assertAlmostEqual(stats["jitter_max"], 0.25)
+        self.assertGreaterEqual(stats["jitter_p99"], 0.2)
+
+
+class BatchedReceiveTest(unittest.TestCase):
+    """
+    Testing batched draining of the internal queue and the bounded queue policies,
+    messages are put in the queue directly so no sockets are involved
+    """
+    def make_vm(self, **kwargs):
+        vm = VM('127.0.0.1', [0, 0, 0], logs(), 0, 2, **kwargs)
+        vm.need_to_listen = True
+        return vm
+
+    def test_single_message_per_tick(self):
+        vm = self.make_vm()
+        for clock in [5, 9, 3]:
+            vm.enqueue(Message(MSG_CLOCK, 1, clock, b""))
+        vm.step(time.time())
+        self.assertEqual(vm.clock, 6)
+        self.assertEqual(vm.q.qsize(), 2)
+
+    def test_batch_folds_with_one_max(self):
+        vm = self.make_vm(batch=2)
+        for clock in [5, 9, 3]:
+            vm.enqueue(Message(MSG_CLOCK, 1, clock, b""))
+        vm.step(time.time())
+        self.assertEqual(vm.clock, 10)
+        self.assertEqual(vm.q.qsize(), 1)
+
+        vm = self.make_vm(batch=0)
+        for clock in [5, 9, 3]:
+            vm.enqueue(Message(MSG_CLOCK, 1, clock, b""))
+        vm.step(time.time())
+        self.assertEqual(vm.clock, 10)
+        self.assertEqual(vm.q.qsize(), 0)
+
+    def test_drop_oldest(self):
+        vm = self.make_vm(queue_size=3, queue_policy="drop_oldest")
+        for clock in range(10):
+            self.assertTrue(vm.enqueue(Message(MSG_CLOCK, 1, clock, b"")))
+        self.assertEqual(vm.dropped, 7)
+        self.assertEqual([m.clock for m in vm.drain()], [7])
+        self.assertEqual(vm.q.qsize(), 2)
+
+    def test_block(self):
+        vm = self.make_vm(queue_size=1)
+        self.assertTrue(vm.enqueue(Message(MSG_CLOCK, 1, 1, b"")))
+        # a full queue holds the listener back until the VM stops listening
+        stopper = threading.Timer(0.2, setattr, args=(vm, "need_to_listen", False))
+        stopper.start()
+        self.assertFalse(vm.enqueue(Message(MSG_CLOCK, 1, 2, b"")))
+        self.assertEqual(vm.q.qsize(), 1)
+
+    def test_depth_series(self):
+        vm = self.make_vm()
+        for clock in range(5):
+            vm.enqueue(Message(MSG_CLOCK, 1, clock, b""))
+        for _ in range(4):
+            vm.step(time.time())
+        # two ticks per second, depth is sampled before each tick drains one message
+        self.assertEqual(vm.depth_series, [(1, 5, 4, 0), (2, 3, 2, 0)])
+
+
+class HotLoopTest(unittest.TestCase):
+    """
+    The tick loop works from precomputed peers, a plan of rolls and a reused frame
+    """
+    class Sink():
+        def __init__(self):
+            self.frames = []
+
+        def sendall(self, data):
+            self.frames.append(bytes(data))
+
+    def make_vm(self, n, **kwargs):
+        vm = VM('127.0.0.1', [0] * (n + 1), None, 0, 4, log_level=logging.WARNING, console=False, seed=3, **kwargs)
+        for peer in range(1, n + 1):
+            vm.add_peer(peer, self.Sink())
+        return vm
+
+    def test_plan(self):
+        # in the ring of three, face 1 is the next VM and face 2 the previous one
+        vm = self.make_vm(2)
+        plan = vm.make_plan()
+        self.assertEqual([(event, peer and peer.index) for event, peer in plan[:4]], [("send", 1), ("send", 2), ("broadcast", None), ("internal", None)])
+        self.assertEqual(len(plan), 10)
+        # with more peers every face is worth one outcome per peer
+        plan = self.make_vm(5, die=5).make_plan()
+        self.assertEqual(len(plan), 25)
+        self.assertEqual(sorted(peer.index for event, peer in plan if event == "send"), sorted(list(range(1, 6)) * 2))
+        self.assertEqual(sum(event == "broadcast" for event, _ in plan), 5)
+        # no peers, nothing to send to
+        self.assertEqual(VM('127.0.0.1', [0], None, 0, 1, console=False).make_plan(), [("internal", None)])
+
+    def test_rolls(self):
+        vm = self.make_vm(8)
+        counts = {}
+        for _ in range(20000):
+            event, _ = vm.roll()
+            counts[event] = counts.get(event, 0) + 1
+        self.assertAlmostEqual(counts["send"] / 20000, 0.2, delta=0.02)
+        self.assertAlmostEqual(counts["broadcast"] / 20000, 0.1, delta=0.02)
+        # a new peer makes a new plan
+        vm.add_peer(9, self.Sink())
+        self.assertIsNone(vm.plan)
+
+    def test_frames(self):
+        vm = self.make_vm(2, die=3)
+        for _ in range(20):
+            vm.step(time.time())
+        frames = vm.peers[1].frames + vm.peers[2].frames
+        self.assertTrue(frames)
+        decoder = FrameDecoder()
+        for frame in vm.peers[1].frames:
+            decoder.feed(frame)
+        clocks = [msg.clock for msg in decoder.frames()]
+        # every stamp went out in its own frame, not the last one written into the buffer
+        self.assertEqual(clocks, sorted(set(clocks)))
+
+
+class MetricsTest(unittest.TestCase):
+    """
+    Testing the metrics registry of a VM and how its snapshots are published
+    """
+    def test_histogram(self):
+        h = Histogram("us")
+        for value in [0, 1, 3, 3, 100]:
+            h.observe(value)
+        snap = h.snapshot()
+        self.assertEqual((snap["count"], snap["max"], snap["mean"]), (5, 100, 107 / 5))
+        self.assertEqual(snap["buckets"], {0: 1, 1: 1, 3: 2, 127: 1})
+        self.assertEqual((h.percentile(50), h.percentile(99)), (3, 127))
+
+    def test_vm_counts(self):
+        vm = VM('127.0.0.1', [0, 0, 0], None, 0, 4, log_level=logging.WARNING, console=False, seed=5)
+        vm.need_to_listen = True
+        sinks = {peer: HotLoopTest.Sink() for peer in (1, 2)}
+        for peer, sink in sinks.items():
+            vm.add_peer(peer, sink)
+        for i in range(300):
+            if i % 4 == 0:
+                vm.enqueue(Message(MSG_CLOCK, 1 + i % 8 // 4, 1000 + i, b""))
+            vm.step(time.time())
+        snap = vm.metrics.snapshot()
+        counters, histograms = snap["counters"], snap["histograms"]
+        self.assertEqual(counters["sent"]["VM1"], len(sinks[1].frames))
+        self.assertEqual(counters["sent"]["VM2"], len(sinks[2].frames))
+        self.assertEqual(counters["received"], {"VM1": 38, "VM2": 37, "total": 75})
+        # every tick is one receive, send, broadcast or internal event
+        sends = len(set(sinks[1].frames) | set(sinks[2].frames))
+        self.assertEqual(histograms["clock_jump"]["count"] + sends + counters["internal"]["total"], 300)
+        self.assertEqual(counters["internal"].keys(), {"VM0", "total"})
+        self.assertEqual(histograms["queue_depth"]["count"], 300)
+        self.assertEqual(histograms["send_latency"]["count"], counters["sent"]["total"])
+        self.assertEqual(snap["gauges"]["clock"], vm.clock)
+        json.dumps(snap)
+
+    def test_publish(self):
+        metrics = Metrics(2)
+        metrics.counter("sent")[1] += 7
+        metrics.gauge("clock", lambda: 42)
+        path = os.path.join(logs(), 'metrics.json')
+        server = MetricsServer(metrics, path, port=0, interval=0.05).start()
+        try:
+            with socket.create_connection(('127.0.0.1', server.port)) as conn:
+                snap = json.loads(conn.makefile().readline())
+            self.assertEqual(snap["counters"]["sent"], {"VM1": 7, "total": 7})
+            self.assertEqual(snap["gauges"]["clock"], 42)
+            # the file is replaced whole, so it is complete once it exists
+            wait_until(lambda: os.path.exists(path))
+            with open(path) as f:
+                self.assertEqual(json.load(f)["gauges"]["clock"], 42)
+        finally:
+            server.stop()
+        server.stop()
+
+    def test_sampler(self):
+        sampler = Sampler(threading.get_ident(), interval=0.0005).start()
+        deadline = time.monotonic() + 0.2
+        while time.monotonic() < deadline:
+            sum(range(100))
+        sampler.stop()
+        top = sampler.top(3)
+        self.assertTrue(top)
+        self.assertIn("test_sampler", " ".join(line["where"] for line in top))
+
+
+class ClockEngineTest(unittest.TestCase):
+    """
+    Testing lamport, vector and matrix clock engines by passing messages between them by hand
+    """
+    def deliver(self, engines, sender, receiver):
+        stamp = engines[sender].send()
+        msg = Message(MSG_CLOCK, sender, stamp, engines[sender].payload(receiver))
+        engines[receiver].receive([msg])
+        return msg
+
+    def test_lamport(self):
+        a, b = LamportClock(2, 0), LamportClock(2, 1)
+        for _ in range(5):
+            a.internal()
+        msg = self.deliver([a, b], 0, 1)
+        # the message carries the clock before the send event
+        self.assertEqual(msg.clock, 5)
+        self.assertEqual(a.value, 6)
+        self.assertEqual(b.value, 6)
+        self.assertEqual(msg.payload, b"")
+
+    def test_vector(self):
+        engines = [VectorClock(3, i) for i in range(3)]
+        engines[0].internal()
+        self.deliver(engines, 0, 1)
+        self.deliver(engines, 1, 2)
+        self.assertEqual(list(engines[0].vector), [2, 0, 0])
+        self.assertEqual(list(engines[1].vector), [2, 2, 0])
+        self.assertEqual(list(engines[2].vector), [2, 2, 1])
+        # the lamport scalar is kept alongside
+        self.assertEqual(engines[2].value, 3)
+
+    def test_vector_delta_matches_full(self):
+        n = 64
+        delta = [VectorClock(n, i) for i in range(n)]
+        full = [VectorClock(n, i, delta=False) for i in range(n)]
+        rng = random.Random(7)
+        sizes = []
+        for _ in range(500):
+            sender, receiver = rng.sample(range(n), 2)
+            msg = self.deliver(delta, sender, receiver)
+            self.deliver(full, sender, receiver)
+            sizes.append(len(msg.payload))
+        for d, f in zip(delta, full):
+            self.assertEqual(d.vector, f.vector)
+        # on average deltas stay below the 8 bytes per entry of a full vector
+        self.assertLess(sum(sizes) / len(sizes), 8 * n)
+
+    def test_full_encoding_when_delta_is_larger(self):
+        engines = [VectorClock(4, i) for i in range(4)]
+        for j in (1, 2, 3):
+            self.deliver(engines, j, 0)
+        encoding, count = VEC_HEADER.unpack_from(engines[0].payload(1))
+        self.assertEqual((encoding, count), (VEC_FULL, 4))
+        encoding, count = VEC_HEADER.unpack_from(engines[0].payload(1))
+        self.assertEqual((encoding, count), (VEC_DELTA, 0))
+
+    def test_matrix(self):
+        engines = [MatrixClock(3, i) for i in range(3)]
+        self.deliver(engines, 0, 1)
+        self.deliver(engines, 1, 2)
+        self.assertEqual(list(engines[2].vector), [1, 2, 1])
+        # vm2 also learns what vm1 and vm0 had seen
+        self.assertEqual(list(engines[2].row(1)), [1, 2, 0])
+        self.assertEqual(list(engines[2].row(0)), [1, 0, 0])
+        # every vm has seen the first event of vm0, but vm0 has seen nothing of vm1
+        self.assertEqual(engines[2].min_known(0), 1)
+        self.assertEqual(engines[2].min_known(1), 0)
+        self.deliver(engines, 2, 0)
+        self.assertEqual(list(engines[0].row(2)), [1, 2, 2])
+        self.assertEqual(list(engines[0].vector), [2, 2, 2])
+        self.assertEqual(engines[0].min_known(1), 2)
+
+    def test_hybrid(self):
+        now = [1000.0]
+        a, b = HybridClock(2, 0, wall=lambda: now[0]), HybridClock(2, 1, wall=lambda: now[0])
+        # reading the clock counts no event
+        self.assertEqual(a.value, hlc_from_time(1000.0))
+        self.assertEqual(a.last, 0)
+        # events within one millisecond count up, and the message carries the send event
+        a.internal()
+        msg = self.deliver([a, b], 0, 1)
+        self.assertEqual(msg.clock, hlc_from_time(1000.0) + 1)
+        self.assertEqual(b.last, msg.clock + 1)
+        # a message from a clock 5 ms ahead pulls the receiver ahead as well
+        a.wall = lambda: now[0] + 0.005
+        msg = self.deliver([a, b], 0, 1)
+        self.assertEqual((hlc_time(b.last), hlc_counter(b.last)), (1000.005, 1))
+        self.assertLess(b.value, hlc_from_time(1000.006))
+        # once the wall clock passes it again, the counter starts over
+        now[0] += 0.01
+        b.internal()
+        self.assertEqual(b.last, hlc_from_time(1000.01))
+        # a full counter carries into the milliseconds
+        b.value = hlc_from_time(1000.01) + (1 << HLC_COUNTER_BITS) - 1
+        b.internal()
+        self.assertEqual(b.last, hlc_from_time(1000.011))
+
+    def test_vm_uses_engine(self):
+        vm = VM('127.0.0.1', [0, 0, 0], logs(), 0, 1, clock_type="vector")
+        other = VectorClock(3, 2)
+        other.internal()
+        stamp = other.send()
+        vm.q.put(Message(MSG_CLOCK, 2, stamp, other.payload(0)))
+        vm.step(time.time())
+        self.assertEqual(list(vm.engine.vector), [1, 0, 2])
+        self.assertEqual(vm.clock, 2)
+
+
+class EventLogTest(unittest.TestCase):
+    """
+    Testing the text and JSON lines event logs and the level switch
+    """
+    def setUp(self):
+
+        self.folder = logs('events')
+
+    def run_steps(self, **kwargs):
+        vm = VM('127.0.0.1', [0, 0, 0], self.folder, 0, 3, console=False, **kwargs)
+        vm.q.put(Message(MSG_CLOCK, 2, 7, b""))
+        start_time = time.time()
+        for _ in range(3):
+            vm.step(start_time)
+        vm.close_logs()
+        return vm
+
+    def test_text(self):
+        self.run_steps()
+        with open(os.path.join(self.folder, 'VM0_cr3.log')) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn("VM0_cr3 Received Message VM2:7 with queue size 0 and internal logic clock 0 at system time", lines[0])
+        self.assertIn("VM0_cr3 Internal Event with logical clock 8 at system time", lines[1])
+
+    def test_json(self):
+        self.run_steps(log_format="json")
+        with open(os.path.join(self.folder, 'VM0_cr3.jsonl')) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(events[0]["event"], "start")
+        self.assertEqual(events[0]["tick"], 3)
+        self.assertEqual([e["event"] for e in events[1:]], ["recv", "internal", "internal"])
+        self.assertEqual((events[1]["peer"], events[1]["msg_clock"], events[1]["clock"], events[1]["queue"]), (2, 7, 0, 0))
+        self.assertEqual([e["clock"] for e in events[2:]], [8, 9])
+        self.assertLessEqual(events[0]["t"], events[1]["t"])
+
+    def test_binary(self):
+        self.run_steps(log_format="binary")
+        with analyze.Trace(os.path.join(self.folder, 'VM0_cr3.trace')) as trace:
+            self.assertEqual((trace.vm, trace.tick, len(trace)), (0, 3, 3))
+            self.assertEqual(os.path.getsize(trace.path), TRACE_HEADER.size + 3 * TRACE_RECORD.size)
+            self.assertEqual([e[0] for e in trace.events()], ["recv", "internal", "internal"])
+            t, clock, msg_clock, qsize, peer, vm, event = trace.record(0)
+            self.assertEqual((clock, msg_clock, qsize, peer, vm, TRACE_EVENTS[event]), (0, 7, 0, 2, 0, "recv"))
+            self.assertEqual([trace.record(i)[1] for i in (1, 2)], [8, 9])
+
+    def test_disabled(self):
+        vm = self.run_steps(log_level=logging.WARNING)
+        self.assertIsNone(vm.events)
+        with open(os.path.join(self.folder, 'VM0_cr3.log')) as f:
+            self.assertEqual(f.read(), "")
+        # the clock still moves
+        self.assertEqual(vm.clock, 10)
+
+
+class TraceTest(unittest.TestCase):
+    """
+    Binary traces of a simulated run, read back, merged and queried
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = logs('trace')
+        os.makedirs(cls.folder + '/json', exist_ok=True)
+        Simulation([3, 2, 6], total_time=30, seed=3, folder=cls.folder, log_format="binary", epoch=1000.0).run()
+        Simulation([3, 2, 6], total_time=30, seed=3, folder=cls.folder + '/json', log_format="json", epoch=1000.0).run()
+
+    def test_same_as_json(self):
+        for name in ("VM0_cr3", "VM1_cr2", "VM2_cr6"):
+            self.assertEqual(list(analyze.events(self.folder + '/' + name + '.trace')), list(analyze.events(self.folder + '/json/' + name + '.jsonl')))
+        self.assertEqual(analyze.analyze_folder(self.folder)["vms"][2]["file"], "VM2_cr6.trace")
+
+    def test_merge_and_drift(self):
+        traces = [analyze.Trace(self.folder + '/' + name + '.trace') for name in ("VM0_cr3", "VM1_cr2", "VM2_cr6")]
+        merged = list(analyze.merge_traces(traces))
+        self.assertEqual(len(merged), sum(len(trace) for trace in traces))
+        self.assertEqual([e[0] for e in merged], sorted(e[0] for e in merged))
+        # the last event of VM2 in the first two seconds of the run
+        i = traces[2].at(round(1002 * 1e9))
+        self.assertEqual(traces[2].time(i), 2 * 10**9)
+        drift = analyze.trace_drift(traces)
+        self.assertEqual(drift["seconds"], 30)
+        self.assertEqual(set(drift["pairs"]), {"VM0-VM1", "VM0-VM2", "VM1-VM2"})
+        # VM2 sends more than it receives and runs at its own rate, the others jump ahead
+        self.assertLess(abs(drift["vms"][2]["final"]), 1)
+        self.assertGreater(drift["vms"][1]["final"], 10)
+        for trace in traces:
+            trace.close()
+
+    def test_hlc_window(self):
+        folder = logs('trace', 'hlc')
+        Simulation([1, 1, 6], total_time=30, seed=3, folder=folder, log_format="binary", clock_type="hlc", epoch=1000.0).run()
+        traces = [analyze.Trace(folder + '/' + name + '.trace') for name in ("VM0_cr1", "VM1_cr1", "VM2_cr6")]
+        # every clock is the time of its event, however different the tick rates
+        for trace in traces:
+            for t, clock, *_ in trace.rows():
+                self.assertLess(abs(hlc_time(clock) - (t + trace.offset) / 1e9), 0.002)
+        window = list(analyze.hlc_window(traces, 1010, 1012))
+        expected = sorted((clock, trace.vm) for trace in traces for _, clock, *_ in trace.rows()
+                          if hlc_from_time(1010) <= clock < hlc_from_time(1012))
+        self.assertEqual([e[:2] for e in window], expected)
+        self.assertEqual({e[1] for e in window}, {0, 1, 2})
+        for trace in traces:
+            trace.close()
+
+    def test_cut_short(self):
+        with open(self.folder + '/VM0_cr3.trace', 'rb') as f:
+            data = bytearray(f.read())
+        path = self.folder + '/cut/VM0_cr3.trace'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # a writer that died after its first batch of 5 leaves reserved space past them
+        struct.pack_into("<Q", data, 32, 5)
+        with open(path, 'wb') as f:
+            f.write(data + bytes(1000 * TRACE_RECORD.size))
+        with analyze.Trace(path) as trace:
+            self.assertEqual(len(list(trace.events())), 5)
+        # a count past the end of a damaged file is cut to the records there are
+        struct.pack_into("<Q", data, 32, 10**6)
+        with open(path, 'wb') as f:
+            f.write(data[:TRACE_HEADER.size + 7 * TRACE_RECORD.size + 3])
+        with analyze.Trace(path) as trace:
+            self.assertEqual(len(trace), 7)
+
+    def test_close_with_views(self):
+        trace = analyze.Trace(self.folder + '/VM0_cr3.trace')
+        # like a slice of records, a view of the mapping outlives close()
+        view = memoryview(trace.map)[TRACE_HEADER.size:TRACE_HEADER.size + TRACE_RECORD.size]
+        trace.close()
+        self.assertEqual(TRACE_RECORD.unpack(view), trace.record(0))
+        view.release()
+
+
+class AnalyzeTest(unittest.TestCase):
+    """
+    Testing the log analyzer on a small hand written experiment and a shipped one
+    """
+    def setUp(self):
+        self.folder = logs('analyze')
+        with open(self.folder + '/VM0_cr2.log', 'w') as f:
+            f.write("""2023-03-09 21:45:36,132 : VM0_cr2 listening on port 4096
+2023-03-09 21:45:39,000 : VM0_cr2 Send Message VM0_cr2:0 to VM1 at system time 0.000
+2023-03-09 21:45:39,500 : VM0_cr2 Internal Event with logical clock 1 at system time 0.500
+2023-03-09 21:45:40,000 : VM0_cr2 send message VM0_cr2:2 to all other VMs at system time 1.000
+2023-03-09 21:45:40,500 : VM0_cr2 Internal Event with logical clock 3 at system time 1.500
+""")
+        with open(self.folder + '/VM1_cr1.log', 'w') as f:
+            f.write("""2023-03-09 21:45:39,000 : VM1_cr1 Internal Event with logical clock 0 at system time 0.000
+2023-03-09 21:45:40,020 : VM1_cr1 Received Message VM0_cr2:0 with queue size 1 and internal logic clock 1 at system time 1.020
+2023-03-09 21:45:41,050 : VM1_cr1 Received Message VM0:2 with queue size 0 and internal logic clock 2 at system time 2.050
+2023-03-09 21:45:42,000 : VM1_cr1 Received Message 9 with queue size 0 and internal logic clock 3 at system time 3.000
+""")
+
+    def test_vm(self):
+        summary = analyze.analyze_folder(self.folder)
+        vm0, vm1 = summary["vms"]
+        self.assertEqual(vm0["events"], {"send": 2, "internal": 2})
+        self.assertEqual(vm0["jumps"], {1: 3})
+        self.assertEqual(vm0["final_clock"], 4)
+        self.assertEqual(vm1["events"], {"internal": 1, "recv": 3, "recv unattributed": 1})
+        # the message stamped 9 moves the clock from 3 to 10
+        self.assertEqual(vm1["jumps"], {1: 2, 7: 1})
+        self.assertEqual(vm1["queue_sizes"], {0: 2, 1: 1})
+        self.assertEqual(vm1["rate"], 1)
+
+    def test_latency_and_drift(self):
+        summary = analyze.analyze_folder(self.folder)
+        self.assertEqual(summary["latency"], {"VM0->VM1": {"messages": 2, "ms": {50: 1020, 90: 1050, 99: 1050}}})
+        # at second :40 vm0 is at 4, vm1 at 2
+        self.assertEqual(summary["drift"]["VM0-VM1"]["seconds"], 2)
+        self.assertEqual(summary["drift"]["VM0-VM1"]["final"], 2)
+
+    def test_json_events(self):
+        folder = logs('analyze', 'json')
+        vm = VM('127.0.0.1', [0, 0, 0], folder, 0, 3, console=False, log_format="json")
+        vm.q.put(Message(MSG_CLOCK, 2, 7, b""))
+        for _ in range(3):
+            vm.step(time.time())
+        vm.close_logs()
+        summary = analyze.analyze_folder(folder)
+        self.assertEqual(summary["vms"][0]["file"], "VM0_cr3.jsonl")
+        self.assertEqual(summary["vms"][0]["jumps"], {1: 2})
+        self.assertEqual(summary["vms"][0]["final_clock"], 10)
+
+    @unittest.skipIf(analyze.numpy is None, "needs numpy")
+    def test_columns_match_rows(self):
+        folder = logs('analyze', 'columns')
+        os.makedirs(folder + '/json', exist_ok=True)
+        Simulation([3, 2, 6], total_time=20, seed=5, folder=folder, log_format="binary", epoch=1678400000.0).run()
+        Simulation([3, 2, 6], total_time=20, seed=5, folder=folder + '/json', log_format="json", epoch=1678400000.0).run()
+        paths = glob.glob(self.folder + '/*.log') + glob.glob('logs/tick_116_random_up_10/*.log') + glob.glob(folder + '/*.trace') + glob.glob(folder + '/json/*.jsonl')
+        self.assertEqual(len(paths), 11)
+        for path in paths:
+            # also across chunk boundaries
+            for chunk in (7, 65536):
+                self.assertEqual(analyze._column_stats(path, chunk), analyze._row_stats(path))
+
+    def test_shipped_logs(self):
+        summary = analyze.analyze_folder('logs/tick_116_random_up_10')
+        self.assertEqual([vm["rate"] for vm in summary["vms"]], [1, 1, 6])
+        # the two slow VMs build up a queue
+        self.assertGreater(max(summary["vms"][0]["queue_sizes"]), 40)
+        self.assertEqual(analyze.find_folders(['logs/tick_116_random_up_10']), ['logs/tick_116_random_up_10'])
+
+
+class SimulationTest(unittest.TestCase):
+    """
+    Testing the discrete event simulation, which runs in virtual time
+    """
+    def test_deterministic(self):
+        first = Simulation([1, 1, 6], seed=11).run()
+        self.assertEqual(Simulation([1, 1, 6], seed=11).run(), first)
+        self.assertNotEqual(Simulation([1, 1, 6], seed=12).run()["clocks"], first["clocks"])
+        # the fast VM ticks 360 times, so its clock is at least 360
+        self.assertGreaterEqual(first["clocks"][2], 360)
+        self.assertGreater(first["messages"], 0)
+
+    def test_fast(self):
+        start = time.perf_counter()
+        Simulation([1, 3, 6], total_time=60, seed=1).run()
+        self.assertLess(time.perf_counter() - start, 1.0)
+
+    def test_fifo_links(self):
+        sim = Simulation([6, 6], total_time=1, seed=1, delay=0.01, jitter=0.5)
+        for clock in range(20):
+            sim.transmit(0, 1, encode_frame(0, clock))
+        times = [t for t, kind, _, vm, frame in sorted(sim.heap)]
+        clocks = [decode_one(frame).clock for t, kind, _, vm, frame in sorted(sim.heap)]
+        self.assertEqual(clocks, list(range(20)))
+        self.assertEqual(times, sorted(times))
+
+    def test_full_queue(self):
+        folder = logs('sim', 'full')
+        results = []
+        # a slow VM with room for one message, the frames it has no room for wait on their link
+        run = threading.Thread(target=lambda: results.append(Simulation([1, 6], total_time=5, seed=1, queue_size=1, die=3,
+                                                                         folder=folder, log_format="binary").run()), daemon=True)
+        run.start()
+        run.join(10)
+        self.assertFalse(run.is_alive())
+        self.assertGreater(results[0]["in_flight"][0], 0)
+        # and reach it in the order they were sent
+        with analyze.Trace(folder + '/VM0_cr1.trace') as trace:
+            received = [msg_clock for _, _, msg_clock, _, peer, _, event in trace.rows() if TRACE_EVENTS[event] == "recv"]
+        self.assertGreater(len(received), 1)
+        self.assertEqual(received, sorted(set(received)))
+
+    def test_logs_match_real_format(self):
+        folder = logs('sim')
+        summary = Simulation([2, 3, 5], total_time=10, seed=4, folder=folder, epoch=1678400000.0).run()
+        result = analyze.analyze_folder(folder)
+        self.assertEqual([vm["final_clock"] for vm in result["vms"]], summary["clocks"])
+        self.assertAlmostEqual(result["vms"][2]["duration"], 9.8, places=1)
+        with open(folder + '/VM0_cr2.log') as f:
+            self.assertTrue(f.readline().startswith(time.strftime("%Y-%m-%d", time.localtime(1678400000.0))))
+
+    def test_process_pool(self):
+        configs = [{"ticks": [1, 2, 3], "total_time": 5, "seed": seed} for seed in range(8)]
+        self.assertEqual(run_simulations(configs, workers=2), [Simulation(**config).run() for config in configs])
+
+
+class SweepTest(unittest.TestCase):
+    """
+    Parameter sweeps of real experiments on ports bound to port 0
+    """
+    def test_grid(self):
+        configs = sweep.grid([[1, 1, 6], [12, 12, 12]], dies=[10, 5], durations=[30, 60], repeat=2)
+        self.assertEqual(len(configs), 16)
+        self.assertEqual(sweep.parse_ticks("116"), [1, 1, 6])
+        self.assertEqual(sweep.parse_ticks("12,12,12"), [12, 12, 12])
+        self.assertEqual(sweep.folder_name(configs[0]), "tick_116_random_up_10_30s_run0")
+        self.assertEqual(sweep.folder_name(configs[-1]), "tick_12_12_12_random_up_5_60s_run1")
+
+    def test_die(self):
+        # with three faces every tick without messages sends
+        busy = Simulation([2, 2, 2], total_time=10, seed=1, die=3).run()
+        quiet = Simulation([2, 2, 2], total_time=10, seed=1).run()
+        self.assertGreater(busy["messages"], quiet["messages"])
+
+    def test_parallel_experiments(self):
+        root = logs("sweep")
+        configs = sweep.grid([[5, 5, 5], [4, 4]], durations=[1])
+        start = time.monotonic()
+        results = list(sweep.sweep(configs, root, jobs=2))
+        # both ran at once and were collected as they finished, not after a fixed wait
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(sorted(len(result["ticks"]) for result in results), [2, 3])
+        for result in results:
+            self.assertTrue(result["ok"])
+            self.assertEqual([vm["vm"] for vm in result["vms"]], list(range(len(result["ticks"]))))
+            self.assertTrue(all(vm["clock"] > 0 for vm in result["vms"]))
+            self.assertTrue(os.path.exists(os.path.join(result["folder"], "VM0_cr{}.log".format(result["ticks"][0]))))
+
+
+class ClusterTest(unittest.TestCase):
+    """
+    VMs spread over several hosts, with loopback addresses standing in for the hosts
+    """
+    HOSTS = ["127.0.0.2", "127.0.0.3", "127.0.0.4"]
+
+    def test_spec(self):
+        spec = cluster.load_spec({"vms": ["10.0.0.1:7000", "10.0.0.2:7000", "[::1]:7002"], "ticks": [1, 2, 3],
+                                  "topology": {"0": [1, 2]}, "vm": {"log_format": "binary"}})
+        self.assertEqual(spec["hosts"], ["10.0.0.1", "10.0.0.2", "::1"])
+        self.assertEqual(spec["ports"], [7000, 7000, 7002])
+        self.assertEqual(spec["barrier"], ("10.0.0.1", 6999))
+        self.assertEqual((spec["topology"], spec["total_time"], spec["vm"]), ({0: [1, 2]}, 60, {"log_format": "binary"}))
+
+    def test_barrier(self):
+        server = cluster.BarrierServer(("127.0.0.1", free_ports(1)[0]), 3).start()
+        starts = [[] for _ in range(3)]
+
+        def wait(i):
+            barrier = cluster.NetBarrier(server.address, i)
+            for _ in range(2):
+                starts[i].append(barrier.wait(5))
+        threads = [threading.Thread(target=wait, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # every party gets the same start time in a round, and rounds do not mix
+        self.assertEqual(starts[0], starts[1])
+        self.assertEqual(starts[0], starts[2])
+        self.assertLess(starts[0][0], starts[0][1])
+        # one party alone never gets through
+        with self.assertRaises(threading.BrokenBarrierError):
+            cluster.NetBarrier(server.address, 0).wait(0.2)
+        server.stop()
+
+    def test_barrier_reset(self):
+        server = cluster.BarrierServer(("127.0.0.1", free_ports(1)[0]), 2).start()
+        # a VM that dies half way through its line resets the connection
+        with socket.create_connection(server.address) as conn:
+            conn.sendall(b"1")
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        starts = []
+        threads = [threading.Thread(target=lambda i=i: starts.append(cluster.NetBarrier(server.address, i).wait(5))) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(server.thread.is_alive())
+        self.assertEqual(len(starts), 2)
+        server.stop()
+
+    def test_launch_per_host(self):
+        # one launcher per host, as on separate machines, the first serves the barrier
+        spec = cluster.local_spec(6, self.HOSTS, ticks=[5] * 6, topology="mesh", total_time=1)
+        summaries = {}
+
+        def launch(host):
+            summaries[host] = cluster.launch(spec, logs("cluster"), host=host, timeout=30)
+        threads = [threading.Thread(target=launch, args=(host,)) for host in self.HOSTS]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([[vm["vm"] for vm in summaries[host]] for host in self.HOSTS], [[0, 3], [1, 4], [2, 5]])
+        vms = [vm for host in self.HOSTS for vm in summaries[host]]
+        self.assertTrue(all(vm["ticks"] == vm["total_ticks"] == 5 for vm in vms))
+        started = [vm["started"] for vm in vms]
+        self.assertLess(max(started) - min(started), 0.1)
+        with open(os.path.join(logs("cluster"), "VM0_cr5.log")) as f:
+            self.assertIn("connected to VM1 on 127.0.0.3", f.read())
+
+
+def connect_helper(host, ports, listener, exp_folder, index, tick, results, done):
+    # every VM listens already, so it dials at once, and keeps its links until all reported
+    vm = VM(host=host, ports=ports, folder=exp_folder, index=index, tick=tick, listener=listener, console=False)
+    vm.connect(timeout=10)
+    results.put((index, sorted(vm.peers)))
+    done.wait(10)
     vm.close_down()
 
 
@@ -243,21 +1593,101 @@ class VMTestConnect(unittest.TestCase):
     """
     def test_connect(self):
 
-        if not os.path.exists('logs/test/'):
-            os.makedirs('logs/test/')
-
-        vm_ports = [4102, 4103, 4104]
+        listeners = sweep.listeners(3)
+        vm_ports = [s.getsockname()[1] for s in listeners]
         local_host = "127.0.0.1"
+        results, done = Queue(), Barrier(3)
         ps = []
         for i in range(len(vm_ports)):
             tick = i + 1
-            proc = Process(target=test_vm_connect_helper, args=(local_host, vm_ports, 'logs/test/', i, tick))
+            proc = Process(target=connect_helper, args=(local_host, vm_ports, listeners[i], logs(), i, tick, results, done))
             proc.start()
             ps.append(proc)
-        
-        time.sleep(5)
+        for s in listeners:
+            s.close()
+
+        # every VM of the ring linked both neighbours
+        peers = dict(results.get(timeout=10) for _ in ps)
+        self.assertEqual(peers, {0: [1, 2], 1: [0, 2], 2: [0, 1]})
         for proc in ps:
-            proc.terminate()
+            proc.join(10)
+            self.assertEqual(proc.exitcode, 0)
+
+
+class WorkTest(unittest.TestCase):
+    """
+    The whole tick loop of work() in virtual time, on links made without connect()
+    """
+    def test_virtual_time(self):
+        ticks = [50, 30, 10]
+        vms = [VM('127.0.0.1', [0, 0, 0], None, i, tick, total_time=60, console=False, seed=i, timer=FakeClock()) for i, tick in enumerate(ticks)]
+        wire(vms)
+        self.assertEqual([sorted(vm.peers) for vm in vms], [[1, 2], [0, 2], [0, 1]])
+        start = time.monotonic()
+        workers = [threading.Thread(target=vm.work) for vm in vms]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # a minute of ticks in well under a second
+        self.assertLess(time.monotonic() - start, 5)
+        summaries = [vm.summary() for vm in vms]
+        for vm in vms:
+            vm.close_down()
+        self.assertEqual([summary["ticks"] for summary in summaries], [60 * tick for tick in ticks])
+        self.assertEqual([summary["missed"] for summary in summaries], [0, 0, 0])
+        self.assertTrue(all(sum(vm.m_received) > 0 for vm in vms))
+        self.assertTrue(all(vm.clock >= 60 * vm.tick for vm in vms))
+
+    def test_readiness(self):
+        ports = free_ports(2)
+        vms = [VM('127.0.0.1', ports, None, i, 1, console=False) for i in range(2)]
+        self.assertFalse(vms[1].listening.is_set())
+        threads = [threading.Thread(target=vm.connect, kwargs={"timeout": 5}) for vm in vms]
+        for thread in threads:
+            thread.start()
+        for vm in vms:
+            self.assertTrue(vm.connected.wait(5))
+            self.assertTrue(vm.listening.is_set())
+        for thread in threads:
+            thread.join()
+        for vm in vms:
+            vm.close_down()
+
+
+def run_parallel(jobs, names=None):
+    """
+    Run test classes of this module, all by default, each in its own process and jobs of
+    them at once, like pytest -n jobs does with pytest-xdist. Returns whether all passed
+    """
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    names = names or [name for name, obj in globals().items() if isinstance(obj, type) and issubclass(obj, unittest.TestCase)]
+
+    def run(name):
+        started = time.monotonic()
+        done = subprocess.run([sys.executable, "-m", "unittest", module + "." + name], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        return done, time.monotonic() - started
+
+    start = time.monotonic()
+    failed = []
+    with ThreadPoolExecutor(jobs) as pool:
+        runs = {pool.submit(run, name): name for name in names}
+        for future in as_completed(runs):
+            done, elapsed = future.result()
+            print("{:4s} {:24s} {:6.2f} s".format("ok" if done.returncode == 0 else "FAIL", runs[future], elapsed))
+            if done.returncode != 0:
+                failed.append(runs[future])
+                print(done.stdout)
+    print("{} test classes in {:.1f} s, {} failed{}".format(len(names), time.monotonic() - start, len(failed), "".join(" " + name for name in failed)))
+    return not failed
+
 
 if __name__ == "__main__":
-    unittest.main()
+    # python3 test.py -j 8 runs the test classes 8 at a time, anything else goes to unittest
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-j", "--jobs", type=int)
+    args, rest = parser.parse_known_args()
+    if args.jobs:
+        sys.exit(0 if run_parallel(args.jobs, [name for name in rest if not name.startswith("-")]) else 1)
+    unittest.main(argv=sys.argv[:1] + rest)